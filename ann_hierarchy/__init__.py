@@ -0,0 +1,5 @@
+"""
+
+Shared geometry and I/O helpers used by the annotation-hierarchy CLIs
+
+"""
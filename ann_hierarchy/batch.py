@@ -0,0 +1,294 @@
+"""
+
+Batch processing of many slides with AnnotationHierarchy or CreateTissueAnnotation
+
+Slides are processed in a process pool, either from local files:
+
+    python -m ann_hierarchy.batch AnnotationHierarchy --input-dir slides/ --output-dir results/ --workers 8 -- \
+        "" "" "" "" --use_JSON true --json_Spec '{"operations": [...]}'
+
+where each sub-directory of slides/ holds the annotation files of one slide (large-image annotation JSON or GeoJSON,
+referenced by file name or annotation name) and, for CreateTissueAnnotation, a thumbnail (thumbnail.png/.jpg/.tif) and
+optionally the image metadata (tiles.json, as returned by /item/{id}/tiles, used to scale to base image coordinates).
+
+Or from every large-image item in a Girder folder or collection (--folder/--collection), with annotations referenced by
+name. Results are uploaded to each item (unless --output-dir is provided, in which case they are written there).
+
+Arguments after "--" are the CLI's own arguments, without input_image.
+
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import girder_client
+from ctk_cli import CLIArgumentParser
+
+from ann_hierarchy.cache import AnnotationCache
+from ann_hierarchy.executor import resolve_annotation_names
+from ann_hierarchy.girder_io import pooled_session
+from ann_hierarchy.local_io import LocalAnnotationCache, write_annotation_file, annotation_file_name, IMAGE_METADATA_NAME
+
+BATCH_CLIS = ['AnnotationHierarchy','CreateTissueAnnotation']
+CLI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),'cli')
+THUMBNAIL_NAMES = ['thumbnail.png','thumbnail.jpg','thumbnail.jpeg','thumbnail.tif','thumbnail.tiff']
+
+_cli_modules = {}
+
+
+def load_cli(cli_name:str):
+    """
+    Import one of the CLI scripts as a module.
+    """
+    if not cli_name in BATCH_CLIS:
+        raise ValueError(f'CLI: {cli_name} not available for batch processing! Choose from: {BATCH_CLIS}')
+
+    if not cli_name in _cli_modules:
+        spec = importlib.util.spec_from_file_location(cli_name,os.path.join(CLI_DIR,cli_name,f'{cli_name}.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _cli_modules[cli_name] = module
+
+    return _cli_modules[cli_name]
+
+def parse_cli_args(cli_name:str, cli_argv:list):
+    """
+    Parse a CLI's own arguments (as on its command line, without input_image).
+    """
+    parser = CLIArgumentParser(os.path.join(CLI_DIR,cli_name,f'{cli_name}.xml'))
+
+    return parser.parse_args(['']+list(cli_argv))
+
+def list_local_slides(input_dir:str)->list:
+    """
+    Every slide directory (sub-directory) of input_dir.
+    """
+    return [
+        os.path.join(input_dir,d)
+        for d in sorted(os.listdir(input_dir))
+        if os.path.isdir(os.path.join(input_dir,d))
+    ]
+
+def list_girder_items(gc, parent_id:str, parent_type:str = 'folder')->list:
+    """
+    Ids of every large-image item in a Girder folder or collection (including sub-folders).
+    """
+    item_ids = []
+    if parent_type=='folder':
+        item_ids.extend([i['_id'] for i in gc.listItem(parent_id) if 'largeImage' in i])
+
+    for folder in gc.listFolder(parent_id,parentFolderType=parent_type):
+        item_ids.extend(list_girder_items(gc,folder['_id'],'folder'))
+
+    return item_ids
+
+def local_image(slide_dir:str)->tuple:
+    """
+    Get (thumbnail array, image metadata) for a local slide directory.
+    Without image metadata, thumbnail pixels are used as image coordinates.
+    """
+    thumbnail_path = None
+    for name in THUMBNAIL_NAMES:
+        if os.path.exists(os.path.join(slide_dir,name)):
+            thumbnail_path = os.path.join(slide_dir,name)
+            break
+    if thumbnail_path is None:
+        raise FileNotFoundError(f'No thumbnail ({", ".join(THUMBNAIL_NAMES)}) in {slide_dir}')
+
+    from PIL import Image
+    thumb_array = np.array(Image.open(thumbnail_path))
+
+    metadata_path = os.path.join(slide_dir,IMAGE_METADATA_NAME)
+    if os.path.exists(metadata_path):
+        with open(metadata_path) as f:
+            image_metadata = json.load(f)
+    else:
+        image_metadata = {'sizeX': thumb_array.shape[1],'sizeY': thumb_array.shape[0]}
+
+    return thumb_array, image_metadata
+
+def write_slide_annotations(output_dir:str, new_annotation_list:list)->list:
+    """
+    Write each (non-empty) annotation to output_dir, returning the paths written.
+    """
+    paths = []
+    for n in new_annotation_list:
+        if len(n['annotation']['elements'])==0:
+            print('No elements in the annotation!')
+            continue
+        path = os.path.join(output_dir,annotation_file_name(n['annotation']['name']))
+        write_annotation_file(path,n)
+        paths.append(path)
+
+    return paths
+
+def item_args(args, gc, item_id:str):
+    """
+    Copy of AnnotationHierarchy arguments with annotation names replaced by the ids of the item's annotations.
+    """
+    annotation_ids = {}
+    for ann in gc.get('/annotation',parameters={'itemId': item_id,'limit': 0}):
+        annotation_ids.setdefault(ann.get('annotation',{}).get('name'),ann['_id'])
+
+    resolved_args = copy.copy(args)
+    resolved = resolve_annotation_names({'ann_id_1': args.ann_id_1,'ann_id_2': args.ann_id_2},annotation_ids)
+    resolved_args.ann_id_1 = resolved['ann_id_1']
+    resolved_args.ann_id_2 = resolved['ann_id_2']
+
+    if args.use_json:
+        json_spec = json.loads(args.json_spec)
+        json_spec['operations'] = [resolve_annotation_names(op,annotation_ids) for op in json_spec['operations']]
+        resolved_args.json_spec = json.dumps(json_spec)
+
+    return resolved_args
+
+def run_local_slide(cli_name:str, args, slide_dir:str, output_dir:str)->dict:
+    """
+    Process one local slide directory, writing results to output_dir/<slide>/. Returns a summary of the results.
+    """
+    cli = load_cli(cli_name)
+    slide_name = os.path.basename(os.path.normpath(slide_dir))
+
+    if cli_name=='AnnotationHierarchy':
+        annotation_cache = LocalAnnotationCache(slide_dir,memory_budget_mb=args.cache_memory,cache_dir=args.cache_dir)
+        new_annotation_list = cli.create_annotations(args,None,None,annotation_cache)
+    else:
+        thumb_array, image_metadata = local_image(slide_dir)
+        gray_mask = cli.thumbnail_grayscale(thumb_array,args.brightfield)
+        new_annotation_list = [cli.create_tissue_annotation(args,gray_mask,image_metadata)]
+
+    write_slide_annotations(os.path.join(output_dir,slide_name),new_annotation_list)
+
+    return {
+        'slide': slide_name,
+        'annotations': {n['annotation']['name']: len(n['annotation']['elements']) for n in new_annotation_list}
+    }
+
+def run_girder_item(cli_name:str, args, item_id:str, output_dir:str = None)->dict:
+    """
+    Process one Girder item, uploading results to it (or writing them to output_dir/<item id>/). Returns a summary of the results.
+    """
+    cli = load_cli(cli_name)
+
+    gc = girder_client.GirderClient(apiUrl=args.girderApiUrl)
+    gc.setToken(args.girderToken)
+
+    max_connections = args.fetch_workers if cli_name=='AnnotationHierarchy' else args.n_workers
+    with gc.session(pooled_session(max_connections)):
+        if cli_name=='AnnotationHierarchy':
+            resolved_args = item_args(args,gc,item_id)
+            annotation_cache = AnnotationCache(gc,item_id,memory_budget_mb=args.cache_memory,cache_dir=args.cache_dir)
+            new_annotation_list = cli.create_annotations(resolved_args,gc,item_id,annotation_cache)
+        else:
+            new_annotation_list = [cli.detect_item_tissue(args,gc,item_id)]
+
+        if output_dir:
+            write_slide_annotations(os.path.join(output_dir,item_id),new_annotation_list)
+        elif cli_name=='AnnotationHierarchy':
+            cli.post_annotations(args,gc,item_id,new_annotation_list,annotation_cache)
+        else:
+            cli.post_tissue_annotation(args,gc,item_id,new_annotation_list[0])
+
+    return {
+        'slide': item_id,
+        'annotations': {n['annotation']['name']: len(n['annotation']['elements']) for n in new_annotation_list}
+    }
+
+def _run_slide(run_slide, cli_name:str, args, slide:str, output_dir:str)->dict:
+    """
+    Run one slide, recording how long it took and any error (so one bad slide doesn't stop the batch).
+    """
+    start = time.perf_counter()
+    try:
+        summary = run_slide(cli_name,args,slide,output_dir)
+    except Exception as e:
+        summary = {'slide': os.path.basename(os.path.normpath(slide)),'error': f'{type(e).__name__}: {e}'}
+    summary['seconds'] = time.perf_counter()-start
+
+    return summary
+
+def run_batch(run_slide, cli_name:str, args, slides:list, output_dir:str = None, n_workers:int = 1)->list:
+    """
+    Run run_slide(cli_name, args, slide, output_dir) for every slide, spread over n_workers processes.
+    Returns the summary for each slide (in the order slides finish).
+    """
+    summaries = []
+    def report(summary):
+        summaries.append(summary)
+        status = f'error: {summary["error"]}' if 'error' in summary else f'{len(summary["annotations"])} annotations'
+        print(f'[{len(summaries)}/{len(slides)}] {summary["slide"]}: {status} ({summary["seconds"]:.2f}s)')
+
+    if n_workers<=1 or len(slides)<=1:
+        for slide in slides:
+            report(_run_slide(run_slide,cli_name,args,slide,output_dir))
+        return summaries
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_run_slide,run_slide,cli_name,args,slide,output_dir) for slide in slides]
+        for future in as_completed(futures):
+            report(future.result())
+
+    return summaries
+
+def main(argv:list = None):
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # Everything after "--" is passed to the CLI
+    if '--' in argv:
+        cli_argv = argv[argv.index('--')+1:]
+        argv = argv[:argv.index('--')]
+    else:
+        cli_argv = []
+
+    parser = argparse.ArgumentParser(
+        prog = 'python -m ann_hierarchy.batch',
+        description = 'Run AnnotationHierarchy or CreateTissueAnnotation over many slides. CLI arguments (without input_image) follow "--".'
+    )
+    parser.add_argument('cli',choices=BATCH_CLIS)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--input-dir',help='Directory with one sub-directory of annotation files/thumbnail per slide')
+    source.add_argument('--folder',help='Girder folder id (every large-image item in it and its sub-folders)')
+    source.add_argument('--collection',help='Girder collection id (every large-image item in it)')
+    parser.add_argument('--output-dir',default=None,help='Directory to write results to (required for --input-dir, otherwise results are uploaded)')
+    parser.add_argument('--workers',type=int,default=os.cpu_count(),help='Number of slides processed at once')
+    batch_args = parser.parse_args(argv)
+
+    args = parse_cli_args(batch_args.cli,cli_argv)
+
+    if batch_args.input_dir is not None:
+        if batch_args.output_dir is None:
+            parser.error('--output-dir is required with --input-dir')
+        run_slide = run_local_slide
+        slides = list_local_slides(batch_args.input_dir)
+    else:
+        run_slide = run_girder_item
+        gc = girder_client.GirderClient(apiUrl=args.girderApiUrl)
+        gc.setToken(args.girderToken)
+        if batch_args.folder is not None:
+            slides = list_girder_items(gc,batch_args.folder,'folder')
+        else:
+            slides = list_girder_items(gc,batch_args.collection,'collection')
+
+    print(f'Running {batch_args.cli} on {len(slides)} slides with {batch_args.workers} workers')
+    summaries = run_batch(run_slide,batch_args.cli,args,slides,batch_args.output_dir,batch_args.workers)
+
+    n_errors = sum(1 for s in summaries if 'error' in s)
+    print(f'Finished {len(summaries)-n_errors} slides, {n_errors} errors')
+    if batch_args.output_dir is not None:
+        os.makedirs(batch_args.output_dir,exist_ok=True)
+        with open(os.path.join(batch_args.output_dir,'batch_summary.json'),'w') as f:
+            json.dump(summaries,f,indent=4)
+
+    return summaries
+
+
+if __name__=='__main__':
+    main()
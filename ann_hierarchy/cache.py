@@ -0,0 +1,261 @@
+"""
+
+Per-run cache of fetched annotations and their parsed geometries
+
+"""
+
+import os
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import shapely
+
+from ann_hierarchy.geometry import polygons_from_annotation
+from ann_hierarchy.instrument import stage, is_active, count_vertices
+from ann_hierarchy.store import GeometryStore
+
+
+def geometry_nbytes(geoms:np.ndarray)->int:
+    """
+    Rough estimate of the memory used by an array of geometries (coordinates plus per-geometry overhead).
+    """
+    return int(16*np.sum(shapely.get_num_coordinates(geoms)) + 100*geoms.shape[0])
+
+class AnnotationCache:
+    """
+    Cache of annotations shared by all operations in a run.
+
+    Entries are keyed by annotation id and "updated" timestamp and hold both the raw annotation and (once requested)
+    the parsed geometries. Least recently used entries are evicted once the estimated size exceeds memory_budget_mb.
+    If cache_dir is provided, entries are also persisted there so later runs skip both the download and the geometry build
+    (geometries are kept in a GeometryStore and memory-mapped when read back).
+    """
+    def __init__(self, gc, item_id:str = None, memory_budget_mb:float = 1024, cache_dir:str = None):
+
+        self.gc = gc
+        self.item_id = item_id
+        self.memory_budget = memory_budget_mb*(1024**2)
+        self.cache_dir = cache_dir if cache_dir else None
+        self.geometry_store = None
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir,exist_ok=True)
+            self.geometry_store = GeometryStore(self.cache_dir)
+
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.updated_stamps = None
+        self.annotation_names = None
+        self.annotation_attributes = None
+        self.image_metadata = None
+        # Guards entries, each entry also has its own lock so that different annotations can be loaded concurrently
+        self.lock = threading.RLock()
+
+    def get_updated(self, annotation_id:str):
+        """
+        Get the "updated" timestamp of an annotation (annotation metadata for the item is listed once, without elements).
+        """
+        with self.lock:
+            if self.updated_stamps is None:
+                self._list_annotations()
+
+        return self.updated_stamps.get(annotation_id)
+
+    def _list_annotations(self):
+        """
+        List the item's annotation metadata (without elements), recording "updated" timestamps, names and attributes.
+        """
+        self.updated_stamps = {}
+        self.annotation_names = {}
+        self.annotation_attributes = {}
+        if self.item_id is not None:
+            for ann in self.gc.get('/annotation',parameters={'itemId': self.item_id,'limit': 0}):
+                self.updated_stamps[ann['_id']] = ann.get('updated')
+                self.annotation_attributes[ann['_id']] = ann.get('annotation',{}).get('attributes')
+                self.annotation_names.setdefault(ann.get('annotation',{}).get('name'),[]).append(ann['_id'])
+
+    def find_annotations(self, name:str)->list:
+        """
+        Ids of the item's existing annotations with this name.
+        """
+        with self.lock:
+            if self.annotation_names is None:
+                self._list_annotations()
+
+        return self.annotation_names.get(name,[])
+
+    def get_attributes(self, annotation_id:str)->dict:
+        """
+        Get the "attributes" of one of the item's annotations from the listing (without downloading its elements).
+        """
+        with self.lock:
+            if self.annotation_attributes is None:
+                self._list_annotations()
+
+        return self.annotation_attributes.get(annotation_id)
+
+    def get_image_metadata(self)->dict:
+        """
+        Image metadata of the item (sizeX, sizeY, mm_x, ... as returned by /item/{id}/tiles), requested once.
+        """
+        with self.lock:
+            if self.image_metadata is None and self.item_id is not None:
+                self.image_metadata = self.gc.get(f'/item/{self.item_id}/tiles')
+
+        return self.image_metadata
+
+    def _disk_path(self, key:tuple, extension:str)->str:
+        """
+        Path of a persisted entry (None if there is no cache_dir or no timestamp to validate it with).
+        """
+        if self.cache_dir is None or key[1] is None:
+            return None
+
+        stamp = ''.join(c if c.isalnum() else '_' for c in str(key[1]))
+        return os.path.join(self.cache_dir,f'{key[0]}_{stamp}{extension}')
+
+    def _add_bytes(self, key:tuple, nbytes:int):
+        """
+        Record additional memory used by an entry and evict least recently used entries if over budget.
+        """
+        with self.lock:
+            if not key in self.entries:
+                return
+            self.entries[key]['nbytes'] += nbytes
+            self.total_bytes += nbytes
+
+            while self.total_bytes>self.memory_budget and len(self.entries)>1:
+                evict_key = next(iter(self.entries))
+                if evict_key==key:
+                    break
+                self.total_bytes -= self.entries.pop(evict_key)['nbytes']
+
+    def _entry(self, annotation_id:str)->dict:
+        """
+        Get (and mark as recently used) the cache entry for an annotation, creating an empty one if needed.
+        """
+        key = (annotation_id,self.get_updated(annotation_id))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            else:
+                self.entries[key] = {
+                    'key': key,
+                    'annotation': None,
+                    'geoms': None,
+                    'element_index': None,
+                    'nbytes': 0,
+                    'lock': threading.RLock()
+                }
+
+            return self.entries[key]
+
+    def get_annotation(self, annotation_id:str)->dict:
+        """
+        Get the raw annotation, loading it from disk or Girder if needed.
+        (Shared between operations, so copy elements before changing them)
+        """
+        entry = self._entry(annotation_id)
+        with entry['lock']:
+            if entry['annotation'] is None:
+                json_path = self._disk_path(entry['key'],'.json')
+                if json_path is not None and os.path.exists(json_path):
+                    with stage('fetch',annotation=annotation_id,source='cache_dir') as record:
+                        with open(json_path,'rb') as f:
+                            content = f.read()
+                        record['bytes'] = len(content)
+                else:
+                    with stage('fetch',annotation=annotation_id) as record:
+                        content = self._load_content(annotation_id)
+                        record['bytes'] = len(content)
+                    if json_path is not None:
+                        with open(json_path,'wb') as f:
+                            f.write(content)
+
+                with stage('decode',annotation=annotation_id,format='json') as record:
+                    entry['annotation'] = json.loads(content)
+                    record['elements'] = len(entry['annotation'].get('annotation',{}).get('elements',[]))
+                # Parsed JSON takes several times the size of the raw text
+                self._add_bytes(entry['key'],4*len(content))
+
+        return entry['annotation']
+
+    def _load_content(self, annotation_id:str)->bytes:
+        """
+        Get the raw (JSON) content of an annotation from Girder.
+        """
+        return self.gc.get(f'/annotation/{annotation_id}',jsonResp=False).content
+
+    def get_polygons(self, annotation_id:str)->tuple:
+        """
+        Get (polygons, element_index) for an annotation, parsing (or loading from disk) the geometries on first use.
+        """
+        entry = self._entry(annotation_id)
+        with entry['lock']:
+            if entry['geoms'] is None:
+                if self.geometry_store is not None and self.geometry_store.has(*entry['key']):
+                    with stage('parse',annotation=annotation_id,format='store') as record:
+                        geoms, element_index = self.geometry_store.open(*entry['key']).polygons()
+                else:
+                    annotation = self.get_annotation(annotation_id)
+                    with stage('parse',annotation=annotation_id,format='geometry') as record:
+                        geoms, element_index = polygons_from_annotation(annotation)
+                    if self.geometry_store is not None and entry['key'][1] is not None:
+                        self.geometry_store.write(*entry['key'],geoms,element_index)
+
+                if is_active():
+                    record['elements'] = int(np.unique(element_index).shape[0])
+                    record['vertices'] = count_vertices(geoms)
+
+                entry['geoms'] = geoms
+                entry['element_index'] = element_index
+                self._add_bytes(entry['key'],geometry_nbytes(geoms))
+
+        return entry['geoms'], entry['element_index']
+
+    def get_layer(self, annotation_id:str):
+        """
+        Get the stored GeometryLayer of an annotation's current version (None if it isn't in the geometry store), to
+        build only some of its polygons.
+        """
+        key = (annotation_id,self.get_updated(annotation_id))
+        if self.geometry_store is None or not self.geometry_store.has(*key):
+            return None
+
+        return self.geometry_store.open(*key)
+
+    def store_annotations(self, annotations:dict):
+        """
+        Save the geometries of annotations this run uploaded or patched ({annotation id: annotation}) to the geometry store
+        under their new "updated" timestamps, so later runs using them as inputs skip both the download and the geometry build.
+        """
+        if self.geometry_store is None or len(annotations)==0:
+            return
+
+        with self.lock:
+            # Listed again, uploads changed the timestamps
+            self._list_annotations()
+
+        for annotation_id, annotation in annotations.items():
+            version = self.get_updated(annotation_id)
+            if version is None:
+                continue
+            with stage('store',annotation=annotation_id) as record:
+                geoms, element_index = polygons_from_annotation(annotation)
+                self.geometry_store.write(annotation_id,version,geoms,element_index,{'name': annotation['annotation']['name']})
+                record['elements'] = len(annotation['annotation']['elements'])
+
+    def prefetch(self, annotation_ids:list, max_workers:int = 4, parse:bool = True)->list:
+        """
+        Load several annotations concurrently (each one is parsed as soon as it arrives if parse is True, so downloads and
+        geometry construction overlap). Returns the result of get_polygons (or get_annotation if parse is False) for each id.
+        """
+        load = self.get_polygons if parse else self.get_annotation
+        if max_workers<=1 or len(annotation_ids)<=1:
+            return [load(a) for a in annotation_ids]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(load,annotation_ids))
@@ -4,11 +4,8 @@ Creating/Editing existing annotations based on user selections of which structur
 
 """
 
-import os
 import sys
 
-import numpy as np
-
 import json
 
 import girder_client
@@ -16,127 +13,86 @@ from ctk_cli import CLIArgumentParser
 
 import uuid
 
-from shapely.geometry import Polygon, MultiPolygon
+import numpy as np
+from shapely.geometry import MultiPolygon
 from shapely.ops import unary_union
 from shapely.validation import make_valid
 
+from ann_hierarchy.geometry import polygons_from_annotation
+from ann_hierarchy.spatial import SpatialIndex, ELEMENT_PREDICATES, query_polygons_from_spec
+from ann_hierarchy.tiled import tiled_boolean
+from ann_hierarchy.cache import AnnotationCache
+from ann_hierarchy.executor import OperationGraph, LayerSources, operation_annotation_ids, operation_references
+from ann_hierarchy.incremental import derive_annotation
+from ann_hierarchy.hierarchy import hierarchy_elements
+from ann_hierarchy.lod import LOD_MODES, VARIANT_LEVELS, FIXED_TOLERANCE, lod_tolerances, lod_variant, simplified_elements
+from ann_hierarchy.girder_io import pooled_session, upload_annotations, patch_annotation
+from ann_hierarchy.instrument import stage, is_active, instrumented, print_arguments
+
 
 def create_polygon_list(json_annotations:dict)->list:
     """
     Take large-image annotations and convert to list of polygon shapes.
     Includes holes.
     """
-    poly_list = []
-    for el_idx,el in enumerate(json_annotations['annotation']['elements']):
-        #TODO: add rectangle and point annotations
-        if el['type']=='polyline':
-            el_coords = np.array(el['points'])
-            x_y_tuples = [(i[0],i[1]) for i in el_coords.tolist()]
-
-            if not 'holes' in el:
-                hole_list = None
-            else:
-                hole_list = []
-                for h in el['holes']:
-                    hole_tuples = [(i[0],i[1]) for i in h]
-                    hole_list.append(hole_tuples)
-
-            el_poly = Polygon(x_y_tuples,holes = None)
-            if el_poly.is_valid:
-                poly_list.append(el_poly)
-            else:
-                # If the constructed polygon is invalid, use make_valid to make it valid.
-                made_valid = make_valid(el_poly)
-                if made_valid.geom_type=='Polygon':
-                    if made_valid.is_valid:
-                        poly_list.append(made_valid)
-                elif made_valid.geom_type in ['MultiPolygon','GeometryCollection']:
-                    for g in made_valid.geoms:
-                        # Only add valid polygons to the list of polygons
-                        if g.geom_type=='Polygon':
-                            if g.is_valid:
-                                poly_list.append(g)
-    
-    return poly_list
+    poly_array, _ = polygons_from_annotation(json_annotations)
 
-def make_annotation_from_shape(shape_list,name)->dict:
+    return poly_array.tolist()
+
+def make_annotation_from_shape(shape_list,name,tolerance:float = FIXED_TOLERANCE,report:bool = False)->dict:
     """
     Take a Shapely shape object (MultiPolygon or Polygon or GeometryCollection) and return the corresponding annotation 
+    (simplified with tolerance, reporting the vertex reduction and area deviation if report is True)
+    The unsimplified polygon of each element is kept as "polygons" (not uploaded), level of detail variants are built from it.
     """
+    shape_array = np.asarray(shape_list,dtype=object)
+    elements, polygon_index = simplified_elements(shape_array,tolerance,name=name if report else None)
+
+    # Points are kept as numpy arrays, these are serialized directly when uploading
     annotation_dict = {
         "annotation": {
             "name": name,
-            "elements": []
-        }
+            "elements": elements
+        },
+        "polygons": (shape_array.reshape(-1)[polygon_index],np.arange(len(elements)))
     }
-    for shape in shape_list:
-        
-        if shape.geom_type=='Polygon' and shape.is_valid:
-            # Exterior "shell" coordinates
-            shape = shape.simplify(tolerance=0.05,preserve_topology=False)
-
-            coords = list(shape.exterior.coords)
-            hole_coords = list(shape.interiors)
-            hole_list = []
-            for h in hole_coords:
-                hole_list.append([
-                    [i[0],i[1],0]
-                    for i in list(h.coords)
-                ])
-
-            if len(coords)>2:
-                annotation_dict['annotation']['elements'].append({
-                    'type': 'polyline',
-                    'points': [list(i)+[0] for i in coords],
-                    'holes': hole_list,
-                    'id': uuid.uuid4().hex[:24],
-                    'closed': True
-                })
-            else: 
-                print('Too few coords')
-        else:
-            print(f'shape.geom_type: {shape.geom_type}')
-            print(f'shape.is_validJ: {shape.is_valid}')
 
     return annotation_dict
 
-
-def main(args):
-    
-    # Printing inputs from CLI
-    for a in vars(args):
-        print(f'{a}: {getattr(args,a)}')
-
-    gc = girder_client.GirderClient(apiUrl = args.girderApiUrl)
-    gc.setToken(args.girderToken)
-
-    # Getting item Id from file
-    image_item = gc.get(f'/file/{args.input_image}')['itemId']
-
-    if not args.use_json:
-        print(f'Running {args.ann_id_1} {args.operation} {args.ann_id_2} to create {args.new_name}')
-
-        available_operations = ["+","-","plus","minus"]
-        if not args.operation.lower() in available_operations:
-            print(f'{args.operation} not implemented! :(')
-            sys.exit(1)
-        
-        annotation_1 = gc.get(f'/annotation/{args.ann_id_1}?token={args.girderToken}')
-        annotation_2 = gc.get(f'/annotation/{args.ann_id_2}?token={args.girderToken}')
-
-        poly_list_1 = create_polygon_list(annotation_1)
-        poly_list_2 = create_polygon_list(annotation_2)
-
-        if args.operation.lower() in ["+","plus"]:
-            # Addition of one annotation to another. (returns list of shapes)
-            merged_annotations = unary_union(poly_list_1+poly_list_2)
-            if merged_annotations.geom_type=='Polygon':
-                merged_list = [merged_annotations]
-            elif merged_annotations.geom_type in ['MultiPolygon','GeometryCollection']:
-                merged_list = merged_annotations.geoms
-
-        elif args.operation.lower() in ["-","minus"]:
-            # Subtraction of one annotation from another (returns one MultiPolygon)
+def combine_polygons(poly_list_1:list, poly_list_2:list, operation:str, tile_size:float = 0, n_workers:int = 1, tolerance:float = 0.0, raster_resolution:float = 0, raster_tile_pixels:int = 4096, raster_check:bool = False)->list:
+    """
+    Apply a plus (+) or minus (-) operation to two lists of polygons and return the list of resulting shapes.
+    If tile_size>0 the operation is split into tiles (processed by n_workers processes) and stitched back together.
+    If raster_resolution>0 the operation is approximated with masks of that pixel size instead (see raster_boolean).
+    """
+    if raster_resolution>0:
+        # Imported here so that vector-only jobs don't load scikit-image
+        from ann_hierarchy.raster import raster_boolean
+
+        raster_operation = 'union' if operation.lower() in ["+","plus"] else 'difference'
+        merged_array, raster_stats = raster_boolean(
+            poly_list_1,
+            poly_list_2,
+            raster_operation,
+            raster_resolution,
+            tile_pixels = raster_tile_pixels,
+            n_workers = n_workers,
+            compare_exact = raster_check
+        )
+        print(f'Raster {raster_operation}: {raster_stats}')
+        return merged_array.tolist()
+
+    if tile_size>0:
+        tiled_operation = 'union' if operation.lower() in ["+","plus"] else 'difference'
+        return tiled_boolean(poly_list_1,poly_list_2,tiled_operation,tile_size,n_workers=n_workers,tolerance=tolerance).tolist()
+
+    if operation.lower() in ["+","plus"]:
+        # Addition of one annotation to another. (returns list of shapes)
+        merged_annotations = unary_union(poly_list_1+poly_list_2)
+
+    elif operation.lower() in ["-","minus"]:
+        # Subtraction of one annotation from another (returns one MultiPolygon)
+        with stage('validate',operation='minus') as record:
             multi_1 = MultiPolygon(poly_list_1).buffer(0)
             if not multi_1.is_valid:
                 multi_1 = make_valid(multi_1)
@@ -145,20 +101,199 @@ def main(args):
             if not multi_2.is_valid:
                 multi_2 = make_valid(multi_2)
 
-            
-            print(f'multi_1 is valid: {multi_1.is_valid}, geoms: {len(multi_1.geoms) if multi_1.geom_type=="MultiPolygon" else 1}')
-            print(f'multi_2 is valid: {multi_2.is_valid}, geoms: {len(multi_2.geoms) if multi_2.geom_type=="MultiPolygon" else 1}')
+            record['valid'] = [multi_1.is_valid,multi_2.is_valid]
+            record['elements'] = sum(len(m.geoms) if m.geom_type=="MultiPolygon" else 1 for m in [multi_1,multi_2])
+
+        merged_annotations = multi_1.difference(multi_2)
+
+    if merged_annotations.geom_type=='Polygon':
+        merged_list = [merged_annotations]
+    elif merged_annotations.geom_type in ['MultiPolygon','GeometryCollection']:
+        merged_list = list(merged_annotations.geoms)
+    else:
+        merged_list = []
+
+    return merged_list
+
+def copy_annotation(annotation:dict, op:dict)->dict:
+    """
+    Copy an annotation created by an identical operation under a new name (with new element ids)
+    """
+    return {
+        "annotation": {
+            "name": op['new_name'],
+            "elements": [dict(el,id=uuid.uuid4().hex[:24]) for el in annotation['annotation']['elements']]
+        }
+    }
+
+def output_tolerance(op:dict, sources:LayerSources, args)->tuple:
+    """
+    Simplification tolerance of new geometries: the full detail tolerance for the image (see lod_tolerances) if the level
+    of detail is "adaptive" or "variants", otherwise FIXED_TOLERANCE.
+    Returns (tolerance, whether the simplification is reported).
+    """
+    level_of_detail = op.get('level_of_detail',args.level_of_detail)
+    if not level_of_detail in LOD_MODES:
+        raise ValueError(f'Level of detail: {level_of_detail} not implemented! Choose from: {LOD_MODES}')
+
+    if level_of_detail=='fixed':
+        return FIXED_TOLERANCE, False
+
+    return lod_tolerances(sources.annotation_cache.get_image_metadata())['full'], True
+
+def tracks_provenance(op:dict, args)->bool:
+    """
+    Whether a + or - operation is computed with derive_annotation: exact tiled operations on annotations of the item
+    (not on the output of other operations).
+    """
+    if op.get('tile_size',args.tile_size)<=0 or op.get('raster_resolution',args.raster_resolution)>0:
+        return False
 
-            merged_annotations = multi_1.difference(multi_2)
+    return len(operation_references(op))==0
 
-            if merged_annotations.geom_type=='Polygon':
-                merged_list = [merged_annotations]
-            elif merged_annotations.geom_type in ['MultiPolygon','GeometryCollection']:
-                merged_list = merged_annotations.geoms
+def run_json_operation(op:dict, sources:LayerSources, args)->dict:
+    """
+    Run one operation from json_spec and return the new annotation
+    """
+    if op['operation'].lower() in ["+","-","plus","minus"] and tracks_provenance(op,args):
+        # Exact tiled operations on annotation ids record their provenance (and can update a previous result)
+        tolerance, report_simplification = output_tolerance(op,sources,args)
+        new_annotation = derive_annotation(
+            sources,
+            op['ann_id_1'].strip(),
+            [a_2.strip() for a_2 in op.get('ann_id_2','').split(',') if not a_2.strip()==""],
+            op['operation'],
+            op['new_name'],
+            op.get('tile_size',args.tile_size),
+            op.get('n_workers',args.n_workers),
+            op.get('tile_tolerance',args.tile_tolerance),
+            op.get('incremental',args.incremental),
+            args.fetch_workers,
+            simplify_tolerance = tolerance,
+            report_simplification = report_simplification,
+            return_polygons = op.get('level_of_detail',args.level_of_detail)=='variants'
+        )
+
+    elif op['operation'].lower() in ["+","-","plus","minus"]:
+        # Fetching and parsing all of the (comma separated) second annotations concurrently
+        ann_id_2_list = [a_2 for a_2 in op.get('ann_id_2','').split(',') if not a_2.strip()==""]
+        poly_list_2 = []
+        for poly_array_2, _ in sources.get_polygons_many(ann_id_2_list,args.fetch_workers):
+            poly_list_2.extend(poly_array_2.tolist())
+
+        # Applying a + or - operation
+        poly_list_1 = sources.get_polygons(op['ann_id_1'])[0].tolist()
+
+        with stage('boolean',operation=op['operation'],new_name=op['new_name']) as record:
+            merged_list = combine_polygons(
+                poly_list_1,
+                poly_list_2,
+                op['operation'],
+                op.get('tile_size',args.tile_size),
+                op.get('n_workers',args.n_workers),
+                op.get('tile_tolerance',args.tile_tolerance),
+                op.get('raster_resolution',args.raster_resolution),
+                op.get('raster_tile_pixels',args.raster_tile_pixels),
+                op.get('raster_check',args.raster_check)
+            )
+            record['elements'] = len(merged_list)
 
         # Creating new annotation from merged annotation geoms
-        new_annotation = make_annotation_from_shape(merged_list,args.new_name)
-        new_annotation_list = [new_annotation]
+        tolerance, report_simplification = output_tolerance(op,sources,args)
+        with stage('simplify',new_name=op['new_name']) as record:
+            new_annotation = make_annotation_from_shape(merged_list,op['new_name'],tolerance,report_simplification)
+            record['elements'] = len(new_annotation['annotation']['elements'])
+            if is_active():
+                record['vertices'] = sum(len(el['points']) for el in new_annotation['annotation']['elements'])
+
+    elif op['operation'].lower()=='hierarchy':
+        # Nesting each layer within the one before it (ann_id_1 is the outermost layer, ann_id_2 the others in order)
+        layer_ids = [op['ann_id_1']]+[a for a in op.get('ann_id_2','').split(',') if not a.strip()==""]
+        layer_polygons = sources.get_polygons_many(layer_ids,args.fetch_workers)
+        layer_annotations = [sources.get_annotation(a) for a in layer_ids]
+
+        with stage('hierarchy',new_name=op['new_name']) as record:
+            new_annotation = {
+                "annotation": {
+                    "name": op['new_name'],
+                    "elements": hierarchy_elements(
+                        layer_annotations,
+                        layer_polygons,
+                        min_overlap = op.get('min_overlap',args.hierarchy_min_overlap),
+                        outside = op.get('outside',args.hierarchy_outside)
+                    )
+                }
+            }
+            record['elements'] = len(new_annotation['annotation']['elements'])
+
+    elif op['operation'].lower()=='property':
+        # Applying a filter by (compound) property predicates
+        annotation = sources.get_annotation(op['ann_id_1'])
+        property_table = sources.get_property_table(op['ann_id_1'])
+        include_idx = property_table.filter(op['property'])
+
+        include_elements = []
+        for i in include_idx.tolist():
+            new_id = uuid.uuid4().hex[:24]
+            include_elements.append(dict(annotation['annotation']['elements'][i],id=new_id))
+
+        new_annotation = {
+            "annotation": {
+                "name": op['new_name'],
+                "elements": include_elements
+            }
+        }
+
+    elif op['operation'].lower() in ELEMENT_PREDICATES:
+        # Grabbing all annotations satisfying a spatial predicate with one or more regions and putting them in their own annotation
+        predicate = op['operation'].lower()
+        annotation = sources.get_annotation(op['ann_id_1'])
+        poly_array, element_index = sources.get_polygons(op['ann_id_1'])
+
+        # Creating the query polygon(s) from exterior coordinates provided in op
+        query_polys = query_polygons_from_spec(op[predicate])
+
+        spatial_index = SpatialIndex(poly_array,element_index)
+        include_idx = spatial_index.query(query_polys,predicate,distance=op[predicate].get('distance'))
+
+        include_elements = []
+        for i in include_idx.tolist():
+            new_id = uuid.uuid4().hex[:24]
+            include_elements.append(dict(annotation['annotation']['elements'][i],id=new_id))
+
+        new_annotation = {
+            "annotation": {
+                "name": op['new_name'],
+                "elements": include_elements
+            }
+        }
+
+    else:
+        raise ValueError(f'{op["operation"]} not implemented! :(')
+
+    return new_annotation
+
+
+def create_annotations(args, gc, image_item:str, annotation_cache:AnnotationCache = None)->list:
+    """
+    Create the new annotations specified by args (either a single operation or json_spec)
+    (annotation_cache can be provided to read annotations from somewhere other than the item, e.g. local files)
+    """
+    # Annotations (and their geometries) shared by all operations in this run
+    if annotation_cache is None:
+        annotation_cache = AnnotationCache(gc,image_item,memory_budget_mb=args.cache_memory,cache_dir=args.cache_dir)
+
+    if not args.use_json:
+        print(f'Running {args.ann_id_1} {args.operation} {args.ann_id_2} to create {args.new_name}')
+
+        available_operations = ["+","-","plus","minus","hierarchy"]
+        if not args.operation.lower() in available_operations:
+            print(f'{args.operation} not implemented! :(')
+            sys.exit(1)
+        
+        op = {'ann_id_1': args.ann_id_1,'ann_id_2': args.ann_id_2,'operation': args.operation,'new_name': args.new_name}
+        new_annotation_list = [run_json_operation(op,LayerSources(annotation_cache,{}),args)]
+        lod_list = [args.level_of_detail]
 
     else:
         # For more specific or multiple changes, passing json
@@ -168,18 +303,30 @@ def main(args):
             "operations": [
                 {
                     "new_name": "",
-                    "ann_id_1": "",
+                    "ann_id_1": "" (or "@new_name" of another operation to use its output),
                     "ann_id_2": "" (can also be comma separated but these are combined first and then the operation is applied)
                       if doing a (+/-) operation, otherwise ignored (properties aren't transferred after performing an operation),
+                    "intermediate": (optional) if true, the output is only used by other operations and isn't posted,
+                    "incremental": (optional) override the CLI incremental parameter for tiled + or - operations,
+                    "tile_size", "n_workers", "tile_tolerance", "raster_resolution", "raster_tile_pixels", "raster_check": (optional)
+                      override the CLI tiling/raster parameters for + or - operations,
+                    "level_of_detail": (optional) override the CLI level of detail ("fixed", "adaptive" or "variants"),
                     "operation": + or - (as above) but also allows:
                         - "property": {
                             "key": name of property in "user",
                             "sub_key": if there's a sub-property to use,
                             "value": either a string if applying a categorical filter or a list [minimum, maximum]
-                        }
+                            (or "in": [accepted values], "range": [minimum, maximum], "min"/"max", "equals")
+                        } these can be combined with {"and": [...]}, {"or": [...]} and {"not": {...}}
                         - "within": {
                             "coordinates": [[x1,y1],...] exterior coordinates to include within
-                        } <-- This could also be expanded to other spatial predicates ("intersects", "overlaps", etc. etc.)
+                            or "polygons": [[[x1,y1],...],...] exterior coordinates of multiple regions (elements matching any region are included)
+                        }
+                        - "intersects", "contains", "overlaps": same as "within" but using that spatial predicate
+                        - "dwithin": same as "within" but also requires "distance" (elements within that distance of a region)
+                        - "hierarchy": nests each layer (ann_id_1 then every ann_id_2, outermost first) within the layer before it,
+                          adding "hierarchy": {"layer", "depth", "parent" (element id), "overlap"} to each element's "user".
+                          Optionally "min_overlap" and "outside" ("keep", "drop" or "clip") override the CLI parameters
                 }
             ]
         }
@@ -188,117 +335,154 @@ def main(args):
         json_operation = json.loads(args.json_spec)
         print(f'JSON operation: {json_operation}')
 
-        new_annotation_list = []
-        for op in json_operation['operations']:
+        # Operations run as a dependency graph, outputs referenced as "@new_name" are kept in memory
+        operation_graph = OperationGraph(json_operation['operations'])
 
-            if op['operation'].lower() in ["+","-","plus","minus"]:
-                if "," in op['ann_id_2']:
-                    ann_id_2_list = op['ann_id_2'].split(',')
-                    poly_list_2 = []
-                    for a_2 in ann_id_2_list:
-                        ann = gc.get(f'/annotation/{a_2}?token={args.girderToken}')
-                        poly_list_2.extend(create_polygon_list(ann))
-                elif not op['ann_id_2'] == "":
-                    poly_list_2 = create_polygon_list(gc.get(f'/annotation/{op["ann_id_2"]}?token={args.girderToken}'))
-
-                # Applying a + or - operation
-                annotation_1 = gc.get(f'/annotation/{op["ann_id_1"]}?token={args.girderToken}')
-                poly_list_1 = create_polygon_list(annotation_1)
-
-                if op["operation"].lower() in ["+","plus"]:
-                    # Addition of one annotation to another. (returns list of shapes)
-                    merged_annotations = unary_union(poly_list_1+poly_list_2)
-                    merged_list = merged_annotations.geoms
-
-                elif op["operation"].lower() in ["-","minus"]:
-                    # Subtraction of one annotation from another (returns one MultiPolygon)
-                    merged_annotations = MultiPolygon(poly_list_1).difference(MultiPolygon(poly_list_2))
-                    merged_list = merged_annotations.geoms
-
-                # Creating new annotation from merged annotation geoms
-                new_annotation = make_annotation_from_shape(merged_list,op['new_name'])
-                new_annotation_list.append(new_annotation)
-
-            elif op['operation'].lower()=='property':
-                # Applying a filter by a property
-                annotation = gc.get(f'/annotation/{op["ann_id_1"]}?token={args.girderToken}')
-                property_filter = op['operation']['property']
-
-                include_elements = []
-                for el in annotation['annotation']['elements']:
-                    if 'user' in el:
-                        if property_filter['key'] in el['user']:
-                            el_val = el['user'][property_filter['key']]
-                            if 'sub_key' in property_filter:
-                                if property_filter['sub_key'] in el_val:
-                                    el_val = el_val[property_filter['sub_key']]
-                            
-                            if type(property_filter['value'])==str:
-                                if el_val==property_filter['value']:
-                                    new_id = uuid.uuid4().hex[:24]
-                                    el['id'] = new_id
-                                    include_elements.append(el)
-                            if type(property_filter['value'])==list:
-                                if el_val>=property_filter['value'][0] and el_val<=property_filter['value'][1]:
-                                    new_id = uuid.uuid4().hex[:24]
-                                    el['id'] = new_id
-                                    include_elements.append(el)
-
-                new_annotation = {
-                    "annotation": {
-                        "name": op['new_name'],
-                        "elements": include_elements
-                    }
-                }
-
-                new_annotation_list.append(new_annotation)
-
-            elif op['operation'].lower()=='within':
-                # Grabbing all annotations within a specified area and putting them in their own annotation
-                annotation = gc.get(f'/annotation/{op["ann_id_1"]}?token={args.girderToken}')
-                poly_list = create_polygon_list(annotation)
-
-                # Creating the polygon shape from exterior coordinates provided in op
-                filter_poly = Polygon([(i[0],i[1]) for i in op['operation']['within']['coordinates']])
-
-                include_elements = []
-                for i in range(len(poly_list)):
-                    if poly_list[i].within(filter_poly):
-                        new_id = uuid.uuid4().hex[:24]
-                        annotation['annotation']['elements'][i]['id'] = new_id
-                        include_elements.append(annotation['annotation']['elements'][i])
-
-                new_annotation = {
-                    "annotation": {
-                        "name": op['new_name'],
-                        "elements": include_elements
-                    }
-                }
-
-                new_annotation_list.append(new_annotation)
-
-
-    # Now adding the new annotation to the image
+        # Fetching every annotation used by the spec concurrently (geometries are only built for geometric operations)
+        geometry_ids = []
+        annotation_ids = []
+        for op in json_operation['operations']:
+            op_ids = operation_annotation_ids(op)
+            if op['operation'].lower()=='property':
+                annotation_ids.extend([a for a in op_ids if not a in annotation_ids])
+            else:
+                geometry_ids.extend([a for a in op_ids if not a in geometry_ids])
+
+        annotation_cache.prefetch(geometry_ids,args.fetch_workers)
+        annotation_cache.prefetch([a for a in annotation_ids if not a in geometry_ids],args.fetch_workers,parse=False)
+
+        results = {}
+        layer_sources = LayerSources(annotation_cache,results)
+        operation_graph.run(
+            lambda op: run_json_operation(op,layer_sources,args),
+            n_workers = args.n_threads,
+            copy_result = copy_annotation,
+            results = results
+        )
+
+        new_annotation_list = [
+            results[op['new_name']]
+            for op in json_operation['operations']
+            if not op.get('intermediate',False)
+        ]
+        lod_list = [
+            op.get('level_of_detail',args.level_of_detail)
+            for op in json_operation['operations']
+            if not op.get('intermediate',False)
+        ]
+
+    # Adding simplified copies of new annotations for viewing at lower magnifications
+    variant_list = []
+    for new_annotation, level_of_detail in zip(new_annotation_list,lod_list):
+        if not level_of_detail=='variants':
+            continue
+        if 'patch' in new_annotation and len(new_annotation['patch']['remove'])==0 and len(new_annotation['patch']['add'])==0:
+            # Unchanged, its variants are already on the item
+            continue
+
+        tolerances = lod_tolerances(annotation_cache.get_image_metadata())
+        name = new_annotation['annotation']['name']
+        for level in VARIANT_LEVELS:
+            with stage('simplify',new_name=name,level=level) as record:
+                variant = lod_variant(new_annotation,level,tolerances[level],polygons=new_annotation.get('polygons'))
+                record['elements'] = len(variant['annotation']['elements'])
+
+            if '_id' in new_annotation:
+                # Updated in place, so the variants made from its previous version are replaced once the new ones are uploaded
+                variant['_replaces'] = [
+                    a for a in annotation_cache.find_annotations(variant['annotation']['name'])
+                    if ((annotation_cache.get_attributes(a) or {}).get('lod') or {}).get('source')==name
+                ]
+            variant_list.append(variant)
+
+    return new_annotation_list+variant_list
+
+
+def post_annotations(args, gc, image_item:str, new_annotation_list:list, annotation_cache:AnnotationCache = None):
+    """
+    Upload the new annotations to the image item (or just report them if this is a test run)
+    (if annotation_cache has a geometry store, the geometries of uploaded annotations are saved to it for later runs)
+    Annotations listing previous versions in "_replaces" (level of detail variants of updated annotations) are uploaded
+    before those are deleted.
+    """
     if not args.test_run:
 
+        stored = {}
+        upload_list = []
         for n in new_annotation_list:
-            if len(n['annotation']['elements'])>0:
-                gc.post(f'/annotation/item/{image_item}?token={args.girderToken}',
-                        data = json.dumps(n),
-                        headers={
-                            'X-HTTP-Method': 'POST',
-                            'Content-Type':'application/json'
-                        }
-                    )
+            if 'patch' in n:
+                # Existing annotation updated incrementally
+                if len(n['patch']['remove'])==0 and len(n['patch']['add'])==0:
+                    print(f'No changes to: {n["annotation"]["name"]}')
+                    continue
+                p = patch_annotation(
+                    gc,
+                    n['_id'],
+                    n['patch']['remove'],
+                    n['patch']['add'],
+                    attributes = n['annotation']['attributes'],
+                    batch_size = args.upload_batch_size,
+                    compress = args.upload_gzip
+                )
+                print(f'Patched: {n["annotation"]["name"]} (-{p["removed"]}/+{p["added"]} elements) in {p["requests"]} requests, {p["bytes"]} bytes, {p["seconds"]:.2f}s')
+                stored[p['annotation_id']] = n
+            elif len(n['annotation']['elements'])>0:
+                upload_list.append(n)
             else:
                 print('No elements in the annotation!')
-    
+                for old_id in n.get('_replaces',[]):
+                    gc.delete(f'/annotation/{old_id}')
+                    print(f'Deleted previous version of {n["annotation"]["name"]}: {old_id}')
+
+        upload_stats = upload_annotations(
+            gc,
+            image_item,
+            upload_list,
+            batch_size = args.upload_batch_size,
+            compress = args.upload_gzip,
+            max_workers = args.upload_workers
+        )
+        for n, u in zip(upload_list,upload_stats):
+            print(f'Uploaded: {u["name"]} ({u["elements"]} elements) in {u["requests"]} requests, {u["bytes"]} bytes, {u["seconds"]:.2f}s')
+            stored[u['annotation_id']] = n
+            for old_id in n.get('_replaces',[]):
+                gc.delete(f'/annotation/{old_id}')
+                print(f'Deleted previous version of {u["name"]}: {old_id}')
+
+        if annotation_cache is not None:
+            annotation_cache.store_annotations(stored)
+
     else:
 
         print(f'Creation of new annotations successful')
         for n in new_annotation_list:
             print(f'new annotation: {n["annotation"]["name"]} contains: {len(n["annotation"]["elements"])} elements')
+            if 'patch' in n:
+                print(f'updates existing annotation: {n["_id"]} (-{len(n["patch"]["remove"])}/+{len(n["patch"]["add"])} elements)')
+            if len(n.get('_replaces',[]))>0:
+                print(f'replaces existing annotation(s): {", ".join(n["_replaces"])}')
+
+
+def main(args):
+    
+    # Printing inputs from CLI (without the token)
+    print_arguments(args)
+
+    # Recording per-stage timing/memory/counts (and profiling) if requested
+    with instrumented(args.instrument_output,args.profile_output,args):
+        gc = girder_client.GirderClient(apiUrl = args.girderApiUrl)
+        gc.setToken(args.girderToken)
+
+        # Getting item Id from file
+        image_item = gc.get(f'/file/{args.input_image}')['itemId']
+
+        # Reusing pooled connections for every request in this run (including concurrent fetches)
+        with gc.session(pooled_session(args.fetch_workers)):
+            annotation_cache = AnnotationCache(gc,image_item,memory_budget_mb=args.cache_memory,cache_dir=args.cache_dir)
+            new_annotation_list = create_annotations(args,gc,image_item,annotation_cache)
 
+            # Now adding the new annotation to the image
+            post_annotations(args,gc,image_item,new_annotation_list,annotation_cache)
 
 
 if __name__=='__main__':
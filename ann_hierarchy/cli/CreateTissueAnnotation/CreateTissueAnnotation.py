@@ -13,161 +13,192 @@ import girder_client
 
 from ctk_cli import CLIArgumentParser
 
-from PIL import Image
-from io import BytesIO
-import requests
-
 from skimage.filters import threshold_otsu
 from skimage.morphology import remove_small_holes
-from skimage.measure import label, find_contours
 
 import json
-from shapely.geometry import Polygon
-from shapely.validation import make_valid
 from shapely.ops import unary_union
-import uuid
+
+from ann_hierarchy.geometry import elements_from_polygons
+from ann_hierarchy.tissue import select_level, threshold_tissue, mask_polygons, detect_tissue_tiled, parse_frames, frame_intensity, reduce_frames
+from ann_hierarchy.girder_io import pooled_session, fetch_tile, fetch_thumbnail
+from ann_hierarchy.instrument import stage, is_active, count_vertices, instrumented, print_arguments
 
 
 def make_annotation_from_shape(shape_list,name,properties)->dict:
     """
     Take a Shapely shape object (MultiPolygon or Polygon or GeometryCollection) and return the corresponding annotation 
     """
+    # Ignoring holes for tissue
     annotation_dict = {
         "annotation": {
             "name": name,
-            "elements": []
+            "elements": elements_from_polygons(shape_list,include_holes=False,properties=properties)
         }
     }
-    for shape in shape_list:
-        
-        if shape.geom_type=='Polygon' and shape.is_valid:
-            # Exterior "shell" coordinates
-            coords = list(shape.exterior.coords)
-            """
-            # Ignoring holes for tissue
-            hole_coords = list(shape.interiors)
-            hole_list = []
-            for h in hole_coords:
-                hole_list.append([
-                    [i[0],i[1]]
-                    for i in list(h.coords)
-                ])
-            """
-            hole_list = []
-            annotation_dict['annotation']['elements'].append({
-                'type': 'polyline',
-                'points': [list(i)+[0] for i in coords],
-                'holes': hole_list,
-                'id': uuid.uuid4().hex[:24],
-                'closed': True,
-                'user': properties
-            })
 
     return annotation_dict
 
-def main(args):
-    
-    # Printing inputs from CLI
-    for a in vars(args):
-        print(f'{a}: {getattr(args,a)}')
-
-    gc = girder_client.GirderClient(apiUrl=args.girderApiUrl)
-    gc.setToken(args.girderToken)
-
-    # Getting item id from file
-    image_item = gc.get(f'/file/{args.input_image}')['itemId']
-
-    # Getting image information
-    image_metadata = gc.get(f'/item/{image_item}/tiles')
-
-    if not 'frames' in image_metadata:
-        # Grabbing the thumbnail of the image (RGB)
-        thumbnail_img = Image.open(BytesIO(requests.get(f'{gc.urlBase}/item/{image_item}/tiles/thumbnail?token={args.girderToken}').content))
-        thumb_array = np.array(thumbnail_img)
-
-    else:
-        # Getting the max projection of the thumbnail
-        thumb_frame_list = []
-        for f in range(len(image_metadata['frames'])):
-            thumb = np.array(Image.open(BytesIO(requests.get(f'{gc.urlBase}/item/{image_item}/tiles/thumbnail?frame={f}&token={args.girderToken}').content)))
-            print(np.shape(thumb))
-            thumb_frame_list.append(np.max(thumb,axis=-1)[:,:,None])
+def thumbnail_grayscale(thumb_array:np.ndarray, brightfield:bool)->np.ndarray:
+    """
+    Grayscale image used for thresholding from an RGB thumbnail
+    """
+    # Making the whole thing grayscale
+    if brightfield:
+        thumb_array = 255-thumb_array
 
-        thumb_array = np.concatenate(tuple(thumb_frame_list),axis=-1)
+    # Mean of all channels to make grayscale mask
+    return np.squeeze(np.mean(thumb_array,axis=-1))
 
-    print(f'shape of thumbnail array: {np.shape(thumb_array)}')
+def create_tissue_annotation(args, gray_mask:np.ndarray, image_metadata:dict, level_tile = None)->dict:
+    """
+    Threshold the grayscale thumbnail and create the tissue mask annotation.
+    If level_tile(level, x, y) is provided and args.detection_downsample>0, tissue is detected from tiles of that
+    pyramid level (using the threshold from the thumbnail).
+    """
+    print(f'shape of grayscale mask: {np.shape(gray_mask)}')
     # Getting scale factors for thumbnail image to full-size image
-    thumbX, thumbY = np.shape(thumb_array)[1],np.shape(thumb_array)[0]
+    thumbX, thumbY = np.shape(gray_mask)[1],np.shape(gray_mask)[0]
     scale_x = image_metadata['sizeX']/thumbX
     scale_y = image_metadata['sizeY']/thumbY
-    
-    # Making the whole thing grayscale
-    if args.brightfield:
-        thumb_array = 255-thumb_array
 
-    # Mean of all channels/frames to make grayscale mask
-    gray_mask = np.squeeze(np.mean(thumb_array,axis=-1))
-    print(f'shape of grayscale mask: {np.shape(gray_mask)}')
-
-    if args.threshold==0:
-        threshold_val = threshold_otsu(gray_mask)
-        tissue_mask = gray_mask <= threshold_val
-
-    else:
-        threshold_val = args.threshold
-        tissue_mask = gray_mask <= args.threshold
+    with stage('threshold',method='otsu' if args.threshold==0 else 'fixed'):
+        if args.threshold==0:
+            threshold_val = threshold_otsu(gray_mask)
+        else:
+            threshold_val = args.threshold
+        tissue_mask = threshold_tissue(gray_mask,threshold_val)
 
     print(f'threshold: {threshold_val}')
-    tissue_mask = remove_small_holes(tissue_mask,area_threshold=150)
 
-    labeled_mask = label(tissue_mask)
-    tissue_pieces = np.unique(labeled_mask).tolist()
-    print(f'Found: {len(tissue_pieces)-1} tissue pieces!')
-    tissue_shape_list = []
-    for piece in tissue_pieces[1:]:
-        tissue_contours = find_contours(labeled_mask==piece)
+    if args.detection_downsample>0 and level_tile is not None:
+        # Thresholding tiles streamed from a higher resolution pyramid level with the threshold from the thumbnail
+        level = select_level(image_metadata,args.detection_downsample)
+        level_scale = 2**(image_metadata['levels']-1-level)
+        print(f'Detecting tissue at level: {level} ({level_scale}x downsampled)')
+
+        # Tile fetches are recorded as their own stages
+        with stage('contour',level=level) as record:
+            tissue_shape_list = detect_tissue_tiled(
+                level_tile,
+                image_metadata,
+                level,
+                threshold_val,
+                args.brightfield,
+                hole_area = 150*(scale_x*scale_y)/(level_scale**2),
+                n_workers = args.n_workers
+            ).tolist()
+            record['elements'] = len(tissue_shape_list)
+        print(f'Found: {len(tissue_shape_list)} tissue pieces!')
 
-        for contour in tissue_contours:
-
-            poly_list = [(i[1]*scale_x,i[0]*scale_y) for i in contour]
-            if len(poly_list)>2:
-                obj_polygon = Polygon(poly_list)
-
-                if not obj_polygon.is_valid:
-                    made_valid = make_valid(obj_polygon)
+    else:
+        with stage('contour',level='thumbnail') as record:
+            tissue_mask = remove_small_holes(tissue_mask,area_threshold=150)
 
-                    if made_valid.geom_type=='Polygon':
-                        tissue_shape_list.append(made_valid)
-                    elif made_valid.geom_type in ['MultiPolygon','GeometryCollection']:
-                        for g in made_valid.geoms:
-                            if g.geom_type=='Polygon':
-                                tissue_shape_list.append(g)
-                else:
-                    tissue_shape_list.append(obj_polygon)
+            # Scaling all contours from thumbnail to full-size image coordinates (pieces touching the edge are closed along it)
+            tissue_shape_list = mask_polygons(tissue_mask,scale=(scale_x,scale_y)).tolist()
+            record['elements'] = len(tissue_shape_list)
+        print(f'Found: {len(tissue_shape_list)} tissue pieces!')
 
     # Merging shapes together to remove holes
-    merged_tissue = unary_union(tissue_shape_list)
-    if merged_tissue.geom_type=='Polygon':
-        merged_tissue = [merged_tissue]
-    elif merged_tissue.geom_type in ['MultiPolygon','GeometryCollection']:
-        merged_tissue = merged_tissue.geoms
+    with stage('boolean',operation='union') as record:
+        merged_tissue = unary_union(tissue_shape_list)
+        if merged_tissue.geom_type=='Polygon':
+            merged_tissue = [merged_tissue]
+        elif merged_tissue.geom_type in ['MultiPolygon','GeometryCollection']:
+            merged_tissue = merged_tissue.geoms
+        record['elements'] = len(merged_tissue)
+        if is_active():
+            record['vertices'] = count_vertices(list(merged_tissue))
+
+    return make_annotation_from_shape(merged_tissue,'Tissue Mask',properties={'Threshold': threshold_val})
+
+def detect_item_tissue(args, gc, image_item:str)->dict:
+    """
+    Create the tissue mask annotation for an image item in Girder
+    """
+    # Getting image information
+    image_metadata = gc.get(f'/item/{image_item}/tiles')
+
+    if not 'frames' in image_metadata:
+        # Grabbing the thumbnail of the image (RGB)
+        thumb_array = fetch_thumbnail(gc,image_item,cache_dir=args.thumbnail_cache)
+        print(f'shape of thumbnail array: {np.shape(thumb_array)}')
+        gray_mask = thumbnail_grayscale(thumb_array,args.brightfield)
 
-    annotation = make_annotation_from_shape(merged_tissue,'Tissue Mask',properties={'Threshold': threshold_val})
+        level_tile = lambda z,x,y: fetch_tile(gc,image_item,z,x,y)
 
+    else:
+        # Reducing the (max projection of each) selected frame thumbnails as they arrive
+        frame_list = parse_frames(args.frames,len(image_metadata['frames']))
+        frame_weights = [float(w) for w in args.frame_weights.split(',') if not w.strip()==''] if args.frame_weights else None
+        print(f'Combining {len(frame_list)} frames with: {args.frame_reduction}')
+
+        gray_mask = reduce_frames(
+            lambda f: frame_intensity(fetch_thumbnail(gc,image_item,f,cache_dir=args.thumbnail_cache)),
+            frame_list,
+            args.frame_reduction,
+            frame_weights,
+            n_workers = args.n_workers
+        )
+
+        if args.brightfield:
+            gray_mask = 255-gray_mask
+
+        # Each tile combines the same frames as the thumbnail (tiles are already fetched concurrently)
+        level_tile = lambda z,x,y: reduce_frames(
+            lambda f: frame_intensity(fetch_tile(gc,image_item,z,x,y,f)),
+            frame_list,
+            args.frame_reduction,
+            frame_weights
+        )
+
+    return create_tissue_annotation(args,gray_mask,image_metadata,level_tile)
+
+def post_tissue_annotation(args, gc, image_item:str, annotation:dict):
+    """
+    Post the tissue mask annotation to the image item (or just report it if this is a test run)
+    """
     if not args.test_run:
-        # Posting tissue mask annotations
-        gc.post(f'/annotation/item/{image_item}?token={args.girderToken}',
-                data = json.dumps(annotation),
-                headers={
-                    'X-HTTP-Method': 'POST',
-                    'Content-Type':'application/json'
-                }
-            )
+        with stage('serialize') as record:
+            body = json.dumps(annotation)
+            record['bytes'] = len(body)
+
+        # Posting tissue mask annotations (the client sends the token as a header, keeping it out of request logs)
+        with stage('upload',path=f'annotation/item/{image_item}') as record:
+            gc.post(f'/annotation/item/{image_item}',
+                    data = body,
+                    headers={
+                        'X-HTTP-Method': 'POST',
+                        'Content-Type':'application/json'
+                    }
+                )
+            record['bytes'] = len(body)
     else:
         print(f'Creation of tissue mask annotation successful')
         print(f'Found: {len(annotation["annotation"]["elements"])} tissue pieces')
 
 
+def main(args):
+    
+    # Printing inputs from CLI (without the token)
+    print_arguments(args)
+
+    # Recording per-stage timing/memory/counts (and profiling) if requested
+    with instrumented(args.instrument_output,args.profile_output,args):
+        gc = girder_client.GirderClient(apiUrl=args.girderApiUrl)
+        gc.setToken(args.girderToken)
+
+        # Getting item id from file
+        image_item = gc.get(f'/file/{args.input_image}')['itemId']
+
+        # Reusing pooled connections for concurrent thumbnail/tile requests
+        with gc.session(pooled_session(args.n_workers)):
+            annotation = detect_item_tissue(args,gc,image_item)
+
+        post_tissue_annotation(args,gc,image_item,annotation)
+
+
 if __name__=='__main__':
     main(CLIArgumentParser().parse_args())
 
@@ -0,0 +1,9 @@
+#!/usr/bin/env bash
+
+# Long-lived alternative to docker-entrypoint.sh: loads the CLIs once and runs jobs from a queue directory or socket
+# e.g. worker-entrypoint.sh --socket /tmp/ann_hierarchy.sock --workers 2
+
+# Try to start a local version memcached, but fail gracefully if we can't.
+memcached -u root -d -m 1024 || true
+
+python -m ann_hierarchy.worker "$@"
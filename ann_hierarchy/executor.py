@@ -0,0 +1,228 @@
+"""
+
+Dependency graph execution of json_spec operations with in-memory chained outputs
+
+"""
+
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from ann_hierarchy.geometry import polygons_from_annotation
+from ann_hierarchy.properties import PropertyTable
+
+# Prefix used to reference the output of another operation by its "new_name" (e.g. "@Cortex minus Medulla")
+REFERENCE_PREFIX = '@'
+ANNOTATION_KEYS = ['ann_id_1','ann_id_2']
+# Keys describing what happens to an operation's output rather than how it is computed
+OUTPUT_KEYS = ['new_name','intermediate']
+
+
+def operation_references(op:dict)->list:
+    """
+    Names of other operations' outputs referenced by this operation (in ann_id_1 or any of the comma separated ann_id_2).
+    """
+    references = []
+    for key in ANNOTATION_KEYS:
+        for ann_id in str(op.get(key,'')).split(','):
+            ann_id = ann_id.strip()
+            if ann_id.startswith(REFERENCE_PREFIX) and not ann_id[1:] in references:
+                references.append(ann_id[1:])
+
+    return references
+
+def operation_annotation_ids(op:dict)->list:
+    """
+    Annotation ids (not references to other operations) used by this operation.
+    """
+    ann_ids = []
+    for key in ANNOTATION_KEYS:
+        for ann_id in str(op.get(key,'')).split(','):
+            ann_id = ann_id.strip()
+            if not ann_id=='' and not ann_id.startswith(REFERENCE_PREFIX) and not ann_id in ann_ids:
+                ann_ids.append(ann_id)
+
+    return ann_ids
+
+def resolve_annotation_names(op:dict, annotation_ids:dict)->dict:
+    """
+    Copy of an operation with annotation names replaced by annotation ids (from {name: id}), so the same spec can be run on
+    many items. Anything else (ids, "@" references) is kept as-is.
+    """
+    resolved = dict(op)
+    for key in ANNOTATION_KEYS:
+        if key in op:
+            resolved[key] = ','.join([
+                a.strip() if a.strip().startswith(REFERENCE_PREFIX) else annotation_ids.get(a.strip(),a.strip())
+                for a in str(op[key]).split(',')
+            ])
+
+    return resolved
+
+def operation_signature(op:dict)->str:
+    """
+    Canonical representation of an operation (without its output name/options) used to detect repeated sub-expressions.
+    """
+    return json.dumps({k:v for k,v in op.items() if not k in OUTPUT_KEYS},sort_keys=True)
+
+
+class LayerSources:
+    """
+    Resolves annotation ids for operations: "@name" references return the in-memory output of another operation,
+    anything else is loaded through the annotation cache.
+    """
+    def __init__(self, annotation_cache, results:dict):
+
+        self.annotation_cache = annotation_cache
+        self.results = results
+        self.lock = threading.Lock()
+        self.parsed = {}
+        self.property_tables = {}
+
+    def get_annotation(self, ann_id:str)->dict:
+        """
+        Get the annotation (shared, so copy elements before changing them).
+        """
+        ann_id = ann_id.strip()
+        if ann_id.startswith(REFERENCE_PREFIX):
+            return self.results[ann_id[1:]]
+
+        return self.annotation_cache.get_annotation(ann_id)
+
+    def get_polygons(self, ann_id:str)->tuple:
+        """
+        Get (polygons, element_index) for an annotation, parsing referenced outputs once.
+        """
+        ann_id = ann_id.strip()
+        if ann_id.startswith(REFERENCE_PREFIX):
+            with self.lock:
+                if not ann_id in self.parsed:
+                    self.parsed[ann_id] = polygons_from_annotation(self.results[ann_id[1:]])
+            return self.parsed[ann_id]
+
+        return self.annotation_cache.get_polygons(ann_id)
+
+    def get_property_table(self, ann_id:str)->PropertyTable:
+        """
+        Get the property columns for an annotation (shared by every filter applied to it in this run).
+        """
+        ann_id = ann_id.strip()
+        annotation = self.get_annotation(ann_id)
+        with self.lock:
+            if not ann_id in self.property_tables:
+                self.property_tables[ann_id] = PropertyTable(annotation['annotation']['elements'])
+
+        return self.property_tables[ann_id]
+
+    def get_polygons_many(self, ann_ids:list, max_workers:int = 4)->list:
+        """
+        Get (polygons, element_index) for several annotations, fetching and parsing them concurrently.
+        """
+        if max_workers<=1 or len(ann_ids)<=1:
+            return [self.get_polygons(a) for a in ann_ids]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.get_polygons,ann_ids))
+
+
+class OperationGraph:
+    """
+    Operations from a json_spec arranged by the outputs they reference.
+
+    Operations run as soon as the outputs they reference are available, with independent operations running concurrently.
+    Operations that are identical apart from "new_name" are only computed once.
+    """
+    def __init__(self, operations:list):
+
+        self.operations = operations
+        self.names = [op['new_name'] for op in operations]
+        if len(set(self.names))<len(self.names):
+            raise ValueError('Each operation in json_spec needs a unique "new_name"')
+
+        self.dependencies = {}
+        for op in operations:
+            references = operation_references(op)
+            for r in references:
+                if not r in self.names:
+                    raise ValueError(f'Operation: {op["new_name"]} references unknown output: {REFERENCE_PREFIX}{r}')
+            self.dependencies[op['new_name']] = references
+
+        self.order = self._topological_order()
+
+    def _topological_order(self)->list:
+        """
+        Order operation names so that every operation comes after the operations it references (keeping spec order otherwise).
+        """
+        order = []
+        visiting = set()
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f'Operations in json_spec have a circular reference involving: {name}')
+            visiting.add(name)
+            for d in self.dependencies[name]:
+                visit(d)
+            visiting.discard(name)
+            order.append(name)
+
+        for name in self.names:
+            visit(name)
+
+        return order
+
+    def run(self, run_operation, n_workers:int = 1, copy_result = None, results:dict = None)->dict:
+        """
+        Run every operation, returning {new_name: result}.
+
+        run_operation(op) is called once the outputs an operation references are in results (pass a dict to share it with
+        e.g. LayerSources). If an operation is a repeat of one that was already computed, copy_result(result, op)
+        (if provided) is used to create its result instead.
+        """
+        ops = dict(zip(self.names,self.operations))
+        signatures = {name:operation_signature(ops[name]) for name in self.names}
+        results = results if results is not None else {}
+        computed = {}
+
+        def finish(name, result):
+            results[name] = result
+            computed.setdefault(signatures[name],name)
+
+        def reuse(name)->bool:
+            # Repeated sub-expression, copying the existing result
+            source = computed.get(signatures[name])
+            if source is None:
+                return False
+            result = results[source]
+            finish(name,copy_result(result,ops[name]) if copy_result is not None else result)
+            return True
+
+        if n_workers<=1:
+            for name in self.order:
+                if not reuse(name):
+                    finish(name,run_operation(ops[name]))
+            return results
+
+        pending = list(self.order)
+        running = {}
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            while len(pending)>0 or len(running)>0:
+                in_flight = {signatures[n] for n in running.values()}
+                for name in list(pending):
+                    if not all(d in results for d in self.dependencies[name]):
+                        continue
+                    if reuse(name):
+                        pending.remove(name)
+                    elif not signatures[name] in in_flight:
+                        running[executor.submit(run_operation,ops[name])] = name
+                        in_flight.add(signatures[name])
+                        pending.remove(name)
+
+                if len(running)==0:
+                    continue
+
+                done, _ = wait(list(running),return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(running.pop(future),future.result())
+
+        return results
@@ -0,0 +1,244 @@
+"""
+
+Array-based conversion between large-image annotation elements and Shapely geometries
+
+"""
+
+import uuid
+
+import numpy as np
+
+import shapely
+
+from ann_hierarchy.instrument import stage
+
+def _ring_array(points)->np.ndarray:
+    """
+    Return the (x,y) coordinates of a ring, or None if there aren't enough distinct points for a linear ring.
+    """
+    ring = np.asarray(points,dtype=float)
+    if ring.ndim!=2 or ring.shape[0]<3:
+        return None
+
+    ring = ring[:,:2]
+    if ring.shape[0]==3 and np.array_equal(ring[0],ring[-1]):
+        return None
+
+    return ring
+
+def rectangle_points(el:dict)->np.ndarray:
+    """
+    Corners of a large-image rectangle element (center, width, height and rotation in radians).
+    """
+    cx, cy = el['center'][0], el['center'][1]
+    half = np.array([[-1,-1],[1,-1],[1,1],[-1,1]],dtype=float)*[el['width']/2,el['height']/2]
+    angle = el.get('rotation',0) or 0
+    rotation = np.array([[np.cos(angle),-np.sin(angle)],[np.sin(angle),np.cos(angle)]])
+
+    return half@rotation.T+[cx,cy]
+
+def pack_elements(elements:list)->dict:
+    """
+    Pack the coordinates of every polyline (exterior and holes) and rectangle element into flat arrays.
+    Point elements have no area and are skipped.
+
+    Returns a dictionary with:
+        - "coords": (N,2) float array of all ring vertices
+        - "ring_index": (N,) ring index of each vertex
+        - "ring_polygon": (R,) polygon index of each ring (first ring of each polygon is its shell)
+        - "element_index": (P,) index in elements of each packed polygon
+    Rings with fewer than 3 points cannot form a polygon and are skipped (an element is skipped
+    entirely if its exterior is too short).
+    """
+    ring_arrays = []
+    ring_polygon = []
+    element_index = []
+    for el_idx,el in enumerate(elements):
+        if el.get('type')=='rectangle':
+            exterior = _ring_array(rectangle_points(el))
+        elif el.get('type')=='polyline':
+            exterior = _ring_array(el['points'])
+        else:
+            continue
+
+        if exterior is None:
+            continue
+
+        poly_idx = len(element_index)
+        element_index.append(el_idx)
+        ring_arrays.append(exterior)
+        ring_polygon.append(poly_idx)
+
+        for h in el.get('holes') or []:
+            hole = _ring_array(h)
+            if hole is not None:
+                ring_arrays.append(hole)
+                ring_polygon.append(poly_idx)
+
+    if len(ring_arrays)==0:
+        return {
+            'coords': np.empty((0,2),dtype=float),
+            'ring_index': np.empty(0,dtype=np.intp),
+            'ring_polygon': np.empty(0,dtype=np.intp),
+            'element_index': np.empty(0,dtype=np.intp)
+        }
+
+    ring_lengths = np.fromiter((r.shape[0] for r in ring_arrays),dtype=np.intp,count=len(ring_arrays))
+
+    return {
+        'coords': np.concatenate(ring_arrays,axis=0),
+        'ring_index': np.repeat(np.arange(len(ring_arrays)),ring_lengths),
+        'ring_polygon': np.asarray(ring_polygon,dtype=np.intp),
+        'element_index': np.asarray(element_index,dtype=np.intp)
+    }
+
+def polygons_from_packed(packed:dict)->tuple:
+    """
+    Build polygons from packed coordinate arrays, repairing invalid ones with make_valid.
+
+    Returns (polygons, element_index) where element_index maps each output polygon back to the
+    element it was created from. Invalid inputs may be split into several polygons (sharing the same
+    element index) or dropped if no valid polygonal part remains.
+    """
+    if packed['ring_polygon'].shape[0]==0:
+        return np.empty(0,dtype=object), np.empty(0,dtype=np.intp)
+
+    rings = shapely.linearrings(packed['coords'],indices=packed['ring_index'])
+    polys = shapely.polygons(rings,indices=packed['ring_polygon'])
+
+    # Validity checks and repairs on the whole array at once
+    with stage('validate') as record:
+        invalid = ~shapely.is_valid(polys)
+        record['elements'] = int(polys.shape[0])
+        record['invalid'] = int(np.count_nonzero(invalid))
+        if not np.any(invalid):
+            return polys, packed['element_index']
+
+        repaired = polys.copy()
+        repaired[invalid] = shapely.make_valid(polys[invalid])
+
+        # Exploding MultiPolygon/GeometryCollection results, keeping only valid Polygon parts
+        parts, part_index = shapely.get_parts(repaired,return_index=True)
+        keep = shapely.get_type_id(parts)==shapely.GeometryType.POLYGON
+        keep[keep] = shapely.is_valid(parts[keep])
+
+        return parts[keep], packed['element_index'][part_index[keep]]
+
+def polygons_from_rings(rings:list)->tuple:
+    """
+    Build one polygon (no holes) from each (n,2) array of exterior coordinates, repairing invalid ones with make_valid.
+
+    Returns (polygons, ring_index) where ring_index maps each output polygon back to the ring it was created from.
+    """
+    keep_rings = []
+    ring_index = []
+    for r_idx,r in enumerate(rings):
+        ring = _ring_array(r)
+        if ring is not None:
+            keep_rings.append(ring)
+            ring_index.append(r_idx)
+
+    if len(keep_rings)==0:
+        return np.empty(0,dtype=object), np.empty(0,dtype=np.intp)
+
+    ring_lengths = np.fromiter((r.shape[0] for r in keep_rings),dtype=np.intp,count=len(keep_rings))
+    packed = {
+        'coords': np.concatenate(keep_rings,axis=0),
+        'ring_index': np.repeat(np.arange(len(keep_rings)),ring_lengths),
+        'ring_polygon': np.arange(len(keep_rings)),
+        'element_index': np.asarray(ring_index,dtype=np.intp)
+    }
+
+    return polygons_from_packed(packed)
+
+def polygons_from_annotation(json_annotations:dict)->tuple:
+    """
+    Convert a large-image annotation to an array of polygons (including holes) and the element index of each one.
+    """
+    return polygons_from_packed(pack_elements(json_annotations['annotation']['elements']))
+
+def simplify_polygons(geoms, tolerance:float, preserve_topology:bool = False)->np.ndarray:
+    """
+    Simplify an array of polygons (one geometry out for each one in, small polygons can become empty).
+
+    Without preserve_topology, topology is still preserved for polygons with holes (so holes can't cross their exterior)
+    and for polygons that the faster simplification left invalid.
+    """
+    geoms = np.asarray(geoms,dtype=object)
+    if preserve_topology:
+        return shapely.simplify(geoms,tolerance,preserve_topology=True)
+
+    has_holes = shapely.get_num_interior_rings(geoms)>0
+    simplified = np.empty(geoms.shape[0],dtype=object)
+    simplified[~has_holes] = shapely.simplify(geoms[~has_holes],tolerance,preserve_topology=False)
+    simplified[has_holes] = shapely.simplify(geoms[has_holes],tolerance,preserve_topology=True)
+
+    invalid = ~has_holes
+    invalid[invalid] = ~shapely.is_valid(simplified[invalid])
+    simplified[invalid] = shapely.simplify(geoms[invalid],tolerance,preserve_topology=True)
+
+    return simplified
+
+def elements_from_polygons(geoms, tolerance:float = None, preserve_topology:bool = False, include_holes:bool = True, properties:dict = None, as_arrays:bool = False, return_index:bool = False)->list:
+    """
+    Convert an array of geometries to large-image polyline elements.
+
+    Only valid, non-empty Polygons are converted. If tolerance is provided, all polygons are simplified in one call (see
+    simplify_polygons) and polygons whose exterior is left with fewer than 3 coordinates are dropped. Points (and holes)
+    are [x,y,0]. If as_arrays is True, "points" and "holes" are (n,3) numpy array views instead of nested lists (to stream
+    straight to a numpy-aware JSON encoder).
+    If properties is provided it is added to each element as "user".
+    If return_index is True, returns (elements, index of the geometry each element was created from).
+    """
+    geoms = np.asarray(geoms,dtype=object)
+    if geoms.ndim==0:
+        geoms = geoms[None]
+
+    keep = shapely.get_type_id(geoms)==shapely.GeometryType.POLYGON
+    keep[keep] = shapely.is_valid(geoms[keep]) & ~shapely.is_empty(geoms[keep])
+    geom_index = np.flatnonzero(keep)
+    geoms = geoms[keep]
+
+    if tolerance is not None:
+        geoms = simplify_polygons(geoms,tolerance,preserve_topology=preserve_topology)
+        long_enough = shapely.get_num_coordinates(shapely.get_exterior_ring(geoms))>2
+        geoms = geoms[long_enough]
+        geom_index = geom_index[long_enough]
+
+    if geoms.shape[0]==0:
+        return ([], geom_index) if return_index else []
+
+    if include_holes:
+        rings, ring_geom = shapely.get_rings(geoms,return_index=True)
+    else:
+        rings = shapely.get_exterior_ring(geoms)
+        ring_geom = np.arange(geoms.shape[0])
+
+    # Flat (x,y,0) coordinates for every ring, split at ring offsets
+    coords, coord_ring = shapely.get_coordinates(rings,return_index=True)
+    coords = np.column_stack([coords,np.zeros(coords.shape[0])])
+    ring_offsets = np.searchsorted(coord_ring,np.arange(1,rings.shape[0]))
+    ring_coords = np.split(coords,ring_offsets)
+    if not as_arrays:
+        ring_coords = [r.tolist() for r in ring_coords]
+
+    # First ring of each polygon is the exterior, the rest are holes
+    geom_offsets = np.searchsorted(ring_geom,np.arange(geoms.shape[0]+1)).tolist()
+
+    elements = []
+    for start,end in zip(geom_offsets[:-1],geom_offsets[1:]):
+        el = {
+            'type': 'polyline',
+            'points': ring_coords[start],
+            'holes': ring_coords[start+1:end],
+            'id': uuid.uuid4().hex[:24],
+            'closed': True
+        }
+        if properties is not None:
+            el['user'] = properties
+        elements.append(el)
+
+    if return_index:
+        return elements, geom_index
+
+    return elements
@@ -0,0 +1,214 @@
+"""
+
+Concurrent transfers to and from Girder
+
+"""
+
+import os
+import gzip
+import json
+from io import BytesIO
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ann_hierarchy.instrument import stage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def pooled_session(max_connections:int = 8)->requests.Session:
+    """
+    Create a requests Session keeping up to max_connections connections open per host, for use with GirderClient.session()
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_connections,pool_maxsize=max_connections)
+    session.mount('http://',adapter)
+    session.mount('https://',adapter)
+
+    return session
+
+def _json_default(obj):
+    """
+    Convert numpy arrays (e.g. element points created with as_arrays=True) for the standard json encoder
+    """
+    if isinstance(obj,(np.ndarray,np.generic)):
+        return obj.tolist()
+
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+def fetch_image(gc, path:str, parameters:dict = None)->np.ndarray:
+    """
+    Get an image from a Girder endpoint (e.g. a thumbnail or tile) as an array
+    """
+    with stage('fetch',path=path) as record:
+        response = gc.get(path,parameters=parameters,jsonResp=False)
+        record['bytes'] = len(response.content)
+
+    # Imported here, only jobs reading images need it
+    from PIL import Image
+
+    with stage('decode',format='image'):
+        return np.array(Image.open(BytesIO(response.content)))
+
+def fetch_tile(gc, item_id:str, level:int, x:int, y:int, frame:int = None)->np.ndarray:
+    """
+    Get one tile of an item's pyramid (of one frame for multi-frame images)
+    (tiles on the right/bottom edge are cropped to the image instead of padded to the full tile size)
+    """
+    parameters = {'edge': 'crop'}
+    if frame is not None:
+        parameters['frame'] = frame
+
+    return fetch_image(gc,f'/item/{item_id}/tiles/zxy/{level}/{x}/{y}',parameters=parameters)
+
+def fetch_thumbnail(gc, item_id:str, frame:int = None, cache_dir:str = None)->np.ndarray:
+    """
+    Get an item's thumbnail (of one frame for multi-frame images).
+    If cache_dir is provided, decoded thumbnails are saved there per item and frame and re-used by later calls.
+    """
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir,f'{item_id}_thumbnail_{frame if frame is not None else "rgb"}.npy')
+        if os.path.exists(cache_path):
+            return np.load(cache_path)
+
+    parameters = {'frame': frame} if frame is not None else None
+    thumbnail = fetch_image(gc,f'/item/{item_id}/tiles/thumbnail',parameters=parameters)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir,exist_ok=True)
+        # Writing to a temporary file first so concurrent readers never see a partial array
+        temp_path = f'{cache_path}.{uuid.uuid4().hex}.npy'
+        np.save(temp_path,thumbnail)
+        os.replace(temp_path,cache_path)
+
+    return thumbnail
+
+def encode_json(obj)->bytes:
+    """
+    Serialize to JSON bytes (using orjson if it is installed)
+    """
+    if orjson is not None:
+        return orjson.dumps(obj,option=orjson.OPT_SERIALIZE_NUMPY)
+
+    return json.dumps(obj,default=_json_default).encode('utf-8')
+
+def _send_json(gc, method:str, path:str, obj, compress:bool = False, parameters:dict = None):
+    """
+    Send obj as a JSON request body, optionally gzip-compressed. Returns (response, number of bytes sent).
+    """
+    with stage('serialize',compress=compress) as record:
+        body = encode_json(obj)
+        headers = {'Content-Type': 'application/json'}
+        if compress:
+            body = gzip.compress(body,compresslevel=6)
+            headers['Content-Encoding'] = 'gzip'
+        record['bytes'] = len(body)
+
+    with stage('upload',method=method,path=path) as record:
+        response = gc.sendRestRequest(method,path,parameters=parameters,data=body,headers=headers,jsonResp=False)
+        record['bytes'] = len(body)
+
+    return response, len(body)
+
+def upload_annotation(gc, item_id:str, annotation:dict, batch_size:int = 0, compress:bool = False)->dict:
+    """
+    Upload one annotation ({"annotation": {"name":..., "elements": [...]}}) to an item.
+
+    If batch_size>0, the annotation is created with the first batch_size elements and the remaining elements are appended in
+    batches of batch_size (PATCH requests adding "elements/id:{id}"). If compress is True, request bodies are gzip-compressed
+    (the server, or a proxy in front of it, needs to accept Content-Encoding: gzip).
+
+    Returns upload statistics (name, elements, requests, bytes sent, seconds).
+    """
+    start = time.perf_counter()
+    ann_dict = annotation['annotation']
+    elements = ann_dict['elements']
+    if batch_size<=0:
+        batch_size = max(len(elements),1)
+
+    # Appended elements are addressed by id
+    for el in elements:
+        if not 'id' in el:
+            el['id'] = uuid.uuid4().hex[:24]
+
+    first_batch = dict(ann_dict,elements=elements[:batch_size])
+    response, bytes_sent = _send_json(gc,'POST','/annotation',first_batch,compress,parameters={'itemId': item_id})
+    annotation_id = response.json()['_id']
+    n_requests = 1
+
+    for batch_start in range(batch_size,len(elements),batch_size):
+        patch_list = [
+            {'op': 'add', 'path': f'elements/id:{el["id"]}', 'value': el}
+            for el in elements[batch_start:batch_start+batch_size]
+        ]
+        _, patch_bytes = _send_json(gc,'PATCH',f'/annotation/{annotation_id}',patch_list,compress)
+        bytes_sent += patch_bytes
+        n_requests += 1
+
+    return {
+        'name': ann_dict['name'],
+        'annotation_id': annotation_id,
+        'elements': len(elements),
+        'requests': n_requests,
+        'bytes': bytes_sent,
+        'seconds': time.perf_counter()-start
+    }
+
+def patch_annotation(gc, annotation_id:str, remove_ids:list, add_elements:list, attributes:dict = None, batch_size:int = 0, compress:bool = False)->dict:
+    """
+    Update an existing annotation in place: remove elements by id, add new elements and (optionally) replace its attributes,
+    in PATCH requests of up to batch_size changes each (all in one request if batch_size<=0).
+
+    Returns patch statistics (elements removed/added, requests, bytes sent, seconds).
+    """
+    start = time.perf_counter()
+    for el in add_elements:
+        if not 'id' in el:
+            el['id'] = uuid.uuid4().hex[:24]
+
+    patch_list = [{'op': 'remove', 'path': f'elements/id:{el_id}'} for el_id in remove_ids]
+    patch_list.extend([{'op': 'add', 'path': f'elements/id:{el["id"]}', 'value': el} for el in add_elements])
+    if attributes is not None:
+        patch_list.append({'op': 'replace', 'path': 'attributes', 'value': attributes})
+
+    if batch_size<=0:
+        batch_size = max(len(patch_list),1)
+
+    bytes_sent = 0
+    n_requests = 0
+    for batch_start in range(0,len(patch_list),batch_size):
+        _, patch_bytes = _send_json(gc,'PATCH',f'/annotation/{annotation_id}',patch_list[batch_start:batch_start+batch_size],compress)
+        bytes_sent += patch_bytes
+        n_requests += 1
+
+    return {
+        'annotation_id': annotation_id,
+        'removed': len(remove_ids),
+        'added': len(add_elements),
+        'requests': n_requests,
+        'bytes': bytes_sent,
+        'seconds': time.perf_counter()-start
+    }
+
+def upload_annotations(gc, item_id:str, annotation_list:list, batch_size:int = 0, compress:bool = False, max_workers:int = 1)->list:
+    """
+    Upload several annotations to an item concurrently (see upload_annotation). Returns upload statistics for each annotation.
+    """
+    def upload(annotation):
+        return upload_annotation(gc,item_id,annotation,batch_size,compress)
+
+    if max_workers<=1 or len(annotation_list)<=1:
+        return [upload(a) for a in annotation_list]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(upload,annotation_list))
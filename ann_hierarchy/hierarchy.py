@@ -0,0 +1,210 @@
+"""
+
+Containment hierarchy across an ordered list of annotation layers (e.g. tissue > cortex > glomeruli > nuclei)
+
+"""
+
+import uuid
+
+import numpy as np
+
+import shapely
+from shapely import STRtree
+
+from ann_hierarchy.geometry import elements_from_polygons
+from ann_hierarchy.tiled import polygon_parts
+
+OUTSIDE_ACTIONS = ['keep','drop','clip']
+# Element keys kept when an element is replaced by its clipped polygon
+STYLE_KEYS = ['group','label','lineColor','lineWidth','fillColor']
+
+
+def assign_parents(child_geoms:np.ndarray, child_element:np.ndarray, n_children:int, parent_geoms:np.ndarray, parent_element:np.ndarray)->tuple:
+    """
+    Find the parent of every child element: the parent element covering the largest fraction of its area (ties go to the
+    smaller parent). Geometries are grouped into elements by child_element and parent_element.
+
+    Every pair of intersecting (child, parent) geometries comes from one STRtree query over the parent layer. Intersection
+    areas are only computed for pairs where the parent doesn't contain the child.
+
+    Returns (parent element of each child (-1 if none), fraction of each child's area inside that parent,
+    (2,n) array of the (child geometry, parent geometry) index pairs of the chosen parents).
+    """
+    parent = np.full(n_children,-1,dtype=np.intp)
+    overlap = np.zeros(n_children)
+    if child_geoms.shape[0]==0 or parent_geoms.shape[0]==0:
+        return parent, overlap, np.empty((2,0),dtype=np.intp)
+
+    child_idx, parent_idx = STRtree(parent_geoms).query(child_geoms,predicate='intersects')
+    if child_idx.shape[0]==0:
+        return parent, overlap, np.empty((2,0),dtype=np.intp)
+
+    # Most children lie entirely inside their parent
+    shapely.prepare(parent_geoms)
+    child_area = shapely.area(child_geoms)
+    pair_area = child_area[child_idx]
+    partial = ~shapely.contains(parent_geoms[parent_idx],child_geoms[child_idx])
+    pair_area[partial] = shapely.area(shapely.intersection(child_geoms[child_idx[partial]],parent_geoms[parent_idx[partial]]))
+
+    # Summing areas over the geometries of each (child element, parent element)
+    n_parents = int(parent_element.max())+1
+    pair_key = child_element[child_idx].astype(np.int64)*n_parents+parent_element[parent_idx]
+    element_pairs, pair_inverse = np.unique(pair_key,return_inverse=True)
+    pair_child = element_pairs//n_parents
+    pair_parent = element_pairs%n_parents
+
+    element_area = np.bincount(pair_inverse,weights=pair_area,minlength=element_pairs.shape[0])
+    child_element_area = np.bincount(child_element,weights=child_area,minlength=n_children)
+    parent_element_area = np.bincount(parent_element,weights=shapely.area(parent_geoms),minlength=n_parents)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        fraction = np.nan_to_num(element_area/child_element_area[pair_child])
+
+    # Largest overlap first, then smallest parent
+    order = np.lexsort((parent_element_area[pair_parent],-fraction,pair_child))
+    first = np.ones(order.shape[0],dtype=bool)
+    first[1:] = pair_child[order][1:]!=pair_child[order][:-1]
+    best = order[first]
+    parent[pair_child[best]] = pair_parent[best]
+    overlap[pair_child[best]] = np.minimum(fraction[best],1.0)
+
+    chosen = np.zeros(element_pairs.shape[0],dtype=bool)
+    chosen[best] = True
+    chosen_pairs = chosen[pair_inverse]
+
+    return parent, overlap, np.stack([child_idx[chosen_pairs],parent_idx[chosen_pairs]])
+
+def containment_hierarchy(layers:list, min_overlap:float = 0.5, outside:str = 'keep')->list:
+    """
+    Assign every element of each layer to a parent element in the layer before it (see assign_parents).
+
+    layers is an ordered list (outermost first) of (geoms, element_index, number of elements). Elements with less than
+    min_overlap of their area inside any element of the layer before have no parent. outside sets what happens to elements
+    that aren't inside a parent:
+        - "keep": every element is kept (elements without a parent have depth 0)
+        - "drop": elements without a parent are removed (so they aren't parents of the next layer either)
+        - "clip": as "drop", and elements partially outside their parent are clipped to it (one element per part)
+
+    Returns for each layer {
+        "element": source element of each kept element,
+        "geoms": clipped Polygon of each kept element (None if not clipped),
+        "parent": index (in the layer before) of the parent of each kept element (-1 if none),
+        "overlap": fraction of each kept element's area inside its parent (before clipping),
+        "depth": number of ancestors of each kept element
+    }
+    """
+    if not outside in OUTSIDE_ACTIONS:
+        raise ValueError(f'Outside action: {outside} not implemented! Choose from: {OUTSIDE_ACTIONS}')
+
+    hierarchy = []
+    parent_geoms = parent_element = parent_depth = None
+    for layer, (geoms, element_index, n_elements) in enumerate(layers):
+        geoms = np.asarray(geoms,dtype=object)
+        element_index = np.asarray(element_index,dtype=np.intp)
+
+        if layer==0:
+            parent = np.full(n_elements,-1,dtype=np.intp)
+            overlap = np.zeros(n_elements)
+            pairs = np.empty((2,0),dtype=np.intp)
+            keep = np.ones(n_elements,dtype=bool)
+        else:
+            parent, overlap, pairs = assign_parents(geoms,element_index,n_elements,parent_geoms,parent_element)
+            parent[overlap<min_overlap] = -1
+            keep = parent>=0 if outside in ['drop','clip'] else np.ones(n_elements,dtype=bool)
+
+        clip = np.zeros(n_elements,dtype=bool)
+        if outside=='clip' and layer>0:
+            clip = keep & (overlap<1.0)
+
+        # Clipping each geometry of a partially outside element to the parent geometries it intersects
+        clip_pairs = pairs[:,clip[element_index[pairs[0]]]]
+        clipped, clipped_pair = polygon_parts(
+            shapely.intersection(geoms[clip_pairs[0]],parent_geoms[clip_pairs[1]]) if clip_pairs.shape[1]>0 else np.empty(0,dtype=object),
+            return_index=True
+        )
+        clipped_element = element_index[clip_pairs[0][clipped_pair]]
+
+        # Kept elements (in source order, clipped elements once per part)
+        whole = np.flatnonzero(keep & ~clip)
+        out_element = np.concatenate([whole,clipped_element])
+        out_geoms = np.concatenate([np.full(whole.shape[0],None,dtype=object),clipped])
+        order = np.argsort(out_element,kind='stable')
+        out_element, out_geoms = out_element[order], out_geoms[order]
+
+        out_parent = parent[out_element]
+        out_depth = np.zeros(out_element.shape[0],dtype=np.intp)
+        if layer>0:
+            has_parent = out_parent>=0
+            out_depth[has_parent] = parent_depth[out_parent[has_parent]]+1
+
+        hierarchy.append({
+            'element': out_element,
+            'geoms': out_geoms,
+            'parent': out_parent,
+            'overlap': overlap[out_element],
+            'depth': out_depth
+        })
+
+        # Kept elements are the parents of the next layer (as their original geometries or clipped parts)
+        out_position = np.argsort(order)
+        whole_out = np.full(n_elements,-1,dtype=np.intp)
+        whole_out[whole] = out_position[:whole.shape[0]]
+        whole_geoms = whole_out[element_index]>=0
+        parent_geoms = np.concatenate([geoms[whole_geoms],clipped])
+        parent_element = np.concatenate([whole_out[element_index[whole_geoms]],out_position[whole.shape[0]:]])
+        parent_depth = out_depth
+
+    return hierarchy
+
+def hierarchy_elements(layer_annotations:list, layer_polygons:list, min_overlap:float = 0.5, outside:str = 'keep')->list:
+    """
+    Create the elements of a hierarchy annotation from an ordered list of annotations (outermost first) and their
+    (polygons, element_index), see containment_hierarchy.
+
+    Every kept element is copied (with a new id) and its "user" properties get a "hierarchy" entry with the "layer"
+    (annotation name), "depth", "parent" (id of the parent element, if any), "overlap" (fraction of its area inside the
+    parent) and "clipped" (if it was clipped to its parent).
+    """
+    layers = [
+        (geoms,element_index,len(annotation['annotation']['elements']))
+        for annotation, (geoms, element_index) in zip(layer_annotations,layer_polygons)
+    ]
+    hierarchy = containment_hierarchy(layers,min_overlap=min_overlap,outside=outside)
+
+    elements = []
+    parent_ids = None
+    for layer, (annotation, h) in enumerate(zip(layer_annotations,hierarchy)):
+        source_elements = annotation['annotation']['elements']
+        layer_name = annotation['annotation'].get('name','')
+
+        # Points of clipped elements
+        clipped_idx = np.flatnonzero(shapely.is_geometry(h['geoms']))
+        clipped_elements = {}
+        if clipped_idx.shape[0]>0:
+            converted, converted_idx = elements_from_polygons(h['geoms'][clipped_idx],as_arrays=True,return_index=True)
+            clipped_elements = dict(zip(clipped_idx[converted_idx].tolist(),converted))
+
+        layer_ids = []
+        for i, (el_idx, parent, overlap, depth) in enumerate(zip(h['element'].tolist(),h['parent'].tolist(),h['overlap'].tolist(),h['depth'].tolist())):
+            user = dict(source_elements[el_idx].get('user') or {})
+            user['hierarchy'] = {'layer': layer_name,'depth': depth}
+            if layer>0:
+                user['hierarchy']['overlap'] = overlap
+                if parent>=0:
+                    user['hierarchy']['parent'] = parent_ids[parent]
+
+            if i in clipped_elements:
+                user['hierarchy']['clipped'] = True
+                new_element = dict(
+                    clipped_elements[i],
+                    **{k: source_elements[el_idx][k] for k in STYLE_KEYS if k in source_elements[el_idx]},
+                    user = user
+                )
+            else:
+                new_element = dict(source_elements[el_idx],id=uuid.uuid4().hex[:24],user=user)
+
+            elements.append(new_element)
+            layer_ids.append(new_element['id'])
+
+        parent_ids = layer_ids
+
+    return elements
@@ -0,0 +1,338 @@
+"""
+
+Provenance of derived (plus/minus) annotations and incremental recomputation of the tiles whose sources changed
+
+"""
+
+import json
+import hashlib
+
+import numpy as np
+
+import shapely
+from shapely import STRtree
+
+from ann_hierarchy.lod import simplified_elements
+from ann_hierarchy.tiled import BOOLEAN_OPERATIONS, boolean_tile_jobs, run_tile_jobs, stitch_tiles
+from ann_hierarchy.instrument import stage, is_active
+
+# Key of the provenance record in a derived annotation's "attributes"
+PROVENANCE_KEY = 'provenance'
+# Key of the tiles each element was built from in the element's "user" (kept on the elements, so the annotation document
+# stays small however many elements it has)
+ELEMENT_TILES_KEY = 'provenance_tiles'
+
+
+def provenance_signature(operation:str, ann_ids_1:list, ann_ids_2:list, tile_size:float, tolerance:float)->str:
+    """
+    Canonical representation of a tiled operation, derived annotations are only updated by the same operation.
+    """
+    return json.dumps({
+        'operation': operation,
+        'ann_id_1': list(ann_ids_1),
+        'ann_id_2': list(ann_ids_2),
+        'tile_size': tile_size,
+        'tile_tolerance': tolerance
+    },sort_keys=True)
+
+def tile_hash(tile_job:tuple)->str:
+    """
+    Content hash of one tile job from boolean_tile_jobs (the WKB of the polygons it combines, in any order).
+    """
+    digest = hashlib.sha1()
+    for geoms in tile_job[:2]:
+        for wkb in sorted(shapely.to_wkb(geoms).tolist()):
+            digest.update(wkb)
+        digest.update(b'|')
+
+    return digest.hexdigest()
+
+def touched_elements(previous:dict, polygons:np.ndarray, polygon_tiles:list, distance:float, kept_tree:STRtree = None)->np.ndarray:
+    """
+    Element indices of the previous result's polygons within distance of polygons (see incremental_boolean).
+
+    If the previous result is a stored GeometryLayer ("layer"), only its polygons around the polygons of each recomputed
+    tile (grouped by the first tile each one was built from) are built, otherwise kept_tree indexes its "geoms".
+    """
+    if not 'layer' in previous:
+        if kept_tree is None:
+            return np.empty(0,dtype=np.int64)
+        return np.unique(previous['element_index'][kept_tree.query(polygons,predicate='dwithin',distance=distance)[1]])
+
+    groups = {}
+    for i, tiles in enumerate(polygon_tiles):
+        groups.setdefault(min(tiles),[]).append(i)
+
+    margin = np.array([-distance,-distance,distance,distance])
+    touched = [np.empty(0,dtype=np.int64)]
+    for group in groups.values():
+        group_polygons = polygons[group]
+        near_geoms, near_index = previous['layer'].polygons_in_bbox(shapely.total_bounds(group_polygons)+margin)
+        if near_geoms.shape[0]>0:
+            touched.append(near_index[STRtree(near_geoms).query(group_polygons,predicate='dwithin',distance=distance)[1]])
+
+    return np.unique(np.concatenate(touched))
+
+def kept_polygons(previous:dict, kept:np.ndarray)->tuple:
+    """
+    Polygons of the previous result's kept elements (kept: their element indices, sorted), with the position of each
+    one's element in kept. From a stored layer, only these polygons are built.
+    """
+    if 'layer' in previous:
+        layer = previous['layer']
+        geoms, element_index = layer.polygons(np.flatnonzero(np.isin(layer.element_index,kept)))
+    else:
+        keep = np.isin(previous['element_index'],kept)
+        geoms, element_index = previous['geoms'][keep], previous['element_index'][keep]
+
+    return geoms, np.searchsorted(kept,element_index)
+
+def incremental_boolean(geoms_1, geoms_2, operation:str, tile_size:float, n_workers:int = 1, tolerance:float = 0.0, previous:dict = None, touch_distance:float = 0.0)->dict:
+    """
+    Tiled union/difference (see tiled_boolean) that only recomputes the tiles whose polygons changed since a previous result.
+
+    previous holds the provenance of the previous result ("extent", "tile_hashes" and "element_tiles": the tiles each of
+    its elements was built from) along with "element_ids", the id of each of its elements, and its polygons: either
+    "geoms" with the "element_index" of each, or "layer", a stored GeometryLayer that is only built around recomputed tiles.
+    Tiles whose hash changed are recomputed together with every tile sharing an element with them. The set grows until none
+    of the recomputed polygons comes within touch_distance of a kept element (which would have been merged with it).
+
+    Returns {
+        "polygons": recomputed polygons, "polygon_tiles": the tiles each one was built from,
+        "removed": ids of previous elements they replace, "extent", "tile_hashes", "tiles", "recomputed": number of tiles
+    }
+    """
+    if not operation in BOOLEAN_OPERATIONS:
+        raise ValueError(f'Boolean operation: {operation} not implemented! Choose from: {BOOLEAN_OPERATIONS}')
+
+    geoms_1 = np.asarray(geoms_1,dtype=object)
+    geoms_2 = np.asarray(geoms_2,dtype=object)
+    all_geoms = np.concatenate([geoms_1,geoms_2])
+
+    # The previous grid is kept so unchanged tiles hash the same
+    if previous is not None:
+        extent = tuple(previous['extent'])
+    elif all_geoms.shape[0]>0:
+        extent = tuple(float(b) for b in shapely.total_bounds(all_geoms))
+    else:
+        extent = (0.0,0.0,0.0,0.0)
+
+    if geoms_1.shape[0]==0 and (operation=='difference' or geoms_2.shape[0]==0):
+        active_tiles, tile_jobs = np.empty(0,dtype=np.intp), []
+    else:
+        active_tiles, tile_jobs = boolean_tile_jobs(geoms_1,geoms_2,operation,extent,tile_size,tolerance)
+    jobs = dict(zip(active_tiles.tolist(),tile_jobs))
+    tile_hashes = {str(t): tile_hash(job) for t, job in jobs.items()}
+
+    if previous is None:
+        recompute = set(jobs)
+        element_tiles = {}
+    else:
+        old_hashes = previous['tile_hashes']
+        recompute = {int(t) for t in set(old_hashes)|set(tile_hashes) if old_hashes.get(t)!=tile_hashes.get(t)}
+        element_tiles = previous['element_tiles']
+
+    tile_elements = {}
+    for el_id, tiles in element_tiles.items():
+        for t in tiles:
+            tile_elements.setdefault(t,[]).append(el_id)
+
+    kept_tree = None
+    if previous is not None and 'geoms' in previous and previous['geoms'].shape[0]>0:
+        kept_tree = STRtree(previous['geoms'])
+
+    tile_results = {}
+    removed = set()
+    while True:
+        # Every element built from a recomputed tile is replaced, so the other tiles it was built from are recomputed too
+        queue = list(recompute)
+        while len(queue)>0:
+            for el_id in tile_elements.get(queue.pop(),[]):
+                if el_id in removed:
+                    continue
+                removed.add(el_id)
+                for t in element_tiles[el_id]:
+                    if not t in recompute:
+                        recompute.add(t)
+                        queue.append(t)
+
+        new_tiles = [t for t in sorted(recompute) if t in jobs and not t in tile_results]
+        for t, result in zip(new_tiles,run_tile_jobs([jobs[t] for t in new_tiles],n_workers)):
+            tile_results[t] = result
+
+        computed = sorted(t for t in recompute if t in tile_results)
+        if len(computed)>0:
+            pieces = np.concatenate([tile_results[t] for t in computed])
+            piece_tiles = np.repeat(np.array(computed,dtype=np.intp),[tile_results[t].shape[0] for t in computed])
+        else:
+            pieces, piece_tiles = np.empty(0,dtype=object), np.empty(0,dtype=np.intp)
+        polygons, polygon_tiles = stitch_tiles(pieces,piece_tiles,extent,tile_size,tolerance,return_tiles=True)
+
+        if previous is None or polygons.shape[0]==0:
+            break
+
+        # Recomputed polygons reaching a kept element are merged with it on the next pass
+        touched = touched_elements(previous,polygons,polygon_tiles,touch_distance,kept_tree)
+        touched_tiles = {
+            t
+            for el_id in previous['element_ids'][touched].tolist() if not el_id in removed
+            for t in element_tiles.get(el_id,[])
+        }-recompute
+        if len(touched_tiles)==0:
+            break
+        recompute |= touched_tiles
+
+    return {
+        'polygons': polygons,
+        'polygon_tiles': polygon_tiles,
+        'removed': sorted(removed),
+        'extent': extent,
+        'tile_hashes': tile_hashes,
+        'tiles': len(jobs),
+        'recomputed': len(recompute)
+    }
+
+def find_derived_annotation(annotation_cache, name:str, signature:str)->dict:
+    """
+    Get an existing annotation (of the cache's item) with this name created by the same operation, or None.
+    Only the matching annotation is downloaded, others are checked from the listed attributes.
+    """
+    for ann_id in annotation_cache.find_annotations(name):
+        provenance = (annotation_cache.get_attributes(ann_id) or {}).get(PROVENANCE_KEY)
+        if provenance is not None and provenance.get('signature')==signature:
+            return annotation_cache.get_annotation(ann_id)
+
+    return None
+
+def previous_element_tiles(elements:list, provenance:dict)->dict:
+    """
+    Get {element id: tiles it was built from} from the elements of a derived annotation, or None if they were edited since
+    (elements added without tiles, or removed).
+    """
+    if not len(elements)==provenance.get('elements'):
+        return None
+
+    element_tiles = {}
+    for el in elements:
+        tiles = (el.get('user') or {}).get(ELEMENT_TILES_KEY)
+        if not 'id' in el or tiles is None:
+            return None
+        element_tiles[el['id']] = tiles
+
+    return element_tiles
+
+def derive_annotation(sources, ann_id_1:str, ann_id_2_list:list, operation:str, name:str, tile_size:float, n_workers:int = 1, tolerance:float = 0.0, incremental:bool = False, fetch_workers:int = 4, simplify_tolerance:float = 0.05, report_simplification:bool = False, return_polygons:bool = False)->dict:
+    """
+    Apply a tiled plus/minus operation to annotations (by id) and create the new annotation, recording its provenance (the
+    source annotations' "updated" timestamps and the hash of every tile) in its "attributes" and the tiles each element was
+    built from in the element's "user".
+
+    If incremental is True and the item already has an annotation with this name created by the same operation, that
+    annotation is updated instead: it is kept as-is if no source was updated, otherwise only the tiles whose source polygons
+    changed are recomputed. The returned annotation then has the existing "_id" and a "patch" with the ids of the elements
+    to "remove" and the elements to "add". If the previous version is in the geometry store, only its polygons around the
+    recomputed tiles are built.
+
+    If return_polygons is True, the unsimplified polygons of its elements are kept as "polygons" (not uploaded).
+    """
+    annotation_cache = sources.annotation_cache
+    tiled_operation = 'union' if operation.lower() in ["+","plus"] else 'difference'
+    signature = provenance_signature(tiled_operation,[ann_id_1],ann_id_2_list,tile_size,tolerance)
+    source_stamps = {a: annotation_cache.get_updated(a) for a in [ann_id_1]+ann_id_2_list}
+
+    previous = find_derived_annotation(annotation_cache,name,signature) if incremental else None
+    previous_state = None
+    if previous is not None:
+        provenance = previous['annotation']['attributes'][PROVENANCE_KEY]
+        if provenance['sources']==source_stamps:
+            print(f'{name} is up to date with its sources')
+            return dict(previous,patch={'remove': [],'add': []})
+
+        previous_elements = previous['annotation']['elements']
+        element_tiles = previous_element_tiles(previous_elements,provenance)
+        if element_tiles is not None:
+            previous_state = dict(
+                provenance,
+                element_tiles = element_tiles,
+                element_ids = np.array([el['id'] for el in previous_elements],dtype=object)
+            )
+            previous_layer = annotation_cache.get_layer(previous['_id'])
+            if previous_layer is not None:
+                previous_state['layer'] = previous_layer
+            else:
+                previous_state['geoms'], previous_state['element_index'] = annotation_cache.get_polygons(previous['_id'])
+        else:
+            print(f'Elements of {name} were edited, recomputing every tile')
+
+    # Fetching and parsing all of the (comma separated) second annotations concurrently
+    poly_array_1 = sources.get_polygons(ann_id_1)[0]
+    poly_arrays_2 = [p for p, _ in sources.get_polygons_many(ann_id_2_list,fetch_workers)]
+    poly_array_2 = np.concatenate(poly_arrays_2) if len(poly_arrays_2)>0 else np.empty(0,dtype=object)
+
+    with stage('boolean',operation=operation,new_name=name,incremental=previous_state is not None) as record:
+        result = incremental_boolean(
+            poly_array_1,
+            poly_array_2,
+            tiled_operation,
+            tile_size,
+            n_workers = n_workers,
+            tolerance = tolerance,
+            previous = previous_state,
+            touch_distance = 2*simplify_tolerance
+        )
+        record['elements'] = len(result['polygons'])
+
+    with stage('simplify',new_name=name) as record:
+        new_elements, polygon_index = simplified_elements(result['polygons'],simplify_tolerance,name=name if report_simplification else None)
+        record['elements'] = len(new_elements)
+        if is_active():
+            record['vertices'] = sum(len(el['points']) for el in new_elements)
+    for el, i in zip(new_elements,polygon_index.tolist()):
+        el.setdefault('user',{})[ELEMENT_TILES_KEY] = [int(t) for t in result['polygon_tiles'][i]]
+
+    if previous is None:
+        kept_elements = []
+        removed = []
+    elif previous_state is None:
+        kept_elements = []
+        removed = [el['id'] for el in previous['annotation']['elements'] if 'id' in el]
+    else:
+        removed_ids = set(result['removed'])
+        kept_elements = [el for el in previous['annotation']['elements'] if not el['id'] in removed_ids]
+        removed = result['removed']
+
+    attributes = dict((previous['annotation'].get('attributes') or {}) if previous is not None else {})
+    attributes[PROVENANCE_KEY] = {
+        'signature': signature,
+        'sources': source_stamps,
+        'tile_size': tile_size,
+        'extent': list(result['extent']),
+        'tile_hashes': result['tile_hashes'],
+        'elements': len(kept_elements)+len(new_elements)
+    }
+
+    new_annotation = {
+        "annotation": {
+            "name": name,
+            "elements": kept_elements+new_elements,
+            "attributes": attributes
+        }
+    }
+    if return_polygons:
+        # Unsimplified polygons of the new elements (and the previous polygons of kept ones), e.g. to build level of detail variants
+        new_polygons = np.asarray(result['polygons'],dtype=object).reshape(-1)[polygon_index]
+        if len(kept_elements)>0:
+            kept = np.flatnonzero(~np.isin(previous_state['element_ids'],result['removed']))
+            kept_geoms, kept_index = kept_polygons(previous_state,kept)
+            new_annotation['polygons'] = (
+                np.concatenate([kept_geoms,new_polygons]),
+                np.concatenate([kept_index,len(kept_elements)+np.arange(len(new_elements))]).astype(np.int64)
+            )
+        else:
+            new_annotation['polygons'] = (new_polygons,np.arange(len(new_elements)))
+    if previous is not None:
+        print(f'Updating {name}: recomputed {result["recomputed"]}/{result["tiles"]} tiles, replacing {len(removed)} elements with {len(new_elements)}')
+        new_annotation['_id'] = previous['_id']
+        new_annotation['patch'] = {'remove': removed,'add': new_elements}
+
+    return new_annotation
@@ -0,0 +1,199 @@
+"""
+
+Structured per-stage instrumentation (wall/CPU time, memory, element/vertex counts and bytes) and optional profiling
+
+"""
+
+import sys
+import json
+import time
+import cProfile
+import resource
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+import shapely
+
+# Arguments never printed or reported
+SECRET_ARGS = ['girderToken']
+# Counts summed over the records of each stage in the report
+STAGE_COUNTS = ['elements','vertices','bytes']
+
+_active = None
+
+
+def peak_rss_mb()->float:
+    """
+    Peak resident memory of this process so far (MB).
+
+    On Linux this is VmHWM from /proc/self/status: ru_maxrss is kept across exec, so a process started by a larger one
+    would report its parent's peak.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    return max_rss/(1024**2) if sys.platform=='darwin' else max_rss/1024
+
+def reset_peak_rss():
+    """
+    Reset the peak resident memory of this process to its current resident memory (Linux only, no-op elsewhere).
+    """
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _children_cpu()->float:
+    """
+    CPU time of finished child processes (e.g. process pool workers).
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime+usage.ru_stime
+
+def count_vertices(geoms)->int:
+    """
+    Total number of coordinates in an array of geometries.
+    """
+    geoms = np.asarray(geoms,dtype=object)
+    if geoms.shape[0]==0:
+        return 0
+
+    return int(np.sum(shapely.get_num_coordinates(geoms)))
+
+def print_arguments(args):
+    """
+    Print the inputs from the CLI (without secrets such as the Girder token).
+    """
+    for a in vars(args):
+        if a in SECRET_ARGS:
+            print(f'{a}: ***')
+        else:
+            print(f'{a}: {getattr(args,a)}')
+
+def is_active()->bool:
+    """
+    Whether stages are being recorded (to skip computing counts that are only reported).
+    """
+    return _active is not None
+
+
+class Instrumentation:
+    """
+    Records of every stage of a run. Stages can run concurrently (and can be nested, e.g. "validate" within "parse").
+    Decoding fetched content (JSON or images) is recorded as "decode", building geometries from it as "parse".
+
+    Each record has the stage name, any labels/counts added by the stage (elements, vertices, bytes, ...), wall and CPU
+    time (CPU of the calling thread, plus child_cpu_seconds for process pool workers that finished during the stage) and
+    memory: "peak_rss_increase_mb", how much the peak RSS of the process rose during the stage (attributed to every stage
+    running at the time if stages overlap), and "process_peak_rss_mb", the peak RSS of the whole process so far.
+    """
+    def __init__(self):
+
+        self.records = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def add(self, record:dict):
+        with self.lock:
+            self.records.append(record)
+
+    def summary(self)->dict:
+        """
+        Totals per stage name (in the order stages first finished).
+        """
+        stages = {}
+        for record in self.records:
+            s = stages.setdefault(record['stage'],{'count': 0,'wall_seconds': 0.0,'cpu_seconds': 0.0,'child_cpu_seconds': 0.0,'peak_rss_increase_mb': 0.0})
+            s['count'] += 1
+            s['wall_seconds'] += record['wall_seconds']
+            s['cpu_seconds'] += record['cpu_seconds']
+            s['child_cpu_seconds'] += record['child_cpu_seconds']
+            # Largest rise of a single record, rises of concurrent records overlap so they aren't summed
+            s['peak_rss_increase_mb'] = max(s['peak_rss_increase_mb'],record['peak_rss_increase_mb'])
+            for key in STAGE_COUNTS:
+                if isinstance(record.get(key),(int,float)):
+                    s[key] = s.get(key,0)+record[key]
+
+        return stages
+
+    def report(self, metadata:dict = None)->dict:
+        return {
+            'metadata': metadata or {},
+            'wall_seconds': time.perf_counter()-self.start,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': self.summary(),
+            'records': list(self.records)
+        }
+
+
+@contextmanager
+def stage(name:str, **labels):
+    """
+    Record one stage of a run (does nothing unless instrumentation is active).
+
+    Yields the stage record so that counts only known at the end (e.g. "elements", "vertices", "bytes") can be added to it.
+    """
+    if _active is None:
+        yield {}
+        return
+
+    instrumentation = _active
+    record = {'stage': name,**labels}
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    children_start = _children_cpu()
+    peak_start = peak_rss_mb()
+    try:
+        yield record
+    finally:
+        record['start_seconds'] = wall_start-instrumentation.start
+        record['wall_seconds'] = time.perf_counter()-wall_start
+        record['cpu_seconds'] = time.thread_time()-cpu_start
+        record['child_cpu_seconds'] = _children_cpu()-children_start
+        record['process_peak_rss_mb'] = peak_rss_mb()
+        record['peak_rss_increase_mb'] = record['process_peak_rss_mb']-peak_start
+        instrumentation.add(record)
+
+@contextmanager
+def instrumented(output:str = '', profile_output:str = '', args = None):
+    """
+    Activate instrumentation for a run (if output is provided) and profiling (if profile_output is provided).
+
+    At the end the report is written as JSON to output ("-" prints it on one line prefixed with "Instrumentation: ") and
+    cProfile statistics are dumped to profile_output (readable with pstats or snakeviz). The profile only covers the
+    calling thread, stages running in worker threads or processes are covered by the report.
+    Non-secret args are included in the report metadata.
+    """
+    global _active
+    _active = Instrumentation() if output else None
+    profiler = None
+    if profile_output:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        yield _active
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_output)
+
+        if _active is not None:
+            metadata = {a: getattr(args,a) for a in vars(args) if not a in SECRET_ARGS} if args is not None else {}
+            report = _active.report(metadata)
+            _active = None
+            if output=='-':
+                print(f'Instrumentation: {json.dumps(report)}')
+            else:
+                with open(output,'w') as f:
+                    json.dump(report,f,indent=4)
@@ -0,0 +1,171 @@
+"""
+
+Reading and writing annotations as local files (large-image annotation JSON or GeoJSON)
+
+"""
+
+import os
+import json
+import hashlib
+
+from ann_hierarchy.cache import AnnotationCache
+from ann_hierarchy.girder_io import encode_json
+
+ANNOTATION_EXTENSIONS = ['.json','.geojson']
+# Image metadata of a slide directory (as returned by /item/{id}/tiles)
+IMAGE_METADATA_NAME = 'tiles.json'
+
+
+def _points_3d(ring:list)->list:
+    """
+    Convert GeoJSON [x,y] positions to large-image [x,y,z] points (dropping the repeated closing position).
+    """
+    points = [[float(p[0]),float(p[1]),float(p[2]) if len(p)>2 else 0.0] for p in ring]
+    if len(points)>1 and points[0]==points[-1]:
+        points = points[:-1]
+
+    return points
+
+def elements_from_geojson(geojson:dict)->list:
+    """
+    Convert the Polygon/MultiPolygon features of a GeoJSON FeatureCollection (or single Feature) to large-image polyline elements.
+    Feature properties are kept in "user" (or the "user" property itself if it is a dict, as in large-image GeoJSON exports).
+    """
+    features = geojson['features'] if geojson.get('type')=='FeatureCollection' else [geojson]
+
+    elements = []
+    for feature in features:
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type')=='Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry.get('type')=='MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            continue
+
+        properties = feature.get('properties') or {}
+        user = properties['user'] if isinstance(properties.get('user'),dict) else properties
+        for rings in polygons:
+            if len(rings)==0:
+                continue
+            el = {
+                'type': 'polyline',
+                'points': _points_3d(rings[0]),
+                'closed': True
+            }
+            if len(rings)>1:
+                el['holes'] = [_points_3d(r) for r in rings[1:]]
+            if len(user)>0:
+                el['user'] = user
+            elements.append(el)
+
+    return elements
+
+def read_annotation_file(path:str)->list:
+    """
+    Read every annotation in a local file as a list of {"annotation": {"name":..., "elements": [...]}}.
+
+    Accepts large-image annotation JSON (a single annotation, with or without the "annotation" wrapper, or a list of them)
+    and GeoJSON (named after the file).
+    """
+    with open(path,'rb') as f:
+        content = json.loads(f.read())
+
+    if isinstance(content,dict) and content.get('type') in ['FeatureCollection','Feature']:
+        name = os.path.splitext(os.path.basename(path))[0]
+        return [{'annotation': {'name': name,'elements': elements_from_geojson(content)}}]
+
+    if not isinstance(content,list):
+        content = [content]
+
+    annotations = []
+    for ann in content:
+        ann = ann['annotation'] if 'annotation' in ann else ann
+        annotations.append({'annotation': {'name': ann.get('name',''),'elements': ann.get('elements',[])}})
+
+    return annotations
+
+def write_annotation_file(path:str, annotation:dict):
+    """
+    Write one annotation as large-image annotation JSON ({"name":..., "elements": [...]}, as accepted for upload).
+    """
+    ann_dict = annotation['annotation'] if 'annotation' in annotation else annotation
+    os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+    with open(path,'wb') as f:
+        f.write(encode_json(ann_dict))
+
+def annotation_file_name(name:str)->str:
+    """
+    File name used to write an annotation (unsafe characters in its name are replaced).
+    """
+    return ''.join(c if c.isalnum() or c in '-_. ' else '_' for c in name).strip()+'.json'
+
+
+class LocalAnnotationCache(AnnotationCache):
+    """
+    AnnotationCache over the annotation files in a local directory.
+
+    Annotations are referenced by file name without extension (the first annotation in that file) or by annotation name
+    in place of Girder annotation ids. File modification times take the place of "updated" timestamps, qualified by the
+    file's absolute path: slides in a batch share cache_dir, and their files can have the same names and modification
+    times (e.g. copies made with cp -p or rsync -a).
+    """
+    def __init__(self, annotation_dir:str, memory_budget_mb:float = 1024, cache_dir:str = None):
+
+        super().__init__(None,None,memory_budget_mb=memory_budget_mb,cache_dir=cache_dir)
+        self.annotation_dir = annotation_dir
+
+        self.paths = {}
+        for file_name in sorted(os.listdir(annotation_dir)):
+            stem, extension = os.path.splitext(file_name)
+            if file_name==IMAGE_METADATA_NAME:
+                continue
+            if extension.lower() in ANNOTATION_EXTENSIONS and os.path.isfile(os.path.join(annotation_dir,file_name)):
+                self.paths[stem] = os.path.join(annotation_dir,file_name)
+
+        # Annotation name: (file path, position in file), only built if a reference isn't a file name
+        self.names = None
+
+    def _locate(self, annotation_id:str)->tuple:
+        """
+        Get (file path, position in file) of a referenced annotation.
+        """
+        if annotation_id in self.paths:
+            return self.paths[annotation_id], 0
+
+        with self.lock:
+            if self.names is None:
+                self.names = {}
+                for path in self.paths.values():
+                    try:
+                        file_annotations = read_annotation_file(path)
+                    except (ValueError,KeyError,TypeError,AttributeError):
+                        # Other JSON files (not annotations)
+                        continue
+                    for i, ann in enumerate(file_annotations):
+                        self.names.setdefault(ann['annotation']['name'],(path,i))
+
+        if not annotation_id in self.names:
+            raise KeyError(f'Annotation: {annotation_id} not found in {self.annotation_dir}')
+
+        return self.names[annotation_id]
+
+    def get_updated(self, annotation_id:str):
+        path = os.path.abspath(self._locate(annotation_id)[0])
+
+        return f'{os.path.getmtime(path)}_{hashlib.sha1(path.encode("utf-8")).hexdigest()[:16]}'
+
+    def get_image_metadata(self)->dict:
+        # Only if the directory has the image metadata file
+        with self.lock:
+            metadata_path = os.path.join(self.annotation_dir,IMAGE_METADATA_NAME)
+            if self.image_metadata is None and os.path.exists(metadata_path):
+                with open(metadata_path) as f:
+                    self.image_metadata = json.load(f)
+
+        return self.image_metadata
+
+    def _load_content(self, annotation_id:str)->bytes:
+        path, position = self._locate(annotation_id)
+
+        return encode_json(read_annotation_file(path)[position])
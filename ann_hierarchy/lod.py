@@ -0,0 +1,141 @@
+"""
+
+Level of detail: simplification tolerances adapted to the image resolution and coarser variants of new annotations
+
+"""
+
+import numpy as np
+
+import shapely
+
+from ann_hierarchy.geometry import polygons_from_annotation, elements_from_polygons, simplify_polygons
+
+LOD_MODES = ['fixed','adaptive','variants']
+# Variants added next to each new annotation in "variants" mode (the annotation itself is the full detail level)
+VARIANT_LEVELS = ['medium','coarse']
+# Tolerance used before level of detail was adaptive (base pixels)
+FIXED_TOLERANCE = 0.05
+# Screen size (pixels) of a view fitting the whole slide, coarse variants are meant for it
+OVERVIEW_PIXELS = 2048
+# Resolution (mm per screen pixel) medium variants are meant for, about a 10x objective
+MEDIUM_MM_PER_PIXEL = 0.001
+# Number of polygons the area deviation of a simplification is measured on (estimated from a sample of larger layers)
+REPORT_SAMPLE = 2000
+# Element keys replaced when an element is simplified (everything else, e.g. "user" or colors, is copied)
+GEOMETRY_KEYS = ['type','points','holes','closed','id']
+
+
+def lod_tolerances(image_metadata:dict)->dict:
+    """
+    Simplification tolerance (in base image pixels) of each level of detail, at most half a screen pixel at the scale
+    the level is viewed at:
+        - "full": half a base pixel (no visible change at full resolution)
+        - "medium": half a pixel at MEDIUM_MM_PER_PIXEL (from mm_x, or halfway between full and coarse without it)
+        - "coarse": half a pixel of a view fitting the whole image (sizeX by sizeY) in OVERVIEW_PIXELS
+    """
+    if image_metadata is None or not 'sizeX' in image_metadata or not 'sizeY' in image_metadata:
+        raise ValueError('Adaptive level of detail needs the image metadata (sizeX, sizeY and optionally mm_x)')
+
+    full = 0.5
+    coarse = max(full,0.5*max(image_metadata['sizeX'],image_metadata['sizeY'])/OVERVIEW_PIXELS)
+    if image_metadata.get('mm_x'):
+        medium = 0.5*MEDIUM_MM_PER_PIXEL/image_metadata['mm_x']
+    else:
+        medium = np.sqrt(full*coarse)
+
+    return {'full': full,'medium': float(min(max(medium,full),coarse)),'coarse': coarse}
+
+def simplification_report(geoms, simplified, max_sample:int = REPORT_SAMPLE)->dict:
+    """
+    Compare polygons with their simplified versions (same order, empty or invalid ones are dropped when converted).
+
+    Returns the number of "elements" (kept/dropped), "vertices" before and after, the "vertex_reduction" factor and the
+    "area_deviation": area of the symmetric difference of each polygon with its simplified version (the whole area of
+    dropped polygons) relative to their area. Overlays are slow, so with more than max_sample polygons it is estimated
+    from a random sample of them.
+    """
+    geoms = np.asarray(geoms,dtype=object)
+    simplified = np.asarray(simplified,dtype=object)
+    kept = ~shapely.is_empty(simplified) & shapely.is_valid(simplified)
+
+    vertices = int(np.sum(shapely.get_num_coordinates(geoms)))
+    simplified_vertices = int(np.sum(shapely.get_num_coordinates(simplified[kept])))
+
+    sample = np.arange(geoms.shape[0])
+    if sample.shape[0]>max_sample:
+        sample = np.sort(np.random.default_rng(0).choice(sample,max_sample,replace=False))
+    sample_kept = sample[kept[sample]]
+    area = float(np.sum(shapely.area(geoms[sample])))
+    changed_area = np.sum(shapely.area(shapely.symmetric_difference(geoms[sample_kept],simplified[sample_kept])))
+    changed_area += np.sum(shapely.area(geoms[sample[~kept[sample]]]))
+
+    return {
+        'elements': int(kept.sum()),
+        'dropped': int((~kept).sum()),
+        'vertices': vertices,
+        'simplified_vertices': simplified_vertices,
+        'vertex_reduction': vertices/simplified_vertices if simplified_vertices>0 else (float('inf') if vertices>0 else 1.0),
+        'area_deviation': float(changed_area/area) if area>0 else 0.0
+    }
+
+def print_report(name:str, tolerance:float, report:dict):
+    """
+    Print a simplification_report.
+    """
+    print(
+        f'Simplified {name} (tolerance: {tolerance:.2f}px): {report["vertices"]} -> {report["simplified_vertices"]} vertices '
+        f'({report["vertex_reduction"]:.1f}x fewer), {report["dropped"]} elements dropped, area deviation: {report["area_deviation"]:.2e}'
+    )
+
+def simplified_elements(geoms, tolerance:float, name:str = None)->tuple:
+    """
+    Simplify the valid polygons in geoms (see simplify_polygons) and convert them to elements. If name is provided, the
+    vertex reduction and area deviation are reported.
+
+    Returns (elements, index of the geometry each element was created from).
+    """
+    geoms = np.asarray(geoms,dtype=object)
+    if geoms.ndim==0:
+        geoms = geoms[None]
+
+    # Only valid Polygons are converted
+    polygon_index = np.flatnonzero(shapely.get_type_id(geoms)==shapely.GeometryType.POLYGON)
+    polygon_index = polygon_index[shapely.is_valid(geoms[polygon_index]) & ~shapely.is_empty(geoms[polygon_index])]
+
+    simplified = simplify_polygons(geoms[polygon_index],tolerance)
+    if name is not None:
+        print_report(name,tolerance,simplification_report(geoms[polygon_index],simplified))
+
+    elements, simplified_index = elements_from_polygons(simplified,as_arrays=True,return_index=True)
+
+    return elements, polygon_index[simplified_index]
+
+def lod_variant(annotation:dict, level:str, tolerance:float, polygons:tuple = None)->dict:
+    """
+    Simplified copy of an annotation named "<name> (<level>)".
+
+    Polyline elements are simplified (each polygon becomes its own element, with the properties and style of its source
+    element and a new id), other elements are copied as-is. The level and tolerance are recorded in the annotation's
+    "attributes" as "lod".
+
+    polygons can be (polygons, element index) already held for the annotation (e.g. the result of the operation that
+    created it), otherwise they are parsed from its elements.
+    """
+    name = annotation['annotation']['name']
+    elements = annotation['annotation']['elements']
+    geoms, element_index = polygons if polygons is not None else polygons_from_annotation(annotation)
+
+    new_elements, geom_index = simplified_elements(geoms,tolerance,name=f'{name} ({level})')
+    for el, source in zip(new_elements,element_index[geom_index].tolist()):
+        el.update({k: v for k,v in elements[source].items() if not k in GEOMETRY_KEYS})
+
+    converted = set(element_index.tolist())
+    new_elements.extend([el for i, el in enumerate(elements) if not i in converted and not el.get('type')=='polyline'])
+
+    return {
+        "annotation": {
+            "name": f'{name} ({level})',
+            "elements": new_elements,
+            "attributes": {'lod': {'level': level,'tolerance': tolerance,'source': name}}
+        }
+    }
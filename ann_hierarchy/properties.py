@@ -0,0 +1,160 @@
+"""
+
+Columnar filtering of annotation elements by their "user" properties
+
+"""
+
+import threading
+from numbers import Number
+
+import numpy as np
+
+
+class PropertyTable:
+    """
+    Typed columns of "user" properties for the elements of one annotation.
+
+    Each (key, sub_key) column is extracted from the elements once, as a float array if every present value is numeric,
+    a str array if every present value is a string, or an object array otherwise. Missing values are tracked with a mask.
+    """
+    def __init__(self, elements:list):
+
+        self.elements = elements
+        self.columns = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.elements)
+
+    def column(self, key:str, sub_key:str = None)->tuple:
+        """
+        Get (values, present) for a property, where present is False for elements without that property.
+        """
+        column_key = (key,sub_key)
+        with self.lock:
+            if not column_key in self.columns:
+                self.columns[column_key] = self._extract(key,sub_key)
+
+        return self.columns[column_key]
+
+    def _extract(self, key:str, sub_key:str = None)->tuple:
+        """
+        Pull one property (and sub-property) out of every element into a typed array.
+        """
+        missing = object()
+        values = [
+            el['user'].get(key,missing) if isinstance(el.get('user'),dict) else missing
+            for el in self.elements
+        ]
+        if sub_key is not None:
+            values = [v.get(sub_key,missing) if isinstance(v,dict) else missing for v in values]
+
+        present = np.fromiter((v is not missing for v in values),dtype=bool,count=len(values))
+        present_values = [v for v in values if v is not missing]
+
+        if all(isinstance(v,Number) for v in present_values):
+            column = np.full(len(values),np.nan)
+            column[present] = np.asarray(present_values,dtype=float)
+        elif all(isinstance(v,str) for v in present_values):
+            column = np.full(len(values),'',dtype=object)
+            column[present] = present_values
+            column = column.astype(str)
+        else:
+            column = np.full(len(values),None,dtype=object)
+            column[present] = present_values
+
+        return column, present
+
+    def evaluate(self, predicate:dict)->np.ndarray:
+        """
+        Evaluate a (possibly compound) predicate, returning a boolean mask over the elements.
+
+        Predicates are either:
+            - {"and": [predicates]}, {"or": [predicates]} or {"not": predicate}
+            - {"key": "", "sub_key": "" (optional), and one of:
+                "value": a string (equality) or [minimum, maximum] (inclusive range),
+                "equals": any value,
+                "in": [list of accepted values],
+                "range": [minimum, maximum] (inclusive, either can be null),
+                "min"/"max": (inclusive) bounds
+              }
+        Elements without the property never satisfy a property predicate (but do satisfy its "not").
+        """
+        if 'and' in predicate:
+            mask = np.ones(len(self),dtype=bool)
+            for p in predicate['and']:
+                mask &= self.evaluate(p)
+            return mask
+
+        if 'or' in predicate:
+            mask = np.zeros(len(self),dtype=bool)
+            for p in predicate['or']:
+                mask |= self.evaluate(p)
+            return mask
+
+        if 'not' in predicate:
+            return ~self.evaluate(predicate['not'])
+
+        values, present = self.column(predicate['key'],predicate.get('sub_key'))
+        mask = present.copy()
+
+        if 'value' in predicate:
+            # Original property filter format
+            if isinstance(predicate['value'],list):
+                mask &= self._range(values,predicate['value'][0],predicate['value'][1])
+            else:
+                mask &= self._equals(values,predicate['value'])
+
+        if 'equals' in predicate:
+            mask &= self._equals(values,predicate['equals'])
+
+        if 'in' in predicate:
+            if values.dtype==object:
+                accepted = predicate['in']
+                mask &= np.fromiter((v in accepted for v in values),dtype=bool,count=values.shape[0])
+            else:
+                accepted_type = Number if values.dtype.kind=='f' else str
+                accepted = [v for v in predicate['in'] if isinstance(v,accepted_type)]
+                mask &= np.isin(values,np.asarray(accepted,dtype=values.dtype))
+
+        if 'range' in predicate:
+            mask &= self._range(values,predicate['range'][0],predicate['range'][1])
+
+        if 'min' in predicate or 'max' in predicate:
+            mask &= self._range(values,predicate.get('min'),predicate.get('max'))
+
+        return mask
+
+    def _equals(self, values:np.ndarray, value)->np.ndarray:
+        """
+        Equality mask (numeric columns only match numbers and str columns only match strings).
+        """
+        if values.dtype==object:
+            return np.fromiter((v==value for v in values),dtype=bool,count=values.shape[0])
+        if values.dtype.kind=='f' and isinstance(value,Number):
+            return values==value
+        if values.dtype.kind=='U' and isinstance(value,str):
+            return values==value
+
+        return np.zeros(values.shape[0],dtype=bool)
+
+    def _range(self, values:np.ndarray, minimum = None, maximum = None)->np.ndarray:
+        """
+        Inclusive range mask (only numeric columns can satisfy a range).
+        """
+        if not values.dtype.kind=='f':
+            return np.zeros(values.shape[0],dtype=bool)
+
+        mask = ~np.isnan(values)
+        if minimum is not None:
+            mask &= values>=minimum
+        if maximum is not None:
+            mask &= values<=maximum
+
+        return mask
+
+    def filter(self, predicate:dict)->np.ndarray:
+        """
+        Indices of elements satisfying the predicate.
+        """
+        return np.flatnonzero(self.evaluate(predicate))
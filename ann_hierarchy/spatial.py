@@ -0,0 +1,90 @@
+"""
+
+STRtree-indexed spatial predicates between annotation elements and query regions
+
+"""
+
+import numpy as np
+
+import shapely
+from shapely import STRtree
+
+# Predicate as applied to (element, query region) and the equivalent STRtree predicate,
+# which is evaluated as predicate(query region, tree geometry)
+ELEMENT_PREDICATES = {
+    'within': 'contains',
+    'contains': 'within',
+    'intersects': 'intersects',
+    'overlaps': 'overlaps',
+    'dwithin': 'dwithin'
+}
+
+
+def query_polygons_from_spec(spec:dict)->np.ndarray:
+    """
+    Create query polygons from a JSON spec containing either "coordinates" (exterior coordinates of one region)
+    or "polygons" (list of exterior coordinates, one per region).
+    """
+    if 'polygons' in spec:
+        coord_list = spec['polygons']
+    else:
+        coord_list = [spec['coordinates']]
+
+    return np.array([
+        shapely.polygons(np.asarray(c,dtype=float)[:,:2])
+        for c in coord_list
+    ],dtype=object)
+
+
+class SpatialIndex:
+    """
+    STRtree over the geometries of one annotation, keeping the element index each geometry came from.
+
+    A single element can be represented by several geometries (e.g. if make_valid split it into multiple polygons)
+    so predicates are resolved per-element:
+        - "within": every geometry of the element satisfies the predicate with the same query region
+        - others: any geometry of the element satisfies the predicate
+    """
+    def __init__(self, geoms:np.ndarray, element_index:np.ndarray):
+
+        self.geoms = np.asarray(geoms,dtype=object)
+        self.element_index = np.asarray(element_index,dtype=np.intp)
+        self.tree = STRtree(self.geoms)
+
+        # Number of geometries representing each element
+        self.n_parts = np.bincount(self.element_index,minlength=int(self.element_index.max())+1 if self.element_index.shape[0]>0 else 0)
+
+    def query_pairs(self, query_geoms, predicate:str, distance=None)->np.ndarray:
+        """
+        Return (2,n) array of (query region index, element index) pairs where predicate(element, query region) is True.
+        """
+        if not predicate in ELEMENT_PREDICATES:
+            raise ValueError(f'Spatial predicate: {predicate} not implemented! Choose from: {list(ELEMENT_PREDICATES)}')
+
+        query_geoms = np.atleast_1d(np.asarray(query_geoms,dtype=object))
+        if predicate=='dwithin':
+            if distance is None:
+                raise ValueError('"dwithin" requires a distance')
+            query_idx, tree_idx = self.tree.query(query_geoms,predicate='dwithin',distance=distance)
+        else:
+            query_idx, tree_idx = self.tree.query(query_geoms,predicate=ELEMENT_PREDICATES[predicate])
+
+        if query_idx.shape[0]==0:
+            return np.empty((2,0),dtype=np.intp)
+
+        # Resolving geometry-level matches to element-level matches
+        pairs, counts = np.unique(
+            np.stack([query_idx,self.element_index[tree_idx]]),
+            axis=1,
+            return_counts=True
+        )
+        if predicate=='within':
+            pairs = pairs[:,counts==self.n_parts[pairs[1]]]
+
+        return pairs
+
+    def query(self, query_geoms, predicate:str, distance=None)->np.ndarray:
+        """
+        Return the sorted indices of elements where predicate(element, query region) is True for any of the query regions.
+        """
+        return np.unique(self.query_pairs(query_geoms,predicate,distance)[1])
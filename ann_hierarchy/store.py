@@ -0,0 +1,194 @@
+"""
+
+On-disk store of annotation geometries as flat coordinate arrays (memory-mapped when read back)
+
+"""
+
+import os
+import re
+import json
+import shutil
+import uuid
+import zipfile
+
+import numpy as np
+
+import shapely
+
+# Arrays of a stored layer (each saved as <name>.npy in the layer directory)
+LAYER_ARRAYS = ['coords','ring_offsets','polygon_offsets','element_index','bounds']
+LAYER_METADATA_NAME = 'layer.json'
+# Geometries cached as <annotation id>_<timestamp>.npz before layers were used (with these arrays)
+NPZ_CACHE_PATTERN = re.compile(r'[0-9a-f]{24}_[A-Za-z0-9_]+\.npz')
+NPZ_CACHE_ARRAYS = ['element_index.npy','offsets.npy','wkb.npy']
+
+
+def _ranges(starts:np.ndarray, counts:np.ndarray)->np.ndarray:
+    """
+    Concatenation of arange(start,start+count) for each start and count.
+    """
+    counts = np.asarray(counts,dtype=np.int64)
+    range_starts = np.cumsum(counts)-counts
+
+    return np.repeat(np.asarray(starts,dtype=np.int64)-range_starts,counts)+np.arange(int(np.sum(counts)),dtype=np.int64)
+
+def write_layer(path:str, geoms:np.ndarray, element_index:np.ndarray, metadata:dict = None):
+    """
+    Save polygons (and the element index of each one) to a layer directory:
+        - coords.npy: (n,2) coordinates of every ring (each ring closed)
+        - ring_offsets.npy: start of each ring in coords (plus the total)
+        - polygon_offsets.npy: start of each polygon's rings (exterior first, then holes) in ring_offsets (plus the total)
+        - element_index.npy, bounds.npy: element index and (minx,miny,maxx,maxy) of each polygon
+        - layer.json: counts and any metadata
+    Non-polygon and empty geometries are skipped. The layer is written to a temporary directory and renamed, so readers
+    never see a partial layer.
+    """
+    geoms = np.asarray(geoms,dtype=object)
+    element_index = np.asarray(element_index,dtype=np.int64)
+    keep = (shapely.get_type_id(geoms)==shapely.GeometryType.POLYGON) & ~shapely.is_empty(geoms)
+    geoms, element_index = geoms[keep], element_index[keep]
+
+    rings, ring_polygon = shapely.get_rings(geoms,return_index=True)
+    ring_counts = shapely.get_num_coordinates(rings)
+    polygon_counts = np.bincount(ring_polygon,minlength=geoms.shape[0])
+
+    arrays = {
+        'coords': shapely.get_coordinates(rings),
+        'ring_offsets': np.concatenate([[0],np.cumsum(ring_counts)]).astype(np.int64),
+        'polygon_offsets': np.concatenate([[0],np.cumsum(polygon_counts)]).astype(np.int64),
+        'element_index': element_index,
+        'bounds': shapely.bounds(geoms).reshape(-1,4)
+    }
+
+    temp_path = f'{path}.{uuid.uuid4().hex[:8]}.tmp'
+    os.makedirs(temp_path)
+    for name in LAYER_ARRAYS:
+        np.save(os.path.join(temp_path,f'{name}.npy'),arrays[name])
+    with open(os.path.join(temp_path,LAYER_METADATA_NAME),'w') as f:
+        json.dump({'polygons': int(geoms.shape[0]),'rings': int(rings.shape[0]),'vertices': int(arrays['coords'].shape[0]),**(metadata or {})},f)
+
+    try:
+        os.rename(temp_path,path)
+    except OSError:
+        # Already written (e.g. by a concurrent run), both copies hold the same version
+        shutil.rmtree(temp_path,ignore_errors=True)
+
+def is_npz_cache(path:str)->bool:
+    """
+    Whether a file is a geometry cache written before layers were used (by its name and the arrays it holds).
+    """
+    if NPZ_CACHE_PATTERN.fullmatch(os.path.basename(path)) is None:
+        return False
+    try:
+        with zipfile.ZipFile(path) as f:
+            return sorted(f.namelist())==NPZ_CACHE_ARRAYS
+    except (OSError,zipfile.BadZipFile):
+        return False
+
+
+class GeometryLayer:
+    """
+    Layer saved by write_layer. Its arrays are memory-mapped, so opening it reads almost nothing: polygons are only
+    built for the ones requested, and bounding box queries only read the bounds.
+    """
+    def __init__(self, path:str):
+
+        self.path = path
+        # Copy-on-write maps, shapely needs writeable arrays
+        for name in LAYER_ARRAYS:
+            array_path = os.path.join(path,f'{name}.npy')
+            setattr(self,name,np.load(array_path,mmap_mode='c') if os.path.exists(array_path) else None)
+        with open(os.path.join(path,LAYER_METADATA_NAME)) as f:
+            self.metadata = json.load(f)
+
+        if self.bounds is None:
+            # Layers written without bounds: each polygon's rings are contiguous, and holes are within the exterior
+            starts = self.ring_offsets[self.polygon_offsets[:-1]]
+            if starts.shape[0]==0:
+                self.bounds = np.empty((0,4))
+            else:
+                self.bounds = np.hstack([np.minimum.reduceat(self.coords,starts),np.maximum.reduceat(self.coords,starts)])
+
+    def __len__(self):
+        return self.element_index.shape[0]
+
+    def query_bbox(self, bbox:list)->np.ndarray:
+        """
+        Indices of the polygons whose bounding box intersects bbox (minx,miny,maxx,maxy).
+        """
+        minx, miny, maxx, maxy = bbox
+        bounds = self.bounds
+        hits = (bounds[:,0]<=maxx) & (bounds[:,2]>=minx) & (bounds[:,1]<=maxy) & (bounds[:,3]>=miny)
+
+        return np.flatnonzero(hits)
+
+    def polygons(self, indices:np.ndarray = None)->tuple:
+        """
+        Build the polygons at indices (every polygon if None). Returns (polygons, element_index).
+        """
+        if indices is None:
+            coords = self.coords
+            ring_counts = np.diff(self.ring_offsets)
+            polygon_counts = np.diff(self.polygon_offsets)
+            element_index = np.asarray(self.element_index)
+        else:
+            indices = np.asarray(indices,dtype=np.int64)
+            polygon_counts = self.polygon_offsets[indices+1]-self.polygon_offsets[indices]
+            ring_ids = _ranges(self.polygon_offsets[indices],polygon_counts)
+            ring_counts = self.ring_offsets[ring_ids+1]-self.ring_offsets[ring_ids]
+            coords = self.coords[_ranges(self.ring_offsets[ring_ids],ring_counts)]
+            element_index = np.asarray(self.element_index[indices])
+
+        if polygon_counts.shape[0]==0:
+            return np.empty(0,dtype=object), np.empty(0,dtype=np.int64)
+
+        rings = shapely.linearrings(coords,indices=np.repeat(np.arange(ring_counts.shape[0]),ring_counts))
+        polys = shapely.polygons(rings,indices=np.repeat(np.arange(polygon_counts.shape[0]),polygon_counts))
+
+        return polys, element_index
+
+    def polygons_in_bbox(self, bbox:list)->tuple:
+        """
+        Build only the polygons intersecting bbox (minx,miny,maxx,maxy). Returns (polygons, element_index).
+        """
+        polys, element_index = self.polygons(self.query_bbox(bbox))
+        hits = shapely.intersects(polys,shapely.box(*bbox))
+
+        return polys[hits], element_index[hits]
+
+
+class GeometryStore:
+    """
+    Directory of geometry layers keyed by annotation id and version (its "updated" timestamp), so a layer is never read
+    for a different version of its annotation.
+    Geometries cached there as .npz files before layers were used are never read again, so they are removed (only files
+    with the name and arrays those were written with, see is_npz_cache).
+    """
+    def __init__(self, root:str):
+
+        self.root = root
+        os.makedirs(self.root,exist_ok=True)
+        for file_name in os.listdir(self.root):
+            path = os.path.join(self.root,file_name)
+            if is_npz_cache(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Removed by a concurrent run
+                    pass
+
+    def layer_path(self, annotation_id:str, version)->str:
+        stamp = ''.join(c if c.isalnum() else '_' for c in str(version))
+        return os.path.join(self.root,f'{annotation_id}_{stamp}.geom')
+
+    def has(self, annotation_id:str, version)->bool:
+        return version is not None and os.path.isdir(self.layer_path(annotation_id,version))
+
+    def open(self, annotation_id:str, version)->GeometryLayer:
+        return GeometryLayer(self.layer_path(annotation_id,version))
+
+    def write(self, annotation_id:str, version, geoms:np.ndarray, element_index:np.ndarray, metadata:dict = None):
+        """
+        Save the geometries of one version of an annotation (see write_layer).
+        """
+        write_layer(self.layer_path(annotation_id,version),geoms,element_index,dict(metadata or {},annotation_id=annotation_id,version=version))
@@ -0,0 +1,188 @@
+"""
+
+Spatially partitioned (tiled) union/difference of annotation layers using a process pool
+
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import shapely
+from shapely import STRtree
+
+BOOLEAN_OPERATIONS = ['union','difference']
+
+
+def polygon_parts(geom, return_index:bool = False)->np.ndarray:
+    """
+    Return the Polygon parts of a Shapely geometry (or array of geometries) as an array.
+    If return_index is True, returns (parts, index of the geometry each part came from).
+    """
+    parts, index = shapely.get_parts(geom,return_index=True)
+    # Intersections/differences can contain nested collections (e.g. MultiPolygon within a GeometryCollection)
+    while np.any(shapely.get_type_id(parts)>=4):
+        parts, part_index = shapely.get_parts(parts,return_index=True)
+        index = index[part_index]
+
+    keep = (shapely.get_type_id(parts)==shapely.GeometryType.POLYGON) & ~shapely.is_empty(parts)
+    if return_index:
+        return parts[keep], index[keep]
+
+    return parts[keep]
+
+def assign_tiles(geoms:np.ndarray, extent:tuple, tile_size:float)->np.ndarray:
+    """
+    Assign each geometry to the grid tile (flat index, row-major) containing the center of its bounding box.
+    """
+    minx, miny, maxx, maxy = extent
+    n_cols = max(int(np.ceil((maxx-minx)/tile_size)),1)
+    n_rows = max(int(np.ceil((maxy-miny)/tile_size)),1)
+
+    bounds = shapely.bounds(geoms)
+    center_x = (bounds[:,0]+bounds[:,2])/2
+    center_y = (bounds[:,1]+bounds[:,3])/2
+    col = np.clip(((center_x-minx)//tile_size).astype(np.intp),0,n_cols-1)
+    row = np.clip(((center_y-miny)//tile_size).astype(np.intp),0,n_rows-1)
+
+    return row*n_cols+col
+
+def _split_by_tile(geoms:np.ndarray, tile_idx:np.ndarray)->tuple:
+    """
+    Group geometries by their tile index. Returns (sorted unique tile indices, list of geometry arrays for each tile).
+    """
+    order = np.argsort(tile_idx,kind='stable')
+    active_tiles, starts = np.unique(tile_idx[order],return_index=True)
+
+    return active_tiles, np.split(geoms[order],starts[1:])
+
+def _tile_boolean(geoms_1:np.ndarray, geoms_2:np.ndarray, operation:str, grid_size:float)->np.ndarray:
+    """
+    Apply the boolean operation to the polygons assigned to one tile and return the resulting polygons.
+    """
+    grid_size = grid_size if grid_size>0 else None
+    if operation=='union':
+        result = shapely.union_all(np.concatenate([geoms_1,geoms_2]),grid_size=grid_size)
+    else:
+        result = shapely.union_all(geoms_1,grid_size=grid_size)
+        if geoms_2.shape[0]>0:
+            result = shapely.difference(result,shapely.union_all(geoms_2,grid_size=grid_size),grid_size=grid_size)
+
+    return polygon_parts(result)
+
+def tiled_boolean(geoms_1, geoms_2, operation:str, tile_size:float, n_workers:int = 1, tolerance:float = 0.0, extent = None)->np.ndarray:
+    """
+    Union (geoms_1 + geoms_2) or difference (geoms_1 - geoms_2) of two polygon layers computed tile by tile.
+
+    The extent (defaults to the total bounds of both layers) is split into a grid of tile_size tiles and each polygon is
+    assigned to the tile containing the center of its bounding box. Each tile is processed independently (in a process pool
+    if n_workers>1). For differences, each tile subtracts every polygon in geoms_2 that intersects the tile's polygons.
+    Tile results that reach the edge of their tile (and anything they overlap) are merged back together along the seams.
+
+    tolerance is used as the precision grid size for all overlay operations (0 uses full floating point precision). The
+    result matches the single (untiled) operation up to that tolerance.
+
+    Returns an array of Polygons.
+    """
+    if not operation in BOOLEAN_OPERATIONS:
+        raise ValueError(f'Boolean operation: {operation} not implemented! Choose from: {BOOLEAN_OPERATIONS}')
+
+    geoms_1 = np.asarray(geoms_1,dtype=object)
+    geoms_2 = np.asarray(geoms_2,dtype=object)
+    if geoms_1.shape[0]==0 and (operation=='difference' or geoms_2.shape[0]==0):
+        return np.empty(0,dtype=object)
+
+    if extent is None:
+        extent = shapely.total_bounds(np.concatenate([geoms_1,geoms_2]))
+
+    active_tiles, tile_jobs = boolean_tile_jobs(geoms_1,geoms_2,operation,extent,tile_size,tolerance)
+    tile_results = run_tile_jobs(tile_jobs,n_workers)
+
+    pieces = np.concatenate(tile_results)
+    piece_tiles = np.repeat(active_tiles,[r.shape[0] for r in tile_results])
+
+    return stitch_tiles(pieces,piece_tiles,extent,tile_size,tolerance)
+
+def boolean_tile_jobs(geoms_1:np.ndarray, geoms_2:np.ndarray, operation:str, extent:tuple, tile_size:float, tolerance:float = 0.0)->tuple:
+    """
+    Split a boolean operation into independent tile jobs (see tiled_boolean).
+    Returns (sorted flat indices of tiles with polygons assigned, list of _tile_boolean arguments for each of those tiles).
+    """
+    if operation=='union':
+        # Both layers are assigned to tiles
+        combined = np.concatenate([geoms_1,geoms_2])
+        active_tiles, tile_geoms = _split_by_tile(combined,assign_tiles(combined,extent,tile_size))
+        tile_jobs = [
+            (g,np.empty(0,dtype=object),operation,tolerance)
+            for g in tile_geoms
+        ]
+    else:
+        # Only the first layer is assigned to tiles, geoms_2 are sent to every tile they intersect
+        active_tiles, tile_geoms = _split_by_tile(geoms_1,assign_tiles(geoms_1,extent,tile_size))
+        tree_2 = STRtree(geoms_2)
+        tile_jobs = [
+            (g,geoms_2[tree_2.query(shapely.box(*shapely.total_bounds(g)))],operation,tolerance)
+            for g in tile_geoms
+        ]
+
+    return active_tiles, tile_jobs
+
+def run_tile_jobs(tile_jobs:list, n_workers:int = 1)->list:
+    """
+    Run tile jobs from boolean_tile_jobs (in a process pool if n_workers>1). Returns the array of polygons from each tile.
+    """
+    if n_workers>1 and len(tile_jobs)>1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            return list(executor.map(_tile_boolean,*zip(*tile_jobs)))
+
+    return [_tile_boolean(*job) for job in tile_jobs]
+
+def stitch_tiles(pieces:np.ndarray, piece_tiles:np.ndarray, extent:tuple, tile_size:float, tolerance:float = 0.0, return_tiles:bool = False):
+    """
+    Merge polygons computed tile by tile (piece_tiles is the flat tile index of each piece, see assign_tiles) back together.
+    Pieces reaching the edge of their own tile are merged with every piece they intersect, other pieces are kept as-is.
+
+    If return_tiles is True, returns (polygons, list with the sorted tile indices each polygon was built from).
+    """
+    if pieces.shape[0]==0:
+        return (pieces, []) if return_tiles else pieces
+
+    n_cols = max(int(np.ceil((extent[2]-extent[0])/tile_size)),1)
+    tile_minx = extent[0]+(piece_tiles%n_cols)*tile_size
+    tile_miny = extent[1]+(piece_tiles//n_cols)*tile_size
+    piece_bounds = shapely.bounds(pieces)
+    crosses_seam = (piece_bounds[:,0]<=tile_minx) | (piece_bounds[:,1]<=tile_miny) | (piece_bounds[:,2]>=tile_minx+tile_size) | (piece_bounds[:,3]>=tile_miny+tile_size)
+
+    if not np.any(crosses_seam):
+        return (pieces, [[int(t)] for t in piece_tiles]) if return_tiles else pieces
+
+    piece_tree = STRtree(pieces)
+    seam_idx = np.unique(piece_tree.query(pieces[crosses_seam],predicate='intersects')[1])
+    stitch = np.zeros(pieces.shape[0],dtype=bool)
+    stitch[seam_idx] = True
+    stitched = polygon_parts(shapely.union_all(pieces[stitch],grid_size=tolerance if tolerance>0 else None))
+    result = np.concatenate([pieces[~stitch],stitched])
+    if not return_tiles:
+        return result
+
+    # Merged polygons were built from every stitched piece they intersect
+    result_tiles = [[int(t)] for t in piece_tiles[~stitch]]
+    stitched_idx, piece_idx = STRtree(pieces[stitch]).query(stitched,predicate='intersects')
+    stitched_tiles = [set() for _ in range(stitched.shape[0])]
+    for s, t in zip(stitched_idx.tolist(),piece_tiles[stitch][piece_idx].tolist()):
+        stitched_tiles[s].add(int(t))
+    result_tiles.extend([sorted(t) for t in stitched_tiles])
+
+    return result, result_tiles
+
+def area_deviation(geoms, reference)->float:
+    """
+    Area of the symmetric difference between two polygon layers relative to the area of the reference layer.
+    """
+    merged = shapely.union_all(np.asarray(geoms,dtype=object))
+    merged_reference = shapely.union_all(np.asarray(reference,dtype=object))
+    reference_area = shapely.area(merged_reference)
+    if reference_area==0:
+        return float(shapely.area(merged))
+
+    return float(shapely.area(shapely.symmetric_difference(merged,merged_reference))/reference_area)
@@ -0,0 +1,234 @@
+"""
+
+Tissue detection helpers for CreateTissueAnnotation
+
+"""
+
+import itertools
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+import shapely
+
+from skimage.measure import find_contours, regionprops, label
+
+from ann_hierarchy.geometry import polygons_from_rings
+from ann_hierarchy.tiled import polygon_parts
+
+FRAME_REDUCTIONS = ['mean','max','sum']
+
+
+def label_contours(labeled_mask:np.ndarray)->list:
+    """
+    Find the contours of every labeled piece in a label image, returned as (n,2) arrays of (x,y) pixel coordinates.
+
+    Each piece is only traced within its bounding box (plus a 1 pixel margin) so the cost scales with the piece size rather
+    than the size of the whole image. Contours are the same as find_contours(labeled_mask==piece) on the full image.
+    """
+    n_rows, n_cols = labeled_mask.shape[:2]
+    contours = []
+    for region in regionprops(labeled_mask):
+        min_row, min_col, max_row, max_col = region.bbox
+        min_row, min_col = max(min_row-1,0), max(min_col-1,0)
+        max_row, max_col = min(max_row+1,n_rows), min(max_col+1,n_cols)
+
+        piece_mask = labeled_mask[min_row:max_row,min_col:max_col]==region.label
+        for contour in find_contours(piece_mask):
+            # (row, col) in the crop to (x, y) in the label image
+            contours.append(contour[:,::-1]+np.array([min_col,min_row]))
+
+    return contours
+
+def select_level(image_metadata:dict, downsample:float)->int:
+    """
+    Pick the pyramid level (0 is the lowest resolution, levels-1 is the base) closest to downsample times smaller than the base image.
+    """
+    max_level = image_metadata['levels']-1
+    level = max_level - int(round(np.log2(max(downsample,1))))
+
+    return int(np.clip(level,0,max_level))
+
+def grayscale(image:np.ndarray, brightfield:bool)->np.ndarray:
+    """
+    Reduce an image to the grayscale values used for thresholding.
+    RGB(A) images use the mean of the color channels, 2D images (e.g. frames already reduced by reduce_frames) are used as-is.
+    Brightfield images are inverted.
+    """
+    if image.ndim==2:
+        image = image[:,:,None]
+    if image.shape[-1]==4:
+        # Dropping alpha channel
+        image = image[:,:,:3]
+
+    gray = np.mean(image,axis=-1)
+    if brightfield:
+        gray = 255-gray
+
+    return gray
+
+def threshold_tissue(gray:np.ndarray, threshold:float)->np.ndarray:
+    """
+    Tissue mask of a grayscale image (see grayscale): tissue is brighter than threshold, as brightfield images are inverted.
+    """
+    return gray > threshold
+
+def windowed_map(function, items, n_workers:int = 4):
+    """
+    Apply function to each item in a thread pool, yielding (item, result) pairs as they complete.
+    At most 2*n_workers items are submitted (and their results held) at once.
+    """
+    items = iter(items)
+    if n_workers<=1:
+        for item in items:
+            yield item, function(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        in_flight = {}
+        for item in itertools.islice(items,2*n_workers):
+            in_flight[executor.submit(function,item)] = item
+
+        while len(in_flight)>0:
+            done, _ = wait(list(in_flight),return_when=FIRST_COMPLETED)
+            for future in done:
+                yield in_flight.pop(future), future.result()
+            for item in itertools.islice(items,len(done)):
+                in_flight[executor.submit(function,item)] = item
+
+def parse_frames(frame_spec:str, n_frames:int)->list:
+    """
+    Parse a frame selection like "0,2,5-9" (empty selects every frame) into a list of frame indices.
+    """
+    if frame_spec is None or frame_spec.strip()=='':
+        return list(range(n_frames))
+
+    frames = []
+    for part in frame_spec.split(','):
+        part = part.strip()
+        if part=='':
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            frames.extend(range(int(start),int(end)+1))
+        else:
+            frames.append(int(part))
+
+    for f in frames:
+        if f<0 or f>=n_frames:
+            raise ValueError(f'Frame: {f} not in image (frames 0-{n_frames-1})')
+
+    return frames
+
+def frame_intensity(image:np.ndarray)->np.ndarray:
+    """
+    Reduce a single frame to one channel (max over channels).
+    """
+    return np.max(np.atleast_3d(image),axis=-1)
+
+def reduce_frames(fetch_frame, frames:list, reduction:str = 'mean', weights:list = None, n_workers:int = 1)->np.ndarray:
+    """
+    Combine single-channel frames into one image without holding every frame in memory.
+
+    fetch_frame(frame) returns one frame as a 2D array. Frames are fetched concurrently (n_workers) and added to a running
+    reduction as they arrive: "mean", "max" or "sum" (weighted by weights, one per frame in frames, default 1).
+    """
+    if not reduction in FRAME_REDUCTIONS:
+        raise ValueError(f'Frame reduction: {reduction} not implemented! Choose from: {FRAME_REDUCTIONS}')
+    if len(frames)==0:
+        raise ValueError('No frames selected')
+
+    if weights is None or len(weights)==0:
+        weights = [1.0]*len(frames)
+    if not len(weights)==len(frames):
+        raise ValueError(f'Got {len(weights)} frame weights for {len(frames)} frames')
+    frame_weights = dict(zip(frames,weights))
+
+    reduced = None
+    for frame, image in windowed_map(fetch_frame,frames,n_workers):
+        if reduced is None:
+            # Preallocated on the first frame to arrive (all frames share the same shape)
+            reduced = np.full(image.shape,-np.inf) if reduction=='max' else np.zeros(image.shape)
+
+        if reduction=='max':
+            np.maximum(reduced,image,out=reduced)
+        elif reduction=='sum':
+            reduced += frame_weights[frame]*image
+        else:
+            reduced += image
+
+    if reduction=='mean':
+        reduced /= len(frames)
+
+    return reduced
+
+def mask_polygons(tissue_mask:np.ndarray, offset:tuple = (0,0), scale = 1.0)->np.ndarray:
+    """
+    Trace the pieces of a tissue mask and return polygons in (x+offset_x, y+offset_y)*scale coordinates (scale can also
+    be (scale_x, scale_y)).
+    The mask is padded so that pieces touching its edge are closed along the edge (polygons from adjacent tiles then share
+    their seam exactly).
+    """
+    padded = np.pad(tissue_mask,1)
+    contours = label_contours(label(padded))
+    shift = np.array([offset[0]-1,offset[1]-1])
+    scale = np.asarray(scale,dtype=float)
+    polygons, _ = polygons_from_rings([(contour+shift)*scale for contour in contours])
+
+    return polygons
+
+def remove_small_interiors(polygons:np.ndarray, min_area:float)->np.ndarray:
+    """
+    Drop the holes smaller than min_area from each polygon.
+    """
+    filled = []
+    for poly in polygons:
+        interiors = [r for r in poly.interiors if shapely.Polygon(r).area>=min_area]
+        filled.append(shapely.Polygon(poly.exterior,interiors) if len(interiors)<len(poly.interiors) else poly)
+
+    return np.array(filled,dtype=object)
+
+def detect_tissue_tiled(fetch_tile, image_metadata:dict, level:int, threshold:float, brightfield:bool, hole_area:float = 0, n_workers:int = 4)->np.ndarray:
+    """
+    Detect tissue at one pyramid level by streaming its tiles.
+
+    fetch_tile(level, x, y) returns the tile image as an array (a 2D array for multi-frame images, see reduce_frames).
+    Each tile is thresholded (see threshold_tissue) and its pieces are traced, then the polygons from every tile are merged
+    across tile borders and clipped to the image. Small holes (< hole_area level pixels) are removed after merging, so
+    background reaching a tile border is only filled if it is also enclosed in the neighboring tiles. At most 2*n_workers
+    tiles are held in memory at once, regardless of the size of the image.
+
+    Returns an array of polygons in base image coordinates.
+    """
+    scale = 2**(image_metadata['levels']-1-level)
+    tile_width = image_metadata['tileWidth']
+    tile_height = image_metadata['tileHeight']
+    level_width = int(np.ceil(image_metadata['sizeX']/scale))
+    level_height = int(np.ceil(image_metadata['sizeY']/scale))
+    n_tiles_x = int(np.ceil(level_width/tile_width))
+    n_tiles_y = int(np.ceil(level_height/tile_height))
+
+    def process_tile(tile_x, tile_y):
+        gray = grayscale(fetch_tile(level,tile_x,tile_y),brightfield)
+        # Edge tiles may be padded to the full tile size (e.g. with black, which could pass the threshold once inverted)
+        gray = gray[:level_height-tile_y*tile_height,:level_width-tile_x*tile_width]
+        tile_mask = threshold_tissue(gray,threshold)
+
+        return mask_polygons(tile_mask,offset=(tile_x*tile_width,tile_y*tile_height),scale=scale)
+
+    tile_coords = [(x,y) for y in range(n_tiles_y) for x in range(n_tiles_x)]
+    tile_polygons = [
+        polygons for _, polygons in windowed_map(lambda xy: process_tile(*xy),tile_coords,n_workers)
+    ]
+
+    if len(tile_polygons)==0:
+        return np.empty(0,dtype=object)
+
+    # Stitching pieces across tile borders
+    merged = shapely.union_all(np.concatenate(tile_polygons))
+    merged = shapely.intersection(merged,shapely.box(0,0,image_metadata['sizeX'],image_metadata['sizeY']))
+    polygons = polygon_parts(merged)
+    if hole_area>0:
+        polygons = remove_small_interiors(polygons,hole_area*scale**2)
+
+    return polygons
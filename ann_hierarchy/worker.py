@@ -0,0 +1,329 @@
+"""
+
+Long-lived worker running AnnotationHierarchy/CreateTissueAnnotation jobs without starting a new process per job
+
+The CLIs (and numpy, shapely, girder_client, ...) are imported once when the worker starts. Jobs are then read from a
+local queue directory:
+
+    python -m ann_hierarchy.worker --queue-dir /jobs --workers 2
+
+where each job is a JSON file (written under another name, e.g. job.json.tmp, and renamed to job.json when complete) and
+its result is written next to it as job.result.json. Or from a unix socket:
+
+    python -m ann_hierarchy.worker --socket /tmp/ann_hierarchy.sock --workers 2
+
+taking one job per line on each connection and answering with one result line per job, e.g. with:
+
+    python -m ann_hierarchy.worker --socket /tmp/ann_hierarchy.sock --submit AnnotationHierarchy -- \
+        <input_image> <ann_id_1> <ann_id_2> + "New Annotation" --api-url ... --token ...
+
+A job is {"cli": "AnnotationHierarchy" or "CreateTissueAnnotation", "argv": [...]} with argv the CLI's own arguments
+(as slicer_cli_web passes them, including input_image), and optionally an "id". Its result has the "id", "cli",
+"status" ("done" or "error"), "seconds", the CLI's printed "output" and the "error" traceback (if any).
+
+With --workers 1 jobs run one after another in the worker process, with more they run concurrently in processes forked
+from it (so the imports are shared).
+
+Only the standard library is imported until the worker starts, so that submitting a job stays fast.
+
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import argparse
+import traceback
+import socketserver
+import multiprocessing
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+WORKER_CLIS = ['AnnotationHierarchy','CreateTissueAnnotation']
+JOB_SUFFIX = '.json'
+RUNNING_SUFFIX = '.running'
+RESULT_SUFFIX = '.result.json'
+
+_cli_parsers = {}
+
+
+def log(message:str):
+    """
+    Print a worker message (to the real stdout, job output is captured separately).
+    """
+    print(message,file=sys.__stdout__,flush=True)
+
+def preload(cli_names:list):
+    """
+    Import the CLIs (and everything they import at the top) and parse their XML descriptions once.
+    """
+    from ctk_cli import CLIArgumentParser
+    from ann_hierarchy.batch import load_cli, CLI_DIR
+
+    for cli_name in cli_names:
+        load_cli(cli_name)
+        _cli_parsers[cli_name] = CLIArgumentParser(os.path.join(CLI_DIR,cli_name,f'{cli_name}.xml'))
+
+def run_job(job:dict)->dict:
+    """
+    Run one job in this process, capturing what the CLI prints (including argument errors). Returns the job result.
+    """
+    from ann_hierarchy.batch import load_cli
+
+    start = time.perf_counter()
+    result = {'id': job.get('id'),'cli': job.get('cli')}
+    output = io.StringIO()
+    try:
+        if not job.get('cli') in _cli_parsers:
+            raise ValueError(f'CLI: {job.get("cli")} not loaded by this worker! Choose from: {list(_cli_parsers)}')
+
+        with redirect_stdout(output), redirect_stderr(output):
+            args = _cli_parsers[job['cli']].parse_args([str(a) for a in job.get('argv',[])])
+            load_cli(job['cli']).main(args)
+        result['status'] = 'done'
+
+    except SystemExit as e:
+        # argparse exits, successfully for --help or --xml, otherwise on errors (reported instead of stopping the worker)
+        if e.code is None or e.code==0:
+            result['status'] = 'done'
+        else:
+            result['status'] = 'error'
+            result['error'] = traceback.format_exc()
+
+    except Exception:
+        result['status'] = 'error'
+        result['error'] = traceback.format_exc()
+
+    result['seconds'] = time.perf_counter()-start
+    result['output'] = output.getvalue()
+
+    return result
+
+
+class JobRunner:
+    """
+    Runs jobs one after another in this process (n_workers=1) or concurrently in n_workers forked processes.
+    A job that kills its process fails, and the processes are restarted for the next jobs.
+    """
+    def __init__(self, n_workers:int = 1):
+
+        self.n_workers = max(n_workers,1)
+        self.executor = None
+        self._start()
+
+    def _start(self):
+        if self.n_workers==1:
+            # One thread, so jobs run one at a time even when submitted concurrently
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        else:
+            self.executor = ProcessPoolExecutor(max_workers=self.n_workers,mp_context=multiprocessing.get_context('fork'))
+            # Forking every process now, before the server threads start
+            for f in [self.executor.submit(os.getpid) for _ in range(self.n_workers)]:
+                f.result()
+
+    def submit(self, job:dict):
+        try:
+            return self.executor.submit(run_job,job)
+        except BrokenProcessPool:
+            log('Worker processes stopped, restarting them')
+            self.executor.shutdown(wait=False)
+            self._start()
+            return self.executor.submit(run_job,job)
+
+    def run(self, job:dict)->dict:
+        try:
+            return self.submit(job).result()
+        except BrokenProcessPool:
+            return {'id': job.get('id'),'cli': job.get('cli'),'status': 'error','error': 'Worker process stopped while running the job','seconds': 0.0,'output': ''}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def write_json_atomic(path:str, obj):
+    """
+    Write obj as JSON to a temporary file and rename it to path (so readers never see a partial file).
+    """
+    temp_path = f'{path}.tmp'
+    with open(temp_path,'w') as f:
+        json.dump(obj,f,indent=4)
+    os.replace(temp_path,path)
+
+def claim_jobs(queue_dir:str)->list:
+    """
+    Claim every job file in queue_dir (renaming it so that other workers sharing the directory skip it).
+    Returns (job name, running path) in file name order.
+    """
+    claimed = []
+    for file_name in sorted(os.listdir(queue_dir)):
+        if not file_name.endswith(JOB_SUFFIX) or file_name.endswith(RESULT_SUFFIX):
+            continue
+        job_path = os.path.join(queue_dir,file_name)
+        try:
+            os.rename(job_path,job_path+RUNNING_SUFFIX)
+        except FileNotFoundError:
+            # Claimed by another worker
+            continue
+        claimed.append((file_name[:-len(JOB_SUFFIX)],job_path+RUNNING_SUFFIX))
+
+    return claimed
+
+def serve_queue(runner:JobRunner, queue_dir:str, poll_interval:float = 0.5, max_jobs:int = 0):
+    """
+    Run the jobs in queue_dir as they appear, writing <job>.result.json for each (and removing the job file).
+    Stops after max_jobs jobs if max_jobs>0.
+    """
+    os.makedirs(queue_dir,exist_ok=True)
+    log(f'Waiting for jobs in: {queue_dir}')
+
+    pending = {}
+    n_finished = 0
+    while max_jobs<=0 or n_finished<max_jobs:
+        for job_name, running_path in claim_jobs(queue_dir):
+            try:
+                with open(running_path) as f:
+                    job = json.load(f)
+                if not isinstance(job,dict):
+                    raise ValueError('a job is a JSON object')
+                job.setdefault('id',job_name)
+            except ValueError as e:
+                # Reported in the result without running anything
+                pending[job_name] = (running_path,{'id': job_name,'invalid': f'Invalid job file: {e}'},None)
+                continue
+            log(f'Started: {job["id"]} ({job.get("cli")})')
+            pending[job_name] = (running_path,job,runner.submit(job))
+
+        for job_name, (running_path, job, future) in list(pending.items()):
+            if future is not None and not future.done():
+                continue
+            if future is None:
+                result = {'id': job['id'],'cli': None,'status': 'error','error': job['invalid'],'seconds': 0.0,'output': ''}
+            else:
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    result = {'id': job['id'],'cli': job.get('cli'),'status': 'error','error': 'Worker process stopped while running the job','seconds': 0.0,'output': ''}
+
+            write_json_atomic(os.path.join(queue_dir,job_name+RESULT_SUFFIX),result)
+            os.remove(running_path)
+            del pending[job_name]
+            n_finished += 1
+            log(f'Finished: {result["id"]} {result["status"]} ({result["seconds"]:.2f}s)')
+
+        time.sleep(poll_interval if len(pending)==0 else min(poll_interval,0.05))
+
+
+class JobRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads one JSON job per line and writes one JSON result per line (in the same order).
+    """
+    runner = None
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                result = {'id': None,'cli': None,'status': 'error','error': f'Invalid job: {e}','seconds': 0.0,'output': ''}
+            else:
+                log(f'Started: {job.get("id")} ({job.get("cli")})')
+                result = self.runner.run(job)
+                log(f'Finished: {result["id"]} {result["status"]} ({result["seconds"]:.2f}s)')
+
+            self.wfile.write((json.dumps(result)+'\n').encode('utf-8'))
+            self.wfile.flush()
+
+def serve_socket(runner:JobRunner, socket_path:str):
+    """
+    Accept jobs on a unix socket until interrupted (connections are handled concurrently, jobs are run by runner).
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    class Handler(JobRequestHandler):
+        pass
+    Handler.runner = runner
+
+    with socketserver.ThreadingUnixStreamServer(socket_path,Handler) as server:
+        server.daemon_threads = True
+        log(f'Waiting for jobs on: {socket_path}')
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+def submit_job(socket_path:str, job:dict)->dict:
+    """
+    Send a job to a worker listening on socket_path and wait for its result.
+    """
+    with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall((json.dumps(job)+'\n').encode('utf-8'))
+        s.shutdown(socket.SHUT_WR)
+        with s.makefile('rb') as f:
+            return json.loads(f.readline())
+
+def main(argv:list = None):
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # Everything after "--" is the submitted job's CLI arguments
+    if '--' in argv:
+        cli_argv = argv[argv.index('--')+1:]
+        argv = argv[:argv.index('--')]
+    else:
+        cli_argv = []
+
+    parser = argparse.ArgumentParser(
+        prog = 'python -m ann_hierarchy.worker',
+        description = 'Run AnnotationHierarchy/CreateTissueAnnotation jobs from a queue directory or a unix socket in one long-lived process.'
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--queue-dir',help='Directory polled for job files (<name>.json, results are written to <name>.result.json)')
+    source.add_argument('--socket',help='Unix socket path to accept jobs on (or to submit a job to with --submit)')
+    parser.add_argument('--workers',type=int,default=1,help='Number of jobs run at once (in forked processes if more than 1)')
+    parser.add_argument('--clis',default=','.join(WORKER_CLIS),help='Comma separated CLIs to load (others are rejected)')
+    parser.add_argument('--poll-interval',type=float,default=0.5,help='Seconds between checks of the queue directory')
+    parser.add_argument('--submit',choices=WORKER_CLIS,default=None,help='Submit one job for this CLI (arguments after "--") to --socket, print its result and exit')
+    worker_args = parser.parse_args(argv)
+
+    if worker_args.submit is not None:
+        if worker_args.socket is None:
+            parser.error('--submit requires --socket')
+        result = submit_job(worker_args.socket,{'cli': worker_args.submit,'argv': cli_argv})
+        print(result['output'],end='')
+        if result['status']=='error':
+            print(result['error'],file=sys.stderr)
+            sys.exit(1)
+        return result
+
+    cli_names = [c.strip() for c in worker_args.clis.split(',') if not c.strip()=='']
+    for cli_name in cli_names:
+        if not cli_name in WORKER_CLIS:
+            parser.error(f'CLI: {cli_name} not available! Choose from: {WORKER_CLIS}')
+
+    start = time.perf_counter()
+    preload(cli_names)
+    log(f'Loaded {", ".join(cli_names)} in {time.perf_counter()-start:.2f}s')
+
+    runner = JobRunner(worker_args.workers)
+    # Stopping the same way on SIGTERM (e.g. docker stop) as on Ctrl+C
+    signal.signal(signal.SIGTERM,signal.default_int_handler)
+    try:
+        if worker_args.queue_dir is not None:
+            serve_queue(runner,worker_args.queue_dir,worker_args.poll_interval)
+        else:
+            serve_socket(runner,worker_args.socket)
+    except KeyboardInterrupt:
+        log('Stopping worker')
+    finally:
+        runner.shutdown()
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,5 @@
+"""
+
+Benchmark suite for the annotation-hierarchy CLIs (run with: python -m benchmarks.run)
+
+"""
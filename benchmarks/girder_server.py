@@ -0,0 +1,267 @@
+"""
+
+Local HTTP stand-in for the Girder endpoints used by the CLIs (files, annotations, tiles and thumbnails)
+
+"""
+
+import re
+import gzip
+import json
+import uuid
+import threading
+from io import BytesIO
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from PIL import Image
+
+API_ROOT = '/api/v1'
+
+
+def encode_png(image:np.ndarray)->bytes:
+    """
+    Encode an image array as PNG.
+    """
+    buffer = BytesIO()
+    Image.fromarray(image).save(buffer,format='PNG')
+
+    return buffer.getvalue()
+
+def render_tile(thumbnail:np.ndarray, metadata:dict, level:int, x:int, y:int)->np.ndarray:
+    """
+    Tile (level, x, y) of a synthetic slide whose base image is the thumbnail scaled up to sizeX by sizeY
+    (nearest neighbor, tiles on the right/bottom edge are cropped to the image).
+    """
+    scale = 2**(metadata['levels']-1-level)
+    tile_width, tile_height = metadata['tileWidth'], metadata['tileHeight']
+    level_width = int(np.ceil(metadata['sizeX']/scale))
+    level_height = int(np.ceil(metadata['sizeY']/scale))
+
+    cols = np.arange(x*tile_width,min((x+1)*tile_width,level_width))
+    rows = np.arange(y*tile_height,min((y+1)*tile_height,level_height))
+    thumb_cols = np.minimum((cols*scale*thumbnail.shape[1]/metadata['sizeX']).astype(int),thumbnail.shape[1]-1)
+    thumb_rows = np.minimum((rows*scale*thumbnail.shape[0]/metadata['sizeY']).astype(int),thumbnail.shape[0]-1)
+
+    return thumbnail[thumb_rows[:,None],thumb_cols[None,:]]
+
+def apply_patch(annotation:dict, patch_list:list):
+    """
+    Apply large-image style PATCH operations (add/remove "elements/id:{id}", replace "attributes") to an annotation.
+    """
+    elements = annotation['elements']
+    for op in patch_list:
+        if op['path']=='attributes':
+            annotation['attributes'] = op['value']
+        elif op['op']=='add':
+            elements.append(op['value'])
+        elif op['op']=='remove':
+            element_id = op['path'].split('id:',1)[1]
+            annotation['elements'] = elements = [el for el in elements if el.get('id')!=element_id]
+
+
+class SyntheticGirder:
+    """
+    In-memory Girder served over HTTP on localhost.
+
+    Holds items (image metadata, an RGB thumbnail or per-frame thumbnails whose tiles are rendered on request) with a file
+    each, and their annotations. Counts the requests and the bytes received/sent (bodies, as transferred) since
+    reset_counters().
+    """
+    def __init__(self):
+
+        self.files = {}
+        self.items = {}
+        self.annotations = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.requests = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def counters(self)->dict:
+        return {'requests': self.requests,'bytes_received': self.bytes_received,'bytes_sent': self.bytes_sent}
+
+    def add_item(self, metadata:dict, thumbnail:np.ndarray = None, frames:list = None)->tuple:
+        """
+        Add an image item. Returns (item id, file id).
+        """
+        item_id = uuid.uuid4().hex[:24]
+        file_id = uuid.uuid4().hex[:24]
+        self.items[item_id] = {'metadata': metadata,'thumbnail': thumbnail,'frames': frames}
+        self.files[file_id] = item_id
+
+        return item_id, file_id
+
+    def add_annotation(self, item_id:str, annotation:dict)->str:
+        """
+        Add an annotation ({"annotation": {"name":..., "elements": [...]}} or the bare annotation) to an item. Returns its id.
+        """
+        annotation_id = uuid.uuid4().hex[:24]
+        with self.lock:
+            self.annotations[annotation_id] = {
+                '_id': annotation_id,
+                'itemId': item_id,
+                'updated': datetime.now(timezone.utc).isoformat(),
+                'annotation': annotation['annotation'] if 'annotation' in annotation else annotation
+            }
+
+        return annotation_id
+
+    def item_annotations(self, item_id:str)->list:
+        """
+        Annotations of an item (full documents).
+        """
+        return [a for a in self.annotations.values() if a['itemId']==item_id]
+
+    def start(self, port:int = 0)->str:
+        """
+        Serve in a background thread. Returns the API URL.
+        """
+        girder = self
+        class Handler(GirderRequestHandler):
+            pass
+        Handler.girder = girder
+
+        self.server = ThreadingHTTPServer(('127.0.0.1',port),Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,daemon=True)
+        self.thread.start()
+
+        return f'http://127.0.0.1:{self.server.server_address[1]}{API_ROOT}'
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class GirderRequestHandler(BaseHTTPRequestHandler):
+    """
+    Routes requests to the SyntheticGirder set as the "girder" class attribute.
+    """
+    protocol_version = 'HTTP/1.1'
+    girder = None
+
+    routes = [
+        ('GET', r'/file/(?P<file_id>\w+)', 'get_file'),
+        ('GET', r'/annotation', 'list_annotations'),
+        ('GET', r'/annotation/(?P<annotation_id>\w+)', 'get_annotation'),
+        ('POST', r'/annotation', 'create_annotation'),
+        ('POST', r'/annotation/item/(?P<item_id>\w+)', 'create_item_annotation'),
+        ('PATCH', r'/annotation/(?P<annotation_id>\w+)', 'patch_annotation'),
+        ('DELETE', r'/annotation/(?P<annotation_id>\w+)', 'delete_annotation'),
+        ('GET', r'/item/(?P<item_id>\w+)/tiles', 'get_tiles'),
+        ('GET', r'/item/(?P<item_id>\w+)/tiles/thumbnail', 'get_thumbnail'),
+        ('GET', r'/item/(?P<item_id>\w+)/tiles/zxy/(?P<level>\d+)/(?P<x>\d+)/(?P<y>\d+)', 'get_tile')
+    ]
+
+    def log_message(self, format, *args):
+        # Keeping benchmark output clean
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method:str):
+        url = urlparse(self.path)
+        # GirderClient joins its API URL and paths with a double slash
+        path = re.sub('/+','/',url.path)
+        path = path[len(API_ROOT):] if path.startswith(API_ROOT) else path
+        self.query = {k: v[0] for k,v in parse_qs(url.query).items()}
+
+        length = int(self.headers.get('Content-Length',0))
+        self.body = self.rfile.read(length) if length>0 else b''
+        with self.girder.lock:
+            self.girder.requests += 1
+            self.girder.bytes_received += len(self.body)
+        if self.headers.get('Content-Encoding')=='gzip':
+            self.body = gzip.decompress(self.body)
+
+        for route_method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern,path)
+            if route_method==method and match:
+                try:
+                    getattr(self,handler)(**match.groupdict())
+                except KeyError as e:
+                    self._send_json({'message': f'Not found: {e}'},status=404)
+                return
+
+        self._send_json({'message': f'No route for {method} {path}'},status=404)
+
+    def _send(self, content:bytes, content_type:str, status:int = 200):
+        self.send_response(status)
+        self.send_header('Content-Type',content_type)
+        self.send_header('Content-Length',str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        with self.girder.lock:
+            self.girder.bytes_sent += len(content)
+
+    def _send_json(self, obj, status:int = 200):
+        self._send(json.dumps(obj).encode('utf-8'),'application/json',status)
+
+    def get_file(self, file_id:str):
+        self._send_json({'_id': file_id,'itemId': self.girder.files[file_id]})
+
+    def list_annotations(self):
+        listing = []
+        for ann in self.girder.item_annotations(self.query['itemId']):
+            # Annotation metadata without elements
+            listing.append(dict(ann,annotation={k:v for k,v in ann['annotation'].items() if not k=='elements'}))
+        self._send_json(listing)
+
+    def get_annotation(self, annotation_id:str):
+        self._send_json(self.girder.annotations[annotation_id])
+
+    def create_annotation(self):
+        annotation_id = self.girder.add_annotation(self.query['itemId'],json.loads(self.body))
+        self._send_json({'_id': annotation_id})
+
+    def create_item_annotation(self, item_id:str):
+        annotation_id = self.girder.add_annotation(item_id,json.loads(self.body))
+        self._send_json({'_id': annotation_id})
+
+    def patch_annotation(self, annotation_id:str):
+        with self.girder.lock:
+            annotation = self.girder.annotations[annotation_id]
+            apply_patch(annotation['annotation'],json.loads(self.body))
+            annotation['updated'] = datetime.now(timezone.utc).isoformat()
+        self._send_json({'_id': annotation_id})
+
+    def delete_annotation(self, annotation_id:str):
+        with self.girder.lock:
+            del self.girder.annotations[annotation_id]
+        self._send_json({'_id': annotation_id})
+
+    def get_tiles(self, item_id:str):
+        self._send_json(self.girder.items[item_id]['metadata'])
+
+    def _frame_image(self, item_id:str)->np.ndarray:
+        item = self.girder.items[item_id]
+        if 'frame' in self.query and item['frames'] is not None:
+            return item['frames'][int(self.query['frame'])]
+        return item['thumbnail'] if item['thumbnail'] is not None else item['frames'][0]
+
+    def get_thumbnail(self, item_id:str):
+        self._send(encode_png(self._frame_image(item_id)),'image/png')
+
+    def get_tile(self, item_id:str, level:str, x:str, y:str):
+        tile = render_tile(self._frame_image(item_id),self.girder.items[item_id]['metadata'],int(level),int(x),int(y))
+        self._send(encode_png(tile),'image/png')
@@ -0,0 +1,428 @@
+"""
+
+Benchmarks of both CLIs' main() on synthetic slides served by a local Girder stand-in
+
+    python -m benchmarks.run [--quick] [--only hierarchy_plus] [--repeat 3] [--output results.json]
+                             [--baseline benchmarks/baseline.json] [--save-baseline] [--tolerance 0.25]
+
+Every case runs main() in its own process and records the wall time of main(), the peak RSS of that process (VmHWM, which
+unlike ru_maxrss doesn't include the runner's own memory on Linux) and the requests/bytes the server received and sent.
+The annotations it uploaded are then checked against the exact result (computed directly with shapely from the synthetic
+annotations or tissue mask): a case whose output doesn't match (intersection over union below its minimum) or that fails
+makes the exit status 1.
+Results are compared with the baseline if it exists: cases exceeding the baseline by more than the tolerance are reported
+as regressions (and the exit status is 1).
+--save-baseline writes the results as the new baseline instead (only if every case passed its check).
+
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+
+import numpy as np
+
+import shapely
+from shapely import STRtree
+
+from ann_hierarchy.geometry import polygons_from_annotation
+
+from benchmarks.synthetic import synthetic_annotation, brightfield_thumbnail, multiplex_frames, tissue_mask, image_metadata
+from benchmarks.girder_server import SyntheticGirder
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(REPO_DIR,'benchmarks','baseline.json')
+# Metrics compared with the baseline
+COMPARED_METRICS = ['seconds','peak_rss_mb','bytes_received','bytes_sent']
+# Minimum intersection over union of each output with its exact result (tissue is detected at thumbnail or tile resolution)
+MIN_IOU = {'AnnotationHierarchy': 0.999,'CreateTissueAnnotation': 0.95}
+TISSUE_ANNOTATION_NAME = 'Tissue Mask'
+# Outputs are compared cell by cell (so merging overlapping polygons stays local)
+CHECK_CELL_SIZE = 4000
+
+
+def benchmark_cases(quick:bool = False)->list:
+    """
+    Scaling sweeps for both CLIs.
+
+    AnnotationHierarchy cases list the synthetic_annotation arguments of each annotation on the item and either an
+    "operation" on the first two or a "json_spec" (where "$0", "$1", ... are replaced by the annotation ids).
+    CreateTissueAnnotation cases give the image size and thumbnail (or number of frames).
+    """
+    element_counts = [1000,5000] if quick else [1000,10000,50000]
+    thumbnail_sizes = [(240,320),(480,640)] if quick else [(240,320),(480,640),(960,1280)]
+    frame_counts = [4] if quick else [4,16]
+
+    cases = []
+    for n in element_counts:
+        layers = [{'n_elements': n,'seed': 1},{'n_elements': n,'seed': 2}]
+        cases.append({'name': f'hierarchy_plus_{n}','cli': 'AnnotationHierarchy','annotations': layers,'operation': '+'})
+        cases.append({'name': f'hierarchy_minus_{n}','cli': 'AnnotationHierarchy','annotations': layers,'operation': '-'})
+        # Same as hierarchy_plus (bytes_received is the uploaded payload) with adaptive simplification
+        cases.append({
+            'name': f'hierarchy_plus_adaptive_{n}',
+            'cli': 'AnnotationHierarchy',
+            'annotations': layers,
+            'operation': '+',
+            'flags': ['--level_Of_Detail','adaptive'],
+            # Simplified with a tolerance relative to each element's size
+            'min_iou': 0.995
+        })
+        cases.append({
+            'name': f'hierarchy_minus_tiled_{n}',
+            'cli': 'AnnotationHierarchy',
+            'annotations': layers,
+            'operation': '-',
+            'flags': ['--tile_Size','8000','--n_Workers','1']
+        })
+        cases.append({
+            'name': f'hierarchy_invalid_holes_{n}',
+            'cli': 'AnnotationHierarchy',
+            'annotations': [dict(l,hole_fraction=0.2,invalid_fraction=0.05) for l in layers],
+            'operation': '-'
+        })
+        cases.append({
+            'name': f'hierarchy_json_{n}',
+            'cli': 'AnnotationHierarchy',
+            'annotations': [dict(layers[0],properties=True),layers[1]],
+            'json_spec': {'operations': [
+                {'new_name': 'Tubules','ann_id_1': '$0','operation': 'property','property': {'key': 'class','equals': 'tubule'}},
+                {'new_name': 'Large','ann_id_1': '$0','operation': 'property','property': {'key': 'area_px','min': 5000}},
+                {'new_name': 'Tubules minus','ann_id_1': '@Tubules','ann_id_2': '$1','operation': '-'},
+                {'new_name': 'Corner','ann_id_1': '$0','operation': 'within','within': {'coordinates': [[0,0],[20000,0],[20000,20000],[0,20000]]}}
+            ]}
+        })
+
+    for shape in thumbnail_sizes:
+        cases.append({
+            'name': f'tissue_brightfield_{shape[1]}x{shape[0]}',
+            'cli': 'CreateTissueAnnotation',
+            'size': (shape[1]*100,shape[0]*100),
+            'thumbnail': {'shape': shape}
+        })
+    cases.append({
+        'name': 'tissue_brightfield_tiled',
+        'cli': 'CreateTissueAnnotation',
+        'size': (64000,48000),
+        'thumbnail': {'shape': (480,640)},
+        'flags': ['--detection_Downsample','32']
+    })
+    for n_frames in frame_counts:
+        cases.append({
+            'name': f'tissue_multiplex_{n_frames}_frames',
+            'cli': 'CreateTissueAnnotation',
+            'size': (64000,48000),
+            'thumbnail': {'shape': (480,640),'n_frames': n_frames},
+            'flags': ['--brightField','false']
+        })
+
+    return cases
+
+def case_data(case:dict)->dict:
+    """
+    Generate the synthetic annotations or thumbnail(s) of a case.
+    """
+    if case['cli']=='AnnotationHierarchy':
+        return {'annotations': [
+            synthetic_annotation(f'Layer {i}',**kwargs)
+            for i, kwargs in enumerate(case['annotations'])
+        ]}
+
+    n_frames = case['thumbnail'].get('n_frames',0)
+    metadata = image_metadata(*case['size'],n_frames=n_frames)
+    if n_frames>0:
+        return {'metadata': metadata,'frames': multiplex_frames(n_frames,case['thumbnail']['shape'])}
+
+    return {'metadata': metadata,'thumbnail': brightfield_thumbnail(case['thumbnail']['shape'])}
+
+def setup_case(girder:SyntheticGirder, api_url:str, case:dict, data:dict)->list:
+    """
+    Add a case's item (and annotations) to the server. Returns the CLI arguments to run it with.
+    """
+    common_flags = ['--api-url',api_url,'--token','benchmark']+case.get('flags',[])
+
+    if case['cli']=='CreateTissueAnnotation':
+        _, file_id = girder.add_item(data['metadata'],thumbnail=data.get('thumbnail'),frames=data.get('frames'))
+        return [file_id]+common_flags
+
+    item_id, file_id = girder.add_item(image_metadata(40000,40000))
+    ann_ids = [girder.add_annotation(item_id,annotation) for annotation in data['annotations']]
+
+    if 'json_spec' in case:
+        json_spec = json.dumps(case['json_spec'])
+        for i, ann_id in enumerate(ann_ids):
+            json_spec = json_spec.replace(f'"${i}"',f'"{ann_id}"')
+        return [file_id,ann_ids[0],ann_ids[-1],'+','Benchmark','--use_JSON','true','--json_Spec',json_spec]+common_flags
+
+    return [file_id,ann_ids[0],ann_ids[1],case['operation'],'Benchmark']+common_flags
+
+def case_operations(case:dict)->list:
+    """
+    JSON operations of an AnnotationHierarchy case (a single plus/minus operation is named like the CLI's output).
+    """
+    if 'json_spec' in case:
+        return case['json_spec']['operations']
+
+    return [{'new_name': 'Benchmark','ann_id_1': '$0','ann_id_2': '$1','operation': case['operation']}]
+
+def polygon_layer(geoms:np.ndarray):
+    """
+    Function returning the union of polygons within a cell (minx,miny,maxx,maxy).
+    """
+    geoms = np.asarray(geoms,dtype=object)
+    tree = STRtree(geoms)
+    def in_cell(cell:tuple):
+        box = shapely.box(*cell)
+        return shapely.union_all(shapely.intersection(geoms[tree.query(box)],box))
+
+    return in_cell
+
+def exact_outputs(case:dict, data:dict)->dict:
+    """
+    Exact result of each output annotation of a case: ({name: function returning its geometry within a cell}, bounds of
+    the polygons it is made from).
+
+    Plus/minus operations merge both layers with shapely, property and within operations select the elements they match
+    (properties from "equals"/"min"/"max" predicates and the elements entirely within the region).
+    """
+    if case['cli']=='CreateTissueAnnotation':
+        # Not imported with the module, which is also the process running each case
+        from ann_hierarchy.tissue import mask_polygons
+        shape = case['thumbnail']['shape']
+        size_x, size_y = case['size']
+        polygons = mask_polygons(tissue_mask(shape),scale=(size_x/shape[1],size_y/shape[0]))
+        return {TISSUE_ANNOTATION_NAME: polygon_layer(polygons)}, shapely.total_bounds(polygons)
+
+    # Polygons, element index and elements of each annotation, and the function of each layer (annotations and outputs)
+    annotations = {}
+    layers = {}
+    for i, annotation in enumerate(data['annotations']):
+        geoms, element_index = polygons_from_annotation(annotation)
+        annotations[f'${i}'] = (geoms,element_index,annotation['annotation']['elements'])
+        layers[f'${i}'] = polygon_layer(geoms)
+
+    # Earlier outputs are referenced as "@name"
+    layer_name = lambda ann_id: ann_id[1:] if ann_id.startswith('@') else ann_id
+
+    for op in case_operations(case):
+        name_1 = layer_name(op['ann_id_1'])
+        operation = op['operation'].lower()
+        if operation in ['+','-']:
+            merge = shapely.union if operation=='+' else shapely.difference
+            layers[op['new_name']] = lambda cell, a=layers[name_1], b=layers[layer_name(op['ann_id_2'])]: merge(a(cell),b(cell))
+            continue
+
+        geoms, element_index, elements = annotations[name_1]
+        if operation=='property':
+            predicate = op['property']
+            values = [el.get('user',{}).get(predicate['key']) for el in elements]
+            selected = np.array([
+                v is not None
+                and (not 'equals' in predicate or v==predicate['equals'])
+                and (not 'min' in predicate or v>=predicate['min'])
+                and (not 'max' in predicate or v<=predicate['max'])
+                for v in values
+            ],dtype=bool)
+        else:
+            region = shapely.Polygon(op['within']['coordinates'])
+            selected = np.ones(len(elements),dtype=bool)
+            np.logical_and.at(selected,element_index,shapely.within(geoms,region))
+        keep = selected[element_index]
+        annotations[op['new_name']] = (geoms[keep],element_index[keep],elements)
+        layers[op['new_name']] = polygon_layer(geoms[keep])
+
+    outputs = {op['new_name']: layers[op['new_name']] for op in case_operations(case)}
+    return outputs, shapely.total_bounds(np.concatenate([a[0] for a in annotations.values()]))
+
+def check_outputs(case:dict, data:dict, uploaded:dict, cell_size:float = CHECK_CELL_SIZE)->dict:
+    """
+    Compare the annotations a case uploaded ({name: annotation}) with their exact results, cell by cell.
+    Returns the lowest intersection over union and whether it is above the minimum for the case's CLI (an output that
+    wasn't uploaded counts as 0).
+    """
+    exact_layers, bounds = exact_outputs(case,data)
+
+    iou = 1.0
+    for name, exact in exact_layers.items():
+        if not name in uploaded:
+            iou = 0.0
+            continue
+        output_polygons = polygons_from_annotation(uploaded[name])[0]
+        output = polygon_layer(output_polygons)
+        # Cells covering both the output and the exact result
+        minx, miny, maxx, maxy = shapely.total_bounds(np.concatenate([output_polygons,[shapely.box(*bounds)]]))
+        cells = [
+            (x,y,x+cell_size,y+cell_size)
+            for x in np.arange(minx,maxx,cell_size) for y in np.arange(miny,maxy,cell_size)
+        ]
+        intersection_area, union_area = 0.0, 0.0
+        for cell in cells:
+            a, b = output(cell), exact(cell)
+            cell_intersection_area = shapely.area(shapely.intersection(a,b))
+            intersection_area += cell_intersection_area
+            union_area += shapely.area(a)+shapely.area(b)-cell_intersection_area
+        if union_area>0:
+            iou = min(iou,intersection_area/union_area)
+
+    return {'iou': float(iou),'correct': bool(iou>=case.get('min_iou',MIN_IOU[case['cli']]))}
+
+def run_child(cli_name:str, result_path:str, cli_argv:list):
+    """
+    Run one CLI's main() in this process, writing its wall time and the peak RSS of this process to result_path.
+    """
+    from ann_hierarchy.instrument import peak_rss_mb, reset_peak_rss
+    # Only counting this process from start-up (the peak is otherwise already reset by exec)
+    reset_peak_rss()
+
+    from ctk_cli import CLIArgumentParser
+    from ann_hierarchy.batch import load_cli, CLI_DIR
+
+    cli = load_cli(cli_name)
+    args = CLIArgumentParser(os.path.join(CLI_DIR,cli_name,f'{cli_name}.xml')).parse_args(cli_argv)
+
+    # CLI output is not part of the benchmark
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        cli.main(args)
+        seconds = time.perf_counter()-start
+
+    with open(result_path,'w') as f:
+        json.dump({'seconds': seconds,'peak_rss_mb': peak_rss_mb()},f)
+
+def run_case(case:dict, data:dict, repeat:int = 1)->dict:
+    """
+    Run a case repeat times (each against a fresh server and process). Keeps the fastest run's time and the lowest peak RSS,
+    and checks the last run's output (see check_outputs).
+    """
+    runs = []
+    for _ in range(repeat):
+        girder = SyntheticGirder()
+        api_url = girder.start()
+        try:
+            cli_argv = setup_case(girder,api_url,case,data)
+            input_ids = set(girder.annotations)
+            with tempfile.TemporaryDirectory() as temp_dir:
+                result_path = os.path.join(temp_dir,'result.json')
+                process = subprocess.run(
+                    [sys.executable,'-m','benchmarks.run','--child',case['cli'],result_path,'--']+cli_argv,
+                    cwd = REPO_DIR,
+                    capture_output = True,
+                    text = True
+                )
+                if process.returncode!=0:
+                    return {'case': case['name'],'error': process.stderr.strip().splitlines()[-1] if process.stderr.strip() else f'exit code {process.returncode}'}
+                with open(result_path) as f:
+                    result = json.load(f)
+            result.update(girder.counters())
+            result['uploaded'] = {a['annotation']['name']: a for ann_id, a in girder.annotations.items() if not ann_id in input_ids}
+            runs.append(result)
+        finally:
+            girder.stop()
+
+    return {
+        'case': case['name'],
+        'seconds': min(r['seconds'] for r in runs),
+        'peak_rss_mb': min(r['peak_rss_mb'] for r in runs),
+        'requests': runs[-1]['requests'],
+        'bytes_received': runs[-1]['bytes_received'],
+        'bytes_sent': runs[-1]['bytes_sent'],
+        **check_outputs(case,data,runs[-1]['uploaded'])
+    }
+
+def compare_results(results:list, baseline:dict, tolerance:float = 0.25)->list:
+    """
+    Compare results with a baseline ({case: result}). Returns a row per case with the ratio of each metric to the baseline
+    and the metrics exceeding it by more than tolerance.
+    """
+    rows = []
+    for result in results:
+        base = baseline.get(result['case'])
+        row = {'case': result['case'],'ratios': {},'regressions': []}
+        if base is None or 'error' in result or 'error' in base:
+            rows.append(row)
+            continue
+        for metric in COMPARED_METRICS:
+            if base.get(metric):
+                ratio = result[metric]/base[metric]
+                row['ratios'][metric] = ratio
+                if ratio>1+tolerance:
+                    row['regressions'].append(metric)
+        rows.append(row)
+
+    return rows
+
+def print_results(results:list, rows:list):
+    """
+    Print a table of results (with ratios to the baseline where available).
+    """
+    print(f'{"case":<36} {"seconds":>9} {"peak MB":>9} {"requests":>9} {"MB received":>12} {"MB sent":>9} {"IoU":>7}  vs. baseline')
+    for result, row in zip(results,rows):
+        if 'error' in result:
+            print(f'{result["case"]:<36} error: {result["error"]}')
+            continue
+        ratios = ' '.join(f'{m}: {r:.2f}x' for m, r in row['ratios'].items())
+        flag = f'  REGRESSION ({", ".join(row["regressions"])})' if len(row['regressions'])>0 else ''
+        if not result['correct']:
+            flag += '  WRONG OUTPUT'
+        print(
+            f'{result["case"]:<36} {result["seconds"]:>9.3f} {result["peak_rss_mb"]:>9.1f} {result["requests"]:>9} '
+            f'{result["bytes_received"]/1e6:>12.2f} {result["bytes_sent"]/1e6:>9.2f} {result["iou"]:>7.4f}  {ratios}{flag}'
+        )
+
+def main(argv:list = None):
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if len(argv)>0 and argv[0]=='--child':
+        # Single case run by run_case: --child CLI RESULT_PATH -- CLI arguments
+        run_child(argv[1],argv[2],argv[argv.index('--')+1:])
+        return
+
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run',description='Benchmark both CLIs on synthetic slides')
+    parser.add_argument('--quick',action='store_true',help='Smaller scaling sweeps')
+    parser.add_argument('--only',default=None,help='Only run cases whose name contains this')
+    parser.add_argument('--repeat',type=int,default=1,help='Runs per case (fastest is kept)')
+    parser.add_argument('--output',default=None,help='Write results to this JSON file')
+    parser.add_argument('--baseline',default=DEFAULT_BASELINE,help='Baseline JSON file to compare with')
+    parser.add_argument('--save-baseline',action='store_true',help='Write the results to the baseline file instead of comparing')
+    parser.add_argument('--tolerance',type=float,default=0.25,help='Relative increase over the baseline reported as a regression')
+    bench_args = parser.parse_args(argv)
+
+    cases = [c for c in benchmark_cases(bench_args.quick) if bench_args.only is None or bench_args.only in c['name']]
+
+    results = []
+    for i, case in enumerate(cases):
+        print(f'[{i+1}/{len(cases)}] {case["name"]}',flush=True)
+        results.append(run_case(case,case_data(case),bench_args.repeat))
+
+    baseline = {}
+    if not bench_args.save_baseline and os.path.exists(bench_args.baseline):
+        with open(bench_args.baseline) as f:
+            baseline = json.load(f)
+    rows = compare_results(results,baseline,bench_args.tolerance)
+    print_results(results,rows)
+
+    if bench_args.output:
+        with open(bench_args.output,'w') as f:
+            json.dump(results,f,indent=4)
+
+    failed = [r['case'] for r in results if 'error' in r or not r['correct']]
+    if len(failed)>0:
+        print(f'Failed (error or wrong output): {", ".join(failed)}')
+        sys.exit(1)
+
+    if bench_args.save_baseline:
+        with open(bench_args.baseline,'w') as f:
+            json.dump({r['case']: r for r in results},f,indent=4)
+        print(f'Saved baseline: {bench_args.baseline}')
+    elif any(len(row['regressions'])>0 for row in rows):
+        sys.exit(1)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+
+Synthetic annotations, thumbnails and image metadata for benchmarks
+
+"""
+
+import uuid
+
+import numpy as np
+
+from skimage.draw import ellipse
+
+ELEMENT_CLASSES = ['tubule','glomerulus','artery','interstitium']
+
+
+def synthetic_annotation(name:str, n_elements:int, n_vertices:int = 24, extent:tuple = (40000,40000), radius:float = 60.0, hole_fraction:float = 0.0, invalid_fraction:float = 0.0, properties:bool = False, seed:int = 0)->dict:
+    """
+    Create a large-image annotation of n_elements closed polylines scattered over extent (x,y).
+
+    Each element is a noisy star-shaped ring of n_vertices points around a random center (so elements overlap each other
+    like dense structure segmentations do). A hole_fraction of the elements get a hole and an invalid_fraction are made
+    self-intersecting (two vertices swapped). If properties is True each element gets "user" properties (a numeric,
+    a categorical and a nested feature).
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform((0,0),extent,(n_elements,2))
+    radii = rng.uniform(0.5,1.0,(n_elements,1))*radius*rng.uniform(0.8,1.2,(n_elements,n_vertices))
+    angles = np.sort(rng.uniform(0,2*np.pi,(n_elements,n_vertices)),axis=1)
+    coords = np.stack([
+        centers[:,0:1]+radii*np.cos(angles),
+        centers[:,1:2]+radii*np.sin(angles),
+        np.zeros((n_elements,n_vertices))
+    ],axis=-1)
+
+    invalid = rng.random(n_elements)<invalid_fraction
+    coords[invalid,0], coords[invalid,n_vertices//2] = coords[invalid,n_vertices//2].copy(), coords[invalid,0].copy()
+
+    has_hole = rng.random(n_elements)<hole_fraction
+    hole_angles = np.linspace(2*np.pi,0,max(n_vertices//3,3),endpoint=False)
+
+    elements = []
+    for i in range(n_elements):
+        el = {
+            'type': 'polyline',
+            'points': coords[i].tolist(),
+            'closed': True,
+            'id': uuid.uuid4().hex[:24]
+        }
+        if has_hole[i]:
+            hole_radius = 0.3*np.min(radii[i])
+            el['holes'] = [np.column_stack([
+                centers[i,0]+hole_radius*np.cos(hole_angles),
+                centers[i,1]+hole_radius*np.sin(hole_angles),
+                np.zeros(hole_angles.shape[0])
+            ]).tolist()]
+        if properties:
+            el['user'] = {
+                'area_px': float(np.pi*np.mean(radii[i])**2),
+                'class': ELEMENT_CLASSES[i%len(ELEMENT_CLASSES)],
+                'features': {'intensity': float(rng.uniform(0,255))}
+            }
+        elements.append(el)
+
+    return {'annotation': {'name': name,'elements': elements}}
+
+def _tissue_mask(shape:tuple, n_pieces:int, rng)->np.ndarray:
+    """
+    Boolean mask of n_pieces elliptical tissue pieces, each with a few small holes.
+    """
+    mask = np.zeros(shape,dtype=bool)
+    for _ in range(n_pieces):
+        center = rng.uniform(0.2,0.8,2)*shape
+        radii = rng.uniform(0.08,0.2,2)*min(shape)
+        rr, cc = ellipse(center[0],center[1],radii[0],radii[1],shape=shape,rotation=rng.uniform(0,np.pi))
+        mask[rr,cc] = True
+        for _ in range(3):
+            hole = center+rng.uniform(-0.5,0.5,2)*radii
+            rr, cc = ellipse(hole[0],hole[1],radii[0]/10,radii[1]/10,shape=shape)
+            mask[rr,cc] = False
+
+    return mask
+
+def tissue_mask(shape:tuple = (480,640), n_pieces:int = 3, seed:int = 0)->np.ndarray:
+    """
+    Tissue mask of the thumbnails made with the same arguments (brightfield_thumbnail, multiplex_frames).
+    """
+    return _tissue_mask(shape,n_pieces,np.random.default_rng(seed))
+
+def brightfield_thumbnail(shape:tuple = (480,640), n_pieces:int = 3, seed:int = 0)->np.ndarray:
+    """
+    RGB (uint8) thumbnail of a brightfield slide: light background with darker pink tissue pieces.
+    """
+    rng = np.random.default_rng(seed)
+    mask = _tissue_mask(shape,n_pieces,rng)
+
+    image = np.full(shape+(3,),235.0)
+    image[mask] = (200,120,170)
+    image += rng.normal(0,6,image.shape)
+
+    return np.clip(image,0,255).astype(np.uint8)
+
+def multiplex_frames(n_frames:int, shape:tuple = (480,640), n_pieces:int = 3, seed:int = 0)->list:
+    """
+    Grayscale (uint8) thumbnails of each frame of a multiplex slide: dark background, tissue with a different intensity
+    in every frame.
+    """
+    rng = np.random.default_rng(seed)
+    mask = _tissue_mask(shape,n_pieces,rng)
+
+    frames = []
+    for _ in range(n_frames):
+        frame = np.full(shape,10.0)
+        frame[mask] = rng.uniform(60,200)
+        frame += rng.normal(0,5,shape)
+        frames.append(np.clip(frame,0,255).astype(np.uint8))
+
+    return frames
+
+def image_metadata(size_x:int, size_y:int, tile_size:int = 256, n_frames:int = 0)->dict:
+    """
+    Image metadata as returned by /item/{id}/tiles for a synthetic slide of size_x by size_y pixels.
+    """
+    levels = int(np.ceil(np.log2(max(size_x/tile_size,size_y/tile_size,1))))+1
+    metadata = {
+        'sizeX': size_x,
+        'sizeY': size_y,
+        'tileWidth': tile_size,
+        'tileHeight': tile_size,
+        'levels': levels,
+        'mm_x': 0.00025,
+        'mm_y': 0.00025,
+        'magnification': 40
+    }
+    if n_frames>0:
+        metadata['frames'] = [{'Frame': f,'Index': f,'IndexC': f} for f in range(n_frames)]
+
+    return metadata
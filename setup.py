@@ -39,7 +39,7 @@ setup(
     author='Sam Border',
     author_email='samuel.border@medicine.ufl.edu',
     url='https://github.com/spborder/annotation-hierarchy/',
-    packages=find_packages(exclude=['tests', '*_test']),
+    packages=find_packages(exclude=['tests', '*_test', 'benchmarks', 'benchmarks.*']),
     package_dir={
         'ann_hierarchy': 'ann_hierarchy',
     },
@@ -52,7 +52,9 @@ setup(
         'ctk-cli',
         'shapely==2.0.1',
         'scikit-image',
-        'numpy'
+        'numpy',
+        # fast JSON encoding of uploaded annotations
+        'orjson'
     ],
     license='Apache Software License 2.0',
     keywords='ann_hierarchy',
@@ -0,0 +1,67 @@
+import os
+import json
+
+import numpy as np
+
+import pytest
+
+import shapely
+
+from ann_hierarchy.batch import parse_cli_args, run_batch, run_local_slide
+from ann_hierarchy.geometry import polygons_from_annotation
+from ann_hierarchy.local_io import LocalAnnotationCache, read_annotation_file, IMAGE_METADATA_NAME
+
+
+def box_annotation(name:str, boxes:list)->dict:
+    return {'name': name,'elements': [
+        {'type': 'polyline','points': [[x,y,0] for x,y in shapely.box(*b).exterior.coords[:-1]],'closed': True}
+        for b in boxes
+    ]}
+
+def write_slide(slide_dir:str, cells_width:float):
+    """
+    Slide directory with "Regions.json", a "Cells" annotation in "layer_2.json" (only found by name) and image metadata.
+    Every file gets the same modification time in every slide, as if copied with cp -p.
+    """
+    os.makedirs(slide_dir)
+    files = {
+        'Regions.json': box_annotation('Regions',[(0,0,100,100)]),
+        'layer_2.json': box_annotation('Cells',[(0,0,cells_width,100)]),
+        IMAGE_METADATA_NAME: {'sizeX': 200,'sizeY': 200,'levels': 1,'tileWidth': 256,'tileHeight': 256}
+    }
+    for file_name, content in files.items():
+        path = os.path.join(slide_dir,file_name)
+        with open(path,'w') as f:
+            json.dump(content,f)
+        os.utime(path,(1700000000,1700000000))
+
+def result_area(path:str)->float:
+    return float(np.sum(shapely.area(polygons_from_annotation(read_annotation_file(path)[0])[0])))
+
+
+def test_local_batch_with_shared_cache(tmp_path):
+    slides = [str(tmp_path/'slides'/'slide_1'),str(tmp_path/'slides'/'slide_2')]
+    write_slide(slides[0],50)
+    write_slide(slides[1],20)
+
+    spec = {'operations': [{'new_name': 'Outside cells','ann_id_1': 'Regions','ann_id_2': 'Cells','operation': '-'}]}
+    args = parse_cli_args('AnnotationHierarchy',['','','','','--use_JSON','true','--json_Spec',json.dumps(spec),'--cache_Dir',str(tmp_path/'cache')])
+
+    output_dir = str(tmp_path/'results')
+    summaries = run_batch(run_local_slide,'AnnotationHierarchy',args,slides,output_dir)
+    assert all(not 'error' in s for s in summaries)
+
+    # Each slide is computed from its own files, even with a shared cache_dir and identical file names and times
+    assert np.isclose(result_area(os.path.join(output_dir,'slide_1','Outside cells.json')),5000)
+    assert np.isclose(result_area(os.path.join(output_dir,'slide_2','Outside cells.json')),8000)
+
+def test_local_cache_skips_image_metadata(tmp_path):
+    slide_dir = str(tmp_path/'slide')
+    write_slide(slide_dir,50)
+
+    cache = LocalAnnotationCache(slide_dir)
+    assert sorted(cache.paths)==['Regions','layer_2']
+    assert cache.get_image_metadata()['sizeX']==200
+    assert cache.get_annotation('Cells')['annotation']['name']=='Cells'
+    with pytest.raises(KeyError):
+        cache.get_annotation('tiles')
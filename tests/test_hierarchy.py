@@ -0,0 +1,95 @@
+import numpy as np
+
+import pytest
+
+import shapely
+
+from ann_hierarchy.hierarchy import assign_parents, containment_hierarchy, hierarchy_elements
+
+
+def polyline(geom)->dict:
+    return {'type': 'polyline','points': [[x,y,0] for x,y in geom.exterior.coords[:-1]],'closed': True}
+
+def layer(geoms:list)->tuple:
+    return np.array(geoms,dtype=object), np.arange(len(geoms)), len(geoms)
+
+
+# Two regions, with one child inside each, one straddling the first region's edge and one outside both
+REGIONS = [shapely.box(0,0,10,10),shapely.box(20,0,30,10)]
+CHILDREN = [shapely.box(2,2,4,4),shapely.box(22,2,24,4),shapely.box(8,4,12,6),shapely.box(14,4,16,6)]
+
+
+def test_assign_parents_largest_overlap():
+    parents = np.array([shapely.box(0,0,10,10),shapely.box(0,0,4,4),shapely.box(5,0,15,10)],dtype=object)
+    children = np.array([shapely.box(1,1,3,3),shapely.box(7,2,13,4),shapely.box(40,40,41,41)],dtype=object)
+
+    parent, overlap, pairs = assign_parents(children,np.arange(3),3,parents,np.arange(3))
+    # Ties go to the smaller parent
+    assert parent.tolist()==[1,2,-1]
+    assert np.allclose(overlap,[1.0,1.0,0.0])
+    assert pairs.shape==(2,2)
+
+def test_assign_parents_multi_part_elements():
+    # Child element 0 has two parts, mostly inside parent element 1 (also in two parts)
+    children = np.array([shapely.box(0,0,1,1),shapely.box(10,0,13,1)],dtype=object)
+    parents = np.array([shapely.box(-1,-1,2,2),shapely.box(9,-1,11,2),shapely.box(11,-1,14,2)],dtype=object)
+
+    parent, overlap, _ = assign_parents(children,np.array([0,0]),1,parents,np.array([0,1,1]))
+    assert parent.tolist()==[1]
+    assert np.isclose(overlap[0],0.75)
+
+def test_containment_keep():
+    hierarchy = containment_hierarchy([layer(REGIONS),layer(CHILDREN)],min_overlap=0.5,outside='keep')
+
+    children = hierarchy[1]
+    assert children['element'].tolist()==[0,1,2,3]
+    assert children['parent'].tolist()==[0,1,0,-1]
+    assert children['depth'].tolist()==[1,1,1,0]
+    assert np.allclose(children['overlap'],[1.0,1.0,0.5,0.0])
+
+def test_containment_drop():
+    hierarchy = containment_hierarchy([layer(REGIONS),layer(CHILDREN)],min_overlap=0.6,outside='drop')
+
+    children = hierarchy[1]
+    assert children['element'].tolist()==[0,1]
+    assert children['parent'].tolist()==[0,1]
+    assert all(g is None for g in children['geoms'])
+
+def test_containment_clip():
+    hierarchy = containment_hierarchy([layer(REGIONS),layer(CHILDREN)],min_overlap=0.5,outside='clip')
+
+    children = hierarchy[1]
+    assert children['element'].tolist()==[0,1,2]
+    assert children['geoms'][0] is None
+    assert shapely.equals(children['geoms'][2],shapely.box(8,4,10,6))
+
+def test_containment_dropped_elements_are_not_parents():
+    grandchildren = [shapely.box(2.5,2.5,3.5,3.5),shapely.box(14.5,4.5,15.5,5.5)]
+    layers = [layer(REGIONS),layer(CHILDREN),layer(grandchildren)]
+
+    kept = containment_hierarchy(layers,outside='keep')
+    assert kept[2]['parent'].tolist()==[0,3]
+    assert kept[2]['depth'].tolist()==[2,1]
+
+    dropped = containment_hierarchy(layers,outside='drop')
+    assert dropped[2]['element'].tolist()==[0]
+    assert dropped[2]['depth'].tolist()==[2]
+
+def test_containment_invalid_outside():
+    with pytest.raises(ValueError):
+        containment_hierarchy([layer(REGIONS)],outside='ignore')
+
+def test_hierarchy_elements_parent_ids():
+    annotations = [
+        {'annotation': {'name': 'Regions','elements': [polyline(g) for g in REGIONS]}},
+        {'annotation': {'name': 'Children','elements': [dict(polyline(g),user={'n': i}) for i, g in enumerate(CHILDREN)]}}
+    ]
+    polygons = [(np.array(REGIONS,dtype=object),np.arange(2)),(np.array(CHILDREN,dtype=object),np.arange(4))]
+
+    elements = hierarchy_elements(annotations,polygons,outside='clip')
+    regions, children = elements[:2], elements[2:]
+    assert [el['user']['hierarchy']['layer'] for el in elements]==['Regions']*2+['Children']*3
+    assert [el['user']['hierarchy']['parent'] for el in children]==[regions[0]['id'],regions[1]['id'],regions[0]['id']]
+    assert [el['user']['n'] for el in children]==[0,1,2]
+    assert children[2]['user']['hierarchy']['clipped']
+    assert len(set(el['id'] for el in elements))==len(elements)
@@ -0,0 +1,72 @@
+import numpy as np
+
+import shapely
+
+from ann_hierarchy.raster import burn_polygons, trace_polygons, raster_boolean
+from ann_hierarchy.tiled import area_deviation
+
+EMPTY = np.empty(0,dtype=object)
+
+
+def pixel_grid(shape:tuple, resolution:float = 1.0)->np.ndarray:
+    """
+    Pixel center points of a (rows, cols) grid with its origin at (0,0).
+    """
+    rows, cols = np.mgrid[:shape[0],:shape[1]]
+    return shapely.points((cols+0.5)*resolution,(rows+0.5)*resolution)
+
+
+def test_burn_matches_pixel_centers():
+    polygon = shapely.Polygon([(3.2,2.7),(40.1,5.3),(35.6,30.2),(6.4,25.9)],[[(15,12),(25,12),(20,20)]])
+    mask = burn_polygons(np.array([polygon]),(0,0),(40,50),1.0)
+
+    expected = shapely.contains_xy(polygon,*np.meshgrid(np.arange(50)+0.5,np.arange(40)+0.5))
+    assert mask.dtype==bool
+    assert np.array_equal(mask,expected)
+
+def test_burn_overlapping_polygons_and_resolution():
+    polygons = np.array([shapely.box(2,2,20,20),shapely.box(10,10,30,30),shapely.box(12,12,14,14)])
+    mask = burn_polygons(polygons,(0,0),(16,16),2.0)
+
+    expected = shapely.intersects(shapely.union_all(polygons),pixel_grid((16,16),2.0))
+    assert np.array_equal(mask,expected)
+
+def test_burn_empty():
+    assert not np.any(burn_polygons(EMPTY,(0,0),(8,8),1.0))
+
+def test_trace_area_is_pixel_area():
+    rng = np.random.default_rng(0)
+    mask = rng.random((60,80))<0.5
+
+    polygons = trace_polygons(mask,scale=2.0)
+    assert np.all(shapely.is_valid(polygons))
+    assert np.sum(shapely.area(polygons))==mask.sum()*4
+
+def test_trace_follows_pixel_edges():
+    mask = np.zeros((20,20),dtype=bool)
+    mask[5:15,4:14] = True
+    mask[8:10,8:11] = False
+
+    polygons = trace_polygons(mask,offset=(0.5,0.5))
+    assert polygons.shape[0]==1
+    assert shapely.equals(polygons[0],shapely.box(4,5,14,15).difference(shapely.box(8,8,11,10)))
+
+def test_raster_union_and_difference_match_exact():
+    rng = np.random.default_rng(1)
+    geoms_1 = shapely.buffer(shapely.points(rng.uniform(0,400,(60,2))),rng.uniform(10,30,60))
+    geoms_2 = shapely.buffer(shapely.points(rng.uniform(0,400,(60,2))),rng.uniform(10,30,60))
+
+    union, stats = raster_boolean(geoms_1,geoms_2,'union',0.5,tile_pixels=256)
+    assert area_deviation(union,[shapely.union_all(np.concatenate([geoms_1,geoms_2]))])<0.01
+    assert stats['pixel_area_deviation']<0.01
+
+    difference, _ = raster_boolean(geoms_1,geoms_2,'difference',0.5,tile_pixels=256)
+    exact = shapely.difference(shapely.union_all(geoms_1),shapely.union_all(geoms_2))
+    assert area_deviation(difference,[exact])<0.02
+
+def test_raster_squares_are_exact():
+    squares = np.array([shapely.box(i*150,0,i*150+100,100) for i in range(3)])
+
+    result, stats = raster_boolean(squares,EMPTY,'union',1.0,tile_pixels=128)
+    assert stats['pixels']==30000
+    assert np.isclose(np.sum(shapely.area(result)),30000)
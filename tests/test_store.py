@@ -0,0 +1,126 @@
+import os
+
+import numpy as np
+
+import shapely
+from shapely import STRtree
+
+from ann_hierarchy.incremental import touched_elements
+from ann_hierarchy.store import write_layer, GeometryLayer, GeometryStore
+
+
+def sample_polygons()->tuple:
+    """
+    Polygons with and without holes, where element 1 has two parts.
+    """
+    polygons = np.array([
+        shapely.box(0,0,10,10),
+        shapely.Polygon([(20,0),(30,0),(30,10),(20,10)],[[(22,2),(24,2),(24,4)],[(26,6),(28,6),(28,8),(26,8)]]),
+        shapely.Polygon([(40,0),(45,8),(50,0)]),
+        shapely.box(0,20,5,25).difference(shapely.box(1,21,2,22))
+    ],dtype=object)
+
+    return polygons, np.array([0,1,1,2])
+
+
+def test_layer_round_trip(tmp_path):
+    polygons, element_index = sample_polygons()
+    path = os.path.join(tmp_path,'layer.geom')
+    write_layer(path,polygons,element_index,{'name': 'A'})
+
+    layer = GeometryLayer(path)
+    geoms, index = layer.polygons()
+    assert len(layer)==4
+    assert layer.metadata['name']=='A'
+    assert layer.metadata['rings']==7
+    assert index.tolist()==[0,1,1,2]
+    assert all(shapely.equals(a,b) for a, b in zip(geoms,polygons))
+    assert [len(g.interiors) for g in geoms]==[0,2,0,1]
+
+def test_layer_subsets_and_bbox(tmp_path):
+    polygons, element_index = sample_polygons()
+    path = os.path.join(tmp_path,'layer.geom')
+    write_layer(path,polygons,element_index)
+
+    layer = GeometryLayer(path)
+    assert np.allclose(layer.bounds,shapely.bounds(polygons))
+
+    geoms, index = layer.polygons([3,1])
+    assert index.tolist()==[2,1]
+    assert shapely.equals(geoms[0],polygons[3]) and shapely.equals(geoms[1],polygons[1])
+    assert layer.polygons([])[0].shape==(0,)
+
+    assert layer.query_bbox([25,5,42,6]).tolist()==[1,2]
+    # The triangle's bounding box reaches its top left corner but the triangle doesn't
+    geoms, index = layer.polygons_in_bbox([40,7,41,8])
+    assert index.tolist()==[]
+    geoms, index = layer.polygons_in_bbox([-5,15,1,21])
+    assert index.tolist()==[2]
+    assert shapely.equals(geoms[0],polygons[3])
+
+def test_touched_elements_from_layer(tmp_path):
+    polygons, element_index = sample_polygons()
+    path = os.path.join(tmp_path,'layer.geom')
+    write_layer(path,polygons,element_index)
+
+    # Recomputed polygons from two tiles, near elements 1 and 2 but not 0
+    new_polygons = np.array([shapely.box(31,4,33,6),shapely.box(6,23,8,24)],dtype=object)
+    in_memory = touched_elements({'geoms': polygons,'element_index': element_index},new_polygons,[[1],[0,2]],1.5,STRtree(polygons))
+    from_layer = touched_elements({'layer': GeometryLayer(path)},new_polygons,[[1],[0,2]],1.5)
+    assert in_memory.tolist()==from_layer.tolist()==[1,2]
+
+def test_layer_without_bounds(tmp_path):
+    polygons, element_index = sample_polygons()
+    path = os.path.join(tmp_path,'layer.geom')
+    write_layer(path,polygons,element_index)
+    os.remove(os.path.join(path,'bounds.npy'))
+
+    assert np.allclose(GeometryLayer(path).bounds,shapely.bounds(polygons))
+
+def test_layer_skips_empty_and_non_polygons(tmp_path):
+    polygons = np.array([shapely.box(0,0,1,1),shapely.Polygon(),shapely.LineString([(0,0),(1,1)]),shapely.box(2,2,3,3)],dtype=object)
+    path = os.path.join(tmp_path,'layer.geom')
+    write_layer(path,polygons,np.arange(4))
+
+    geoms, index = GeometryLayer(path).polygons()
+    assert index.tolist()==[0,3]
+    assert shapely.equals(geoms[1],shapely.box(2,2,3,3))
+
+def test_empty_layer(tmp_path):
+    path = os.path.join(tmp_path,'layer.geom')
+    write_layer(path,np.empty(0,dtype=object),np.empty(0,dtype=np.int64))
+
+    layer = GeometryLayer(path)
+    geoms, index = layer.polygons()
+    assert len(layer)==0
+    assert geoms.shape==(0,) and index.shape==(0,)
+
+def test_store_versions(tmp_path):
+    polygons, element_index = sample_polygons()
+    store = GeometryStore(str(tmp_path))
+    store.write('abc','2024-01-01T00:00:00+00:00',polygons,element_index)
+
+    assert store.has('abc','2024-01-01T00:00:00+00:00')
+    assert not store.has('abc','2024-01-02T00:00:00+00:00')
+    assert not store.has('abc',None)
+
+    # Writing the same version again keeps the first copy
+    store.write('abc','2024-01-01T00:00:00+00:00',polygons[:1],element_index[:1])
+    layer = store.open('abc','2024-01-01T00:00:00+00:00')
+    assert len(layer)==4
+    assert layer.metadata['annotation_id']=='abc'
+    assert [p for p in os.listdir(tmp_path) if p.endswith('.tmp')]==[]
+
+def test_store_only_removes_its_npz(tmp_path):
+    annotation_id = '0123456789abcdef01234567'
+    arrays = {'wkb': np.zeros(1,dtype=np.uint8),'offsets': np.zeros(2,dtype=np.int64),'element_index': np.zeros(1,dtype=np.int64)}
+    # Written by the previous geometry cache
+    np.savez(os.path.join(tmp_path,f'{annotation_id}_2024_01_01.npz'),**arrays)
+    # Other files: a different name, or the same name pattern with other arrays
+    np.savez(os.path.join(tmp_path,'features.npz'),**arrays)
+    np.savez(os.path.join(tmp_path,f'{annotation_id}_other.npz'),x=np.zeros(1))
+    with open(os.path.join(tmp_path,f'{annotation_id}_2024_01_01.json'),'w') as f:
+        f.write('{}')
+
+    GeometryStore(str(tmp_path))
+    assert sorted(os.listdir(tmp_path))==[f'{annotation_id}_2024_01_01.json',f'{annotation_id}_other.npz','features.npz']
@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+import shapely
+
+from ann_hierarchy.batch import load_cli
+from ann_hierarchy.geometry import polygons_from_annotation
+from ann_hierarchy.tissue import reduce_frames, frame_intensity
+
+from benchmarks.synthetic import brightfield_thumbnail, multiplex_frames, image_metadata
+from benchmarks.girder_server import render_tile
+
+METADATA = image_metadata(64000,48000)
+
+
+def tissue_area(thumbnail:np.ndarray, gray:np.ndarray, detection_downsample:float, brightfield:bool = True, level_tile = None):
+    """
+    Union of the tissue annotation created from a synthetic slide (from the thumbnail or from tiles of a pyramid level).
+    """
+    cli = load_cli('CreateTissueAnnotation')
+    args = SimpleNamespace(threshold=0,detection_downsample=detection_downsample,brightfield=brightfield,n_workers=2)
+    if level_tile is None:
+        level_tile = lambda z,x,y: render_tile(thumbnail,METADATA,z,x,y)
+
+    annotation = cli.create_tissue_annotation(args,gray,METADATA,level_tile)
+    return shapely.union_all(polygons_from_annotation(annotation)[0])
+
+def iou(a, b)->float:
+    return shapely.area(shapely.intersection(a,b))/shapely.area(shapely.union(a,b))
+
+
+def test_brightfield_tiled_matches_thumbnail():
+    thumbnail = brightfield_thumbnail((480,640))
+    gray = load_cli('CreateTissueAnnotation').thumbnail_grayscale(thumbnail,True)
+
+    from_thumbnail = tissue_area(thumbnail,gray,0)
+    from_tiles = tissue_area(thumbnail,gray,32)
+
+    # The synthetic pieces cover under a fifth of the slide, the background must not be selected
+    assert 0.05<from_thumbnail.area/(64000*48000)<0.2
+    assert iou(from_thumbnail,from_tiles)>0.95
+
+def test_multiplex_tiled_matches_thumbnail():
+    frames = multiplex_frames(3,(480,640))
+    gray = reduce_frames(lambda f: frame_intensity(frames[f]),[0,1,2])
+    level_tile = lambda z,x,y: reduce_frames(lambda f: frame_intensity(render_tile(frames[f],METADATA,z,x,y)),[0,1,2])
+
+    from_thumbnail = tissue_area(None,gray,0,brightfield=False)
+    from_tiles = tissue_area(None,gray,32,brightfield=False,level_tile=level_tile)
+
+    assert 0.05<from_thumbnail.area/(64000*48000)<0.2
+    assert iou(from_thumbnail,from_tiles)>0.95